@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import concurrent.futures as cf
 import numpy as np
 import ctypes as ct
+import hashlib
+import os
 import string
 import h5py
 import scipy.interpolate as spint 
@@ -28,6 +31,563 @@ def elt_atomw_cgs(element):
     element = string.capwords(element)
     return atomw_u_dct[element] * c.u
 
+def parse_ps20ion(ion, emission=False):
+    '''
+    get the parent element abbreviation and ionization stage for an
+    ion or emission line name (see Linetable_PS20.parse_ionname)
+
+    Returns:
+    --------
+    elementshort: str
+        element abbreviation, e.g. 'O', 'Fe'
+    ionstage: int or str
+        ionization stage (1 = neutral); a str for 'hmolssh'
+    wavelength_cm: float or None
+        line wavelength for emission lines, None for ions
+    '''
+    wavelength_cm = None
+    # lines are formatted as in the IdentifierLines dataset
+    if emission: 
+        try:
+            elementshort = ion[:2].strip()
+            ionstage = int(ion[2:4])
+            if ion.endswith('A'):
+                # wavelength in Angstrom
+                wavelength_cm = float(ion[4:-1]) * 1e-8
+            else:
+                msg = 'Could not extract wavelength from line "{}"'
+                raise ValueError(msg.format(ion))
+        except:
+            msg = 'Failed to parse "{}" as an emission line'
+            raise ValueError(msg.format(ion))
+    else: # ions are '<elt><stage>....'
+        try:
+            if ion == 'hmolssh':
+                elementshort = 'H'
+                # get a useful error, I hope
+                ionstage = 'invalid index for hmolssh'
+            else:
+                ionstage = ''
+                i = 0
+                while not ion[i].isdigit():
+                    i += 1             
+                elementshort = string.capwords(ion[:i])
+                elementshort = elementshort.strip()
+                while ion[i].isdigit():
+                    ionstage = ionstage + ion[i]
+                    i += 1
+                    if i == len(ion):
+                        break
+                ionstage = int(ionstage)
+        except:
+            msg = 'Failed to parse "{}" as an ion'
+            raise ValueError(msg.format(ion))
+    return elementshort, ionstage, wavelength_cm
+
+# PS20 table metadata, bins, and redshift-interpolated (T, Z, nH) 
+# tables, shared by all Linetable_PS20 instances in a process. 
+# The cached arrays are read-only, since they are shared.
+_ps20metadata = {}
+_ps20bins = {}
+_ps20lineids = {}
+_ps20tables = {}
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+def get_ps20_metadata(ionbalfile=ol.iontab_sylvia_ssh):
+    '''
+    element names, masses, and abundances from a PS20 ion balance 
+    table file, only read once per process
+
+    Returns:
+    --------
+    dict with keys 
+        'TotalAbundances': element abundances n_i / n_H 
+                           (metallicity bin, element)
+        'ElementNamesShort', 'ElementNames': lists of str
+        'ElementMasses': element masses in atomic mass units
+        'SolarMetallicity': solar metal mass fraction
+    '''
+    if ionbalfile not in _ps20metadata:
+        with h5py.File(ionbalfile, 'r') as f:
+            out = {}
+            out['TotalAbundances'] = _readonly(f['TotalAbundances'][:, :])
+            out['ElementNamesShort'] = [elt.decode().strip() for elt in
+                                        f['ElementNamesShort'][:]]
+            out['ElementNames'] = [elt.decode().strip() for elt in 
+                                   f['ElementNames'][:]]
+            out['ElementMasses'] = _readonly(f['ElementMasses'][:])
+            out['SolarMetallicity'] = f['SolarMetallicity'][0]
+        _ps20metadata[ionbalfile] = out
+    return _ps20metadata[ionbalfile]
+
+def get_ps20_element(ion, emission=False, 
+                     ionbalfile=ol.iontab_sylvia_ssh):
+    '''
+    get the parent element of an ion or emission line without 
+    setting up a Linetable_PS20 instance or reading any tables
+
+    Returns:
+    --------
+    element: str
+        parent element name, as in the table (e.g., 'Oxygen')
+    elementmass_u: float
+        parent element mass in atomic mass units
+    '''
+    elementshort = parse_ps20ion(ion, emission=emission)[0]
+    md = get_ps20_metadata(ionbalfile)
+    if elementshort not in md['ElementNamesShort']:
+        msg = 'Data for element {elt} is not available'
+        msg = msg.format(elt=elementshort)
+        raise ValueError(msg)
+    eltind = md['ElementNamesShort'].index(elementshort)
+    return md['ElementNames'][eltind], md['ElementMasses'][eltind]
+
+def get_ps20_bins(tablefile):
+    '''
+    table bins (log T [K], log nH [cm**-3], log Z / Z_solar, 
+    redshift) for a PS20 table file. The lowest metallicity bin 
+    (log Z / Z_solar = -50., primordial) is omitted.
+    '''
+    if tablefile not in _ps20bins:
+        with h5py.File(tablefile, 'r') as f:
+            out = {}
+            out['logTK'] = f['TableBins/TemperatureBins'][:]
+            out['lognHcm3'] = f['TableBins/DensityBins'][:]
+            out['logZsol'] = f['TableBins/MetallicityBins'][1:]
+            out['redshifts'] = f['TableBins/RedshiftBins'][:]
+        _ps20bins[tablefile] = {key: _readonly(out[key]) for key in out}
+    return _ps20bins[tablefile]
+
+def get_ps20_lineindex(line, emtabfile=ol.emtab_sylvia_ssh):
+    '''
+    index of an emission line (IdentifierLines entry) in the 
+    emissivity tables
+    '''
+    if emtabfile not in _ps20lineids:
+        with h5py.File(emtabfile, 'r') as f:
+            lineid = f['IdentifierLines'][:]
+            _ps20lineids[emtabfile] = [_line.decode() for _line in lineid]
+    lineids = _ps20lineids[emtabfile]
+    if line not in lineids:
+        msg = 'Line {line} is not in the IdentifierLines of {tab}'
+        raise ValueError(msg.format(line=line, tab=emtabfile))
+    return lineids.index(line)
+
+def ps20table_filen(tablefile, tablepath, index, z, lintable,
+                    outdir=None):
+    '''
+    file name for a stored redshift-interpolated table, or None if 
+    no outdir is given and opts_locs does not set dir_ps20tables
+    '''
+    if outdir is None:
+        outdir = getattr(ol, 'dir_ps20tables', None)
+        if outdir is None:
+            return None
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    key = '{}:{}:{}:{}:{}'.format(os.path.abspath(tablefile), 
+                                  tablepath.strip('/'), index,
+                                  repr(float(z)), lintable)
+    tag = hashlib.md5(key.encode()).hexdigest()[:12]
+    base = os.path.basename(tablefile).split('.')[0]
+    return outdir + f'{base}_{tag}.hdf5'
+
+def _sourceid(tablefile):
+    stat = os.stat(tablefile)
+    return stat.st_size, stat.st_mtime
+
+def _read_ps20table(filen, tablefile):
+    if not os.path.isfile(filen):
+        return None
+    try:
+        with h5py.File(filen, 'r') as f:
+            # the source table was replaced: redo the interpolation
+            if (f.attrs['sourcesize'], f.attrs['sourcemtime']) \
+                    != _sourceid(tablefile):
+                return None
+            return f['table'][:]
+    except (OSError, KeyError):
+        return None
+
+def _save_ps20table(filen, table, tablefile, tablepath, index, z, 
+                    lintable):
+    try:
+        outdir = os.path.dirname(filen)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        # write to a temporary file first: other processes might 
+        # be reading the table
+        tempfilen = filen + '.{}.tmp'.format(os.getpid())
+        with h5py.File(tempfilen, 'w') as f:
+            f.create_dataset('table', data=table)
+            f.attrs.create('sourcefile', np.string_(tablefile))
+            sourcesize, sourcemtime = _sourceid(tablefile)
+            f.attrs.create('sourcesize', sourcesize)
+            f.attrs.create('sourcemtime', sourcemtime)
+            f.attrs.create('tablepath', np.string_(tablepath))
+            f.attrs.create('index', index)
+            f.attrs.create('z', z)
+            f.attrs.create('lintable', lintable)
+            _info = ('PS20 table values for one ion, line, or element '
+                     '(last index in tablepath) at redshift z, '
+                     'interpolated linearly in redshift, in linear '
+                     '(lintable=True) or log space. Axes: temperature, '
+                     'metallicity (lowest bin omitted), density.')
+            f.attrs.create('info', np.string_(_info))
+        os.replace(tempfilen, filen)
+    except (OSError, ValueError) as err:
+        print('Warning: could not save PS20 table '
+              '{}:\n{}'.format(filen, err))
+
+def get_ps20_table(tablefile, tablepath, index, z, lintable=False,
+                   usecache=True):
+    '''
+    get a PS20 (temperature, metallicity, density) table for one 
+    ion, emission line, or element (depletion) at redshift z. Tables
+    are interpolated linearly in redshift (in linear space for 
+    lintable=True, otherwise in log space). The lowest metallicity 
+    bin is omitted.
+
+    Tables are only read in and interpolated once per process, and 
+    are shared between Linetable_PS20 instances; do not modify them
+    in place. 
+
+    Parameters:
+    -----------
+    tablefile: str
+        the PS20 table file (including the full path)
+    tablepath: str
+        path to the dataset in the file (redshift, temperature, 
+        metallicity, density, ion/line/element)
+    index: int
+        ion, line, or element index along the last table axis 
+    z: float
+        redshift
+    lintable: bool
+        return the table in linear (True) or log (False) space
+    usecache: bool
+        read the interpolated table from disk 
+        (opts_locs.dir_ps20tables) if it was stored before, and 
+        store it if not. If opts_locs does not set dir_ps20tables,
+        tables are only kept in memory.
+
+    Returns:
+    --------
+    table: float array
+        table values (temperature, metallicity, density)
+    '''
+    z = float(z)
+    key = (tablefile, tablepath.strip('/'), index, z, lintable)
+    if key in _ps20tables:
+        return _ps20tables[key]
+    table = None
+    if usecache:
+        filen = ps20table_filen(tablefile, tablepath, index, z, lintable)
+        usecache = filen is not None
+    if usecache:
+        table = _read_ps20table(filen, tablefile)
+    if table is None:
+        redshifts = get_ps20_bins(tablefile)['redshifts']
+        if z < redshifts[0] or z > redshifts[-1]:
+            msg = ('Desired redshift {z} is outside the tabulated range '
+                   '{zmin} - {zmax}')
+            msg = msg.format(z=z, zmin=redshifts[0], zmax=redshifts[-1])
+            raise ValueError(msg)
+        zi_lo = np.max(np.where(z >= redshifts)[0])
+        zi_hi = np.min(np.where(z <= redshifts)[0])
+        with h5py.File(tablefile, 'r') as f:
+            tableg = f[tablepath] 
+            # 0: Redshift, 1: Temperature, 2: Metallicity, 
+            # 3: Density, 4: Ion / Line / Element
+            if zi_lo == zi_hi:
+                table = tableg[zi_lo, :, 1:, :, index]
+                if lintable:
+                    table = 10**table
+            else:
+                msg = ('Linearly interpolating table {} values in '
+                       'redshift').format(tablepath)
+                print(msg)
+                z_lo = redshifts[zi_lo]
+                z_hi = redshifts[zi_hi]
+                tab_lo = tableg[zi_lo, :, 1:, :, index]
+                tab_hi = tableg[zi_hi, :, 1:, :, index]
+                if lintable:
+                    tab_lo = 10**tab_lo
+                    tab_hi = 10**tab_hi
+                table = (z_hi - z) / (z_hi - z_lo) * tab_lo + \
+                        (z - z_lo) / (z_hi - z_lo) * tab_hi
+        # stored in the format used in the interpolation
+        table = np.ascontiguousarray(table, dtype=np.float32)
+        if usecache:
+            _save_ps20table(filen, table, tablefile, tablepath, index, z,
+                            lintable)
+    _ps20tables[key] = _readonly(table)
+    return table
+
+# C interpolation functions, by library file; the libraries are only
+# loaded once per process
+_cinterpfunctions = {}
+
+def get_cinterpfunction(cfile=None):
+    '''
+    get the interpolate_3d function from the C interpolation library
+    (default: opts_locs.c_interpfile), with its argument types set.
+    The library needs to be compiled with some extra options:
+    make -f make_emission_only
+    '''
+    if cfile is None:
+        cfile = ol.c_interpfile
+    if cfile not in _cinterpfunctions:
+        acfile = ct.CDLL(cfile)
+        interpfunction = acfile.interpolate_3d 
+        # just a linear interpolator; works for non-emission stuff too
+        # tables are T x Z x nH
+        type_floatarray = np.ctypeslib.ndpointer(dtype=ct.c_float, ndim=1,
+                                                 flags='C_CONTIGUOUS')
+        interpfunction.argtypes = [type_floatarray,
+                                   type_floatarray,
+                                   type_floatarray,
+                                   ct.c_longlong, 
+                                   type_floatarray,
+                                   type_floatarray,
+                                   ct.c_int,
+                                   type_floatarray,
+                                   ct.c_int,
+                                   type_floatarray,
+                                   ct.c_int,
+                                   type_floatarray]
+        interpfunction.restype = ct.c_int
+        _cinterpfunctions[cfile] = interpfunction
+    return _cinterpfunctions[cfile]
+
+def _float32buffer(arr):
+    '''
+    1D, contiguous float32 version of an array; no copy is made if the
+    array is already contiguous and float32
+    '''
+    return np.ascontiguousarray(arr, dtype=np.float32).reshape(-1)
+
+# default TableInterpolator backend: 'C' (opts_locs.c_interpfile), 
+# 'numpy', or 'auto' (C if the library file exists, NumPy otherwise)
+interp_backend = 'auto'
+# default number of threads for the NumPy TableInterpolator backend
+interp_nthreads = 1
+
+def _gridpos(vals, grid):
+    '''
+    lower grid index and the linear interpolation weight of the upper
+    grid point for each value. Values outside the grid get the edge
+    values, matching the C interpolation function.
+    '''
+    ind = np.searchsorted(grid, vals, side='right') - 1
+    np.clip(ind, 0, len(grid) - 2, out=ind)
+    lo = grid[ind]
+    weight = (vals - lo) / (grid[ind + 1] - lo)
+    np.clip(weight, 0., 1., out=weight)
+    return ind, weight
+
+class TableInterpolator:
+    '''
+    linear interpolation of one or more (temperature, metallicity, 
+    density) tables on the same grid. Values outside the grid are 
+    taken from the grid edges.
+
+    There are two backends: the C interpolation function 
+    (opts_locs.c_interpfile), or trilinear interpolation in NumPy. 
+    The NumPy version works on blocks of particles, which can be 
+    divided over threads, and finds the grid positions and weights of 
+    each particle only once for all the tables.
+
+    The tables and grids are stored as contiguous float32 arrays
+    once, and contiguous float32 particle arrays (and output arrays)
+    are used without copying, so this is cheap to call repeatedly, 
+    e.g., on blocks of particles.
+    '''
+
+    def __init__(self, logTK, logZ, lognHcm3, tables, cfile=None,
+                 backend=None, nthreads=None, blocksize=2**16):
+        '''
+        Parameters:
+        -----------
+        logTK: 1D float array
+            log10 temperature [K] grid
+        logZ: 1D float array
+            log10 metallicity [mass fraction, *not* normalized to solar]
+            grid
+        lognHcm3: 1D float array
+            log10 hydrogen number density [cm**-3] grid
+        tables: list of 3D float arrays
+            the tables to interpolate, shape (temperature, metallicity,
+            density)
+        cfile: str or None
+            the C interpolation library; None means 
+            opts_locs.c_interpfile
+        backend: {'C', 'numpy', 'auto', None}
+            'C': use the C interpolation function
+            'numpy': use NumPy trilinear interpolation
+            'auto': C if the C library file exists, otherwise NumPy
+            None: use the module default (interp_backend)
+        nthreads: int or None
+            number of threads to divide particle blocks over (NumPy
+            backend). None means the module default (interp_nthreads).
+        blocksize: int
+            number of particles to interpolate at once (NumPy backend)
+        '''
+        self.logTK = _float32buffer(logTK)
+        self.logZ = _float32buffer(logZ)
+        self.lognHcm3 = _float32buffer(lognHcm3)
+        self.tableshape = (len(self.logTK), len(self.logZ), 
+                           len(self.lognHcm3))
+        self.tables = []
+        for table in tables:
+            if table.shape != self.tableshape: 
+                msg  = 'Table shape {} did not match expected {}'
+                msg = msg.format(table.shape, self.tableshape)
+                raise ValueError(msg)
+            self.tables.append(_float32buffer(table))
+        if cfile is None:
+            cfile = ol.c_interpfile
+        if backend is None:
+            backend = interp_backend
+        if backend == 'auto':
+            backend = 'C' if os.path.isfile(cfile) else 'numpy'
+        if backend not in ['C', 'numpy']:
+            msg = 'backend should be "C", "numpy", or "auto", not {}'
+            raise ValueError(msg.format(backend))
+        self.backend = backend
+        if self.backend == 'C':
+            self.interpfunction = get_cinterpfunction(cfile)
+        else:
+            self.nthreads = interp_nthreads if nthreads is None \
+                            else nthreads
+            self.blocksize = blocksize
+            # table index offsets of the 8 grid cell corners
+            nZ, nnH = self.tableshape[1:]
+            self.corners = [(dT, dZ, dnH) for dT in (0, 1) 
+                            for dZ in (0, 1) for dnH in (0, 1)]
+            self.offsets = [(dT * nZ + dZ) * nnH + dnH 
+                            for dT, dZ, dnH in self.corners]
+    
+    def __call__(self, logT, logZ, lognH, out=None):
+        '''
+        Parameters:
+        -----------
+        logT, logZ, lognH: 1D float arrays
+            particle log10 temperature [K], metallicity [mass fraction,
+            *not* normalized to solar], and hydrogen number density 
+            [cm**-3]. Contiguous float32 arrays are not copied.
+        out: float32 array or None
+            C-contiguous output array, shape (number of tables, number 
+            of particles)
+
+        Returns:
+        --------
+        out: float32 array, shape (number of tables, number of 
+             particles)
+            the interpolated values for each table
+        '''
+        logT = _float32buffer(logT)
+        logZ = _float32buffer(logZ)
+        lognH = _float32buffer(lognH)
+        NumPart = len(lognH)
+        if len(logT) != NumPart or len(logZ) != NumPart:
+            msg = 'lognH, logZ, and logT  should have the same length'
+            raise ValueError(msg)
+        outshape = (len(self.tables), NumPart)
+        if out is None:
+            out = np.zeros(outshape, dtype=np.float32)
+        else:
+            if out.shape != outshape or out.dtype != np.float32 \
+                    or not out.flags['C_CONTIGUOUS']:
+                msg = ('out should be a C-contiguous float32 array of '
+                       'shape {}, not a {} array of shape {}')
+                msg = msg.format(outshape, out.dtype, out.shape)
+                raise ValueError(msg)
+            out[:] = 0.
+        if self.backend == 'numpy':
+            self._interp_numpy(logT, logZ, lognH, out)
+        else:
+            self._interp_C(logT, logZ, lognH, out)
+        return out
+    
+    def _interp_C(self, logT, logZ, lognH, out):
+        NumPart = len(lognH)
+        msg = ('------------------- C interpolation function output'
+               ' --------------------------\n')
+        print(msg)
+        for ti, table in enumerate(self.tables):
+            res = self.interpfunction(logT, logZ, lognH,
+                                      ct.c_longlong(NumPart),
+                                      table,
+                                      self.logTK,
+                                      ct.c_int(len(self.logTK)), 
+                                      self.logZ,
+                                      ct.c_int(len(self.logZ)), 
+                                      self.lognHcm3,
+                                      ct.c_int(len(self.lognHcm3)),
+                                      out[ti])
+            if res != 0:
+                msg = ('Something has gone wrong in the C function: '
+                       f'output {res}.')
+                raise RuntimeError(msg)
+        msg = ('-------------- C interpolation function output finished'
+               ' ----------------------\n')
+        print(msg)
+    
+    def cornerweights(self, logT, logZ, lognH):
+        '''
+        table indices of the lowest grid cell corner and the 
+        interpolation weights of the 8 cell corners (in the order of 
+        self.offsets) for a set of particles
+        '''
+        iT, wT = _gridpos(logT, self.logTK)
+        iZ, wZ = _gridpos(logZ, self.logZ)
+        inH, wnH = _gridpos(lognH, self.lognHcm3)
+        nZ, nnH = self.tableshape[1:]
+        base = iT * nZ
+        base += iZ
+        base *= nnH
+        base += inH
+        del iT, iZ, inH
+        wTs = (1. - wT, wT)
+        wZs = (1. - wZ, wZ)
+        wnHs = (1. - wnH, wnH)
+        weights = [wTs[dT] * wZs[dZ] * wnHs[dnH] 
+                   for dT, dZ, dnH in self.corners]
+        return base, weights
+    
+    def _interp_block(self, logT, logZ, lognH, out, start, stop):
+        base, weights = self.cornerweights(logT[start: stop], 
+                                           logZ[start: stop], 
+                                           lognH[start: stop])
+        inds = [base + offset for offset in self.offsets]
+        del base
+        res = np.empty(stop - start, dtype=weights[0].dtype)
+        for ti, table in enumerate(self.tables):
+            res[:] = 0.
+            for ind, weight in zip(inds, weights):
+                res += weight * table.take(ind)
+            out[ti, start: stop] = res
+    
+    def _interp_numpy(self, logT, logZ, lognH, out):
+        NumPart = len(lognH)
+        starts = np.arange(0, NumPart, self.blocksize)
+        stops = np.append(starts[1:], NumPart)
+        if self.nthreads <= 1 or len(starts) <= 1:
+            for start, stop in zip(starts, stops):
+                self._interp_block(logT, logZ, lognH, out, start, stop)
+        else:
+            # blocks write to separate parts of out
+            with cf.ThreadPoolExecutor(max_workers=self.nthreads) as ex:
+                futures = [ex.submit(self._interp_block, logT, logZ, 
+                                     lognH, out, start, stop)
+                           for start, stop in zip(starts, stops)]
+                for future in futures:
+                    future.result()
+
 class Linetable_PS20:
     '''
     class for storing data from the Ploeckinger & Schaye (2020) ion
@@ -44,10 +604,11 @@ class Linetable_PS20:
     fraction) should be rescaled to the right metallicity (or better: 
     specific element abundance) after the interpolation step.
     
-    A single instance is for one emission or absorption line. This
-    does mean the table bins and dust table may be stored twice if
-    multiple objects are in use. The instance is also only valid for
-    one redshift.
+    A single instance is for one emission or absorption line. The 
+    instance is also only valid for one redshift. The table bins, 
+    metadata, and (redshift-interpolated) tables are shared between
+    instances (get_ps20_table), so setting up multiple instances for
+    the same ion, line, or element is cheap.
     '''
     
     def parse_ionname(self):
@@ -64,52 +625,19 @@ class Linetable_PS20:
         None.
 
         '''
-        # lines are formatted as in the IdentifierLines dataset
-        if self.emission: 
-            try:
-                self.elementshort = self.ion[:2].strip()
-                self.ionstage = int(self.ion[2:4])
-                msg = ('Interpreting {line} as coming from the '
-                       '{elt} {stage} ion')
-                msg = msg.format(line=self.ion, elt=self.elementshort,
-                                 stage=self.ionstage)
-                print(msg)
-                if self.ion.endswith('A'):
-                    # wavelength in Angstrom
-                    self.wavelength_cm = float(self.ion[4:-1]) * 1e-8
-                else:
-                    msg = 'Could not extract wavelength from line "{}"'
-                    raise ValueError(msg.format(self.ion))
-            except:
-                msg = 'Failed to parse "{}" as an emission line'
-                raise ValueError(msg.format(self.ion))
-        else: # ions are '<elt><stage>....'
-            try:
-                if self.ion == 'hmolssh':
-                    self.elementshort = 'H'
-                    # get a useful error, I hope
-                    self.ionstage = 'invalid index for hmolssh'
-                else:
-                    self.elementshort = ''
-                    self.ionstage = ''
-                    i = 0
-                    while not self.ion[i].isdigit():
-                        i += 1             
-                    self.elementshort = string.capwords(self.ion[:i])
-                    self.elementshort = self.elementshort.strip()
-                    while self.ion[i].isdigit():
-                        self.ionstage = self.ionstage + self.ion[i]
-                        i += 1
-                        if i == len(self.ion):
-                            break
-                    self.ionstage = int(self.ionstage)
-            except:
-                msg = 'Failed to parse "{}" as an ion'
-                raise ValueError(msg.format(self.ion))
+        self.elementshort, self.ionstage, wavelength_cm = \
+            parse_ps20ion(self.ion, emission=self.emission)
+        if self.emission:
+            self.wavelength_cm = wavelength_cm
+            msg = ('Interpreting {line} as coming from the '
+                   '{elt} {stage} ion')
+            msg = msg.format(line=self.ion, elt=self.elementshort,
+                             stage=self.ionstage)
+        else:
             msg = 'Interpreting {ion} as the {elt} {stage} ion'
             msg = msg.format(ion=self.ion, elt=self.elementshort,
                              stage=self.ionstage)
-            print(msg)
+        print(msg)
             
     def getmetadata(self):
         '''
@@ -130,32 +658,31 @@ class Linetable_PS20:
         '''
         self.table_logzero = -50.0
         
-        with h5py.File(self.ionbalfile, 'r') as f:
-            # get element abundances (n_i / n_H) 
-            # for tabulated log Z / Z_solar
-            self.numberfractions_Z_elt = f['TotalAbundances'][:, :]
-            elts = [elt.decode() for elt in f['ElementNamesShort'][:]]
-            if self.elementshort not in elts:
-                msg = 'Data for element {elt} is not available'
-                msg = msg.format(elt=self.elementshort)
-                raise ValueError(msg)
-            self.eltind = np.where([self.elementshort == elt \
-                                    for elt in elts])[0][0]
-            # element number fraction n_i / n_H as a function of 
-            # metallicity in the tables
-            self.numberfraction_Z = np.copy(\
-                self.numberfractions_Z_elt[:, self.eltind])
-            
-            self.element = f['ElementNames'][self.eltind].decode().strip()
-            self.elementmass_u = f['ElementMasses'][self.eltind]
-            
-            # solar Z for scaling
-            self.solarZ = f['SolarMetallicity'][0]
+        md = get_ps20_metadata(self.ionbalfile)
+        # get element abundances (n_i / n_H) 
+        # for tabulated log Z / Z_solar
+        self.numberfractions_Z_elt = md['TotalAbundances']
+        elts = md['ElementNamesShort']
+        if self.elementshort not in elts:
+            msg = 'Data for element {elt} is not available'
+            msg = msg.format(elt=self.elementshort)
+            raise ValueError(msg)
+        self.eltind = elts.index(self.elementshort)
+        # element number fraction n_i / n_H as a function of 
+        # metallicity in the tables
+        self.numberfraction_Z = np.copy(\
+            self.numberfractions_Z_elt[:, self.eltind])
+        
+        self.element = md['ElementNames'][self.eltind]
+        self.elementmass_u = md['ElementMasses'][self.eltind]
+        
+        # solar Z for scaling
+        self.solarZ = md['SolarMetallicity']
     
     def __init__(self, ion, z, emission=False, vol=True,
                  ionbalfile=ol.iontab_sylvia_ssh,
                  emtabfile=ol.emtab_sylvia_ssh,
-                 lintable=False):
+                 lintable=False, usecache=True):
         '''
         Parameters
         ----------
@@ -196,6 +723,12 @@ class Linetable_PS20:
             instead of linearly in log space (e.g., log ion fraction)
             Note that whether log values are returned in controlled
             separately.
+        usecache: bool
+            read redshift-interpolated tables from disk 
+            (opts_locs.dir_ps20tables) if they were stored before, 
+            and store them if not (see get_ps20_table); memory-only
+            if opts_locs does not set dir_ps20tables. Tables are
+            always shared between instances in the same process.
 
         Returns
         -------
@@ -208,6 +741,7 @@ class Linetable_PS20:
         self.emission = emission
         self.vol = vol
         self.lintable = lintable
+        self.usecache = usecache
 
         if self.z < 0.:
             if np.isclose(self.z, 0.):
@@ -258,7 +792,7 @@ class Linetable_PS20:
                            lintable=self.lintable)
         return _str
     
-    def find_ionbal(self, dct_T_Z_nH, log=False):
+    def find_ionbal(self, dct_T_Z_nH, log=False, depletion=False):
         '''
         retrieve the interpolated ion balance values for the input 
         particle density, temperature, and metallicity
@@ -277,22 +811,41 @@ class Linetable_PS20:
                 'lognH': log10 hydrogen number density [cm**-3].
         log: bool
             return log ion balance if True
+        depletion: bool
+            multiply the ion balance by the fraction of the element
+            not depleted onto dust (1 - find_depletion), interpolating
+            both tables in one call
         Returns
         -------
         float array
             ion balances: ion mass / gas phase parent element mass.
+            (with depletion: ion mass / parent element mass)
 
         '''
         if not hasattr(self, 'iontable_T_Z_nH'):
             self.findiontable()
-        
-        res = self.interpolate_3Dtable(dct_T_Z_nH,
-                                       self.iontable_T_Z_nH[:, :, :])
-        if (not self.lintable) and (not log):
-            res = 10**res
-        elif self.lintable and log:
-            res = np.log10(res)
-        return res
+        if not depletion:
+            res = self.interpolate_3Dtable(dct_T_Z_nH, self.iontable_T_Z_nH)
+            if (not self.lintable) and (not log):
+                res = 10**res
+            elif self.lintable and log:
+                res = np.log10(res)
+            return res
+        if not hasattr(self, 'depletiontable_T_Z_nH'):
+            self.finddepletiontable()
+        res = self.interpolate_3Dtables(dct_T_Z_nH, 
+                                        [self.iontable_T_Z_nH,
+                                         self.depletiontable_T_Z_nH])
+        ionbal = res[0]
+        undepleted = res[1]
+        if not self.lintable:
+            np.power(10., ionbal, out=ionbal)
+            np.power(10., undepleted, out=undepleted)
+        np.subtract(1., undepleted, out=undepleted)
+        ionbal *= undepleted
+        if log:
+            np.log10(ionbal, out=ionbal)
+        return ionbal
         
     def find_logemission(self, dct_T_Z_nH):
         '''
@@ -415,147 +968,90 @@ class Linetable_PS20:
                                          eltname=self.element.lower())
             print('Using table {}'.format(tablepath))
             
-        with h5py.File(self.ionbalfile, "r") as tablefile:
-            self.logTK     = tablefile['TableBins/TemperatureBins'][:] 
-            self.lognHcm3  = tablefile['TableBins/DensityBins'][:] 
-            self.logZsol   = tablefile['TableBins/MetallicityBins'][1:]
-            self.redshifts = tablefile['TableBins/RedshiftBins'][:] 
-            
-            if self.z < self.redshifts[0] or self.z > self.redshifts[-1]:
-                msg = ('Desired redshift {z} is outside the tabulated range '
-                       '{zmin} - {zmax}')
-                msg = msg.format(z=self.z, zmin=self.redshifts[0], 
-                                 zmax=self.reshifts[-1])
-                raise ValueError(msg)
-            zi_lo = np.min(np.where(self.z <= self.redshifts)[0])
-            zi_hi = np.max(np.where(self.z >= self.redshifts)[0])            
-            
-            tableg = tablefile[tablepath] #  z, T, Z, nH, ion
-             # 0: Redshift, 1: Temperature, 2: Metallicity, 
-             # 3: Density, 4: Ion
-            if zi_lo == zi_hi:
-                self.iontable_T_Z_nH =\
-                    tableg[zi_lo, :, 1:, :, ionind]
-                if self.lintable:
-                    self.iontable_T_Z_nH  = 10**self.iontable_T_Z_nH 
-            else:
-                msg = ('Linearly interpolating ion balance table '
-                       'values in redshift')
-                print(msg)
-                z_lo = self.redshifts[zi_lo]
-                z_hi = self.redshifts[zi_hi]
-                
-                if self.lintable:
-                    self.iontable_T_Z_nH =\
-                        (z_hi - self.z) / (z_hi - z_lo) * \
-                            10**tableg[zi_lo, :, 1:, :, ionind] + \
-                        (self.z - z_lo) / (z_hi - z_lo) * \
-                            10**tableg[zi_hi, :, 1:, :, ionind]
-                else:
-                    self.iontable_T_Z_nH =\
-                        (z_hi - self.z) / (z_hi - z_lo) * \
-                            tableg[zi_lo, :, 1:, :, ionind] + \
-                        (self.z - z_lo) / (z_hi - z_lo) * \
-                            tableg[zi_hi, :, 1:, :, ionind]
+        self._setbins(self.ionbalfile)
+        self.iontable_T_Z_nH = get_ps20_table(self.ionbalfile, tablepath,
+                                              ionind, self.z, 
+                                              lintable=self.lintable,
+                                              usecache=self.usecache)
+
+    def _setbins(self, tablefile):
+        bins = get_ps20_bins(tablefile)
+        self.logTK = bins['logTK']
+        self.lognHcm3 = bins['lognHcm3']
+        # -50. = primordial
+        self.logZsol = bins['logZsol']
+        self.redshifts = bins['redshifts']
 
     def findemtable(self):
         if self.vol:
             vc = 'Vol'
         else:
             vc = 'Col'
-            
-        with h5py.File(self.emtabfile, 'r') as f:
-            lineid = f['IdentifierLines'][:]
-            lineid = np.array([line.decode() for line in lineid])
-            match = [self.ion == line for line in lineid]
-            li = np.where(match)[0][0]
-            
-            emg = f['Tdep/Emissivities{vc}'.format(vc=vc)] 
-            # 0: Redshift, 1: Temperature, 2: Metallicity, 
-            # 3: Density, 4: Line
-            self.redshifts = f['TableBins/RedshiftBins'][:]
-            self.logTK = f['TableBins/TemperatureBins'][:]
-            self.lognHcm3 = f['TableBins/DensityBins'][:]
-             # -50. = primordial
-            self.logZsol = f['TableBins/MetallicityBins'][1:]
-            
-            zi_lo = np.min(np.where(self.z <= self.redshifts)[0])
-            zi_hi = np.max(np.where(self.z >= self.redshifts)[0])            
-            
-            if self.z < self.redshifts[0] or self.z > self.redshifts[-1]:
-                msg = ('Desired redshift {z} is outside the tabulated range '
-                       '{zmin} - {zmax}')
-                msg = msg.format(z=self.z, zmin=self.redshifts[0], 
-                                 zmax=self.reshifts[-1])
-                raise ValueError(msg) 
-             # 0: Redshift, 1: Temperature, 2: Metallicity, 
-             # 3: Density, 4: Line
-            if zi_lo == zi_hi:
-                self.emtable_T_Z_nH = emg[zi_lo, :, 1:, :, li]
-                if self.lintable:
-                    self.emtable = 10**self.emtable
-            else:
-                z_lo = self.redshifts[zi_lo]
-                z_hi = self.redshifts[zi_hi]
-
-                if self.lintable:
-                    self.emtable_T_Z_nH =\
-                    (z_hi - self.z) / (z_hi - z_lo) *\
-                        10**emg[zi_lo, :, 1:, :, li] + \
-                    (self.z - z_lo) / (z_hi - z_lo) *\
-                        10**emg[zi_hi, :, 1:, :, li]
-                else:
-                    self.emtable_T_Z_nH =\
-                        (z_hi - self.z) / (z_hi - z_lo) *\
-                            emg[zi_lo, :, 1:, :, li] + \
-                        (self.z - z_lo) / (z_hi - z_lo) *\
-                            emg[zi_hi, :, 1:, :, li]
+        li = get_ps20_lineindex(self.ion, emtabfile=self.emtabfile)
+        tablepath = 'Tdep/Emissivities{vc}'.format(vc=vc)
+        self._setbins(self.emtabfile)
+        self.emtable_T_Z_nH = get_ps20_table(self.emtabfile, tablepath,
+                                             li, self.z, 
+                                             lintable=self.lintable,
+                                             usecache=self.usecache)
         
     def finddepletiontable(self):    
-        with h5py.File(self.ionbalfile, 'r') as f:        
-            deplg = f['Tdep/Depletion'] 
-            # z, T, Z, nH, element
-            self.redshifts = f['TableBins/RedshiftBins'][:]
-            self.logTK = f['TableBins/TemperatureBins'][:]
-            self.lognHcm3 = f['TableBins/DensityBins'][:]
-            # -50. = primordial
-            self.logZsol = f['TableBins/MetallicityBins'][1:]
-             
-            zi_lo = np.min(np.where(self.z <= self.redshifts)[0])
-            zi_hi = np.max(np.where(self.z >= self.redshifts)[0])              
-            
-            if self.z < self.redshifts[0] or self.z > self.redshifts[-1]:
-                msg = ('Desired redshift {z} is outside the tabulated range '
-                       '{zmin} - {zmax}')
-                msg = msg.format(z=self.z, zmin=self.redshifts[0], 
-                                 zmax=self.reshifts[-1])
-                raise ValueError(msg) 
-             # 0: Redshift, 1: Temperature, 2: Metallicity, 
-             # 3: Density, 4: element
-            if zi_lo == zi_hi:
-                self.depletiontable_T_Z_nH = \
-                    deplg[zi_lo, :, 1:, :, self.eltind]
-                if self.lintable:
-                    self.depletiontable_T_Z_nH = \
-                        10**self.depletiontable_T_Z_nH
-            else:
-                z_lo = self.redshifts[zi_lo]
-                z_hi = self.redshifts[zi_hi]
-
-                if self.lintable:
-                    self.depletiontable_T_Z_nH =\
-                       (z_hi - self.z) / (z_hi - z_lo) *\
-                            10**deplg[zi_lo, :, 1:, :, self.eltind] + \
-                       (self.z - z_lo) / (z_hi - z_lo) *\
-                            10**deplg[zi_hi, :, 1:, :, self.eltind]
-                else:
-                    self.depletiontable_T_Z_nH =\
-                        (z_hi - self.z) / (z_hi - z_lo) *\
-                            deplg[zi_lo, :, 1:, :, self.eltind] + \
-                        (self.z - z_lo) / (z_hi - z_lo) *\
-                            deplg[zi_hi, :, 1:, :, self.eltind]
-        
+        self._setbins(self.ionbalfile)
+        self.depletiontable_T_Z_nH = get_ps20_table(self.ionbalfile, 
+                                                    'Tdep/Depletion',
+                                                    self.eltind, self.z,
+                                                    lintable=self.lintable,
+                                                    usecache=self.usecache)
         
+    def interpolate_3Dtables(self, dct_logT_logZ_lognH, tables, 
+                             out=None):
+        '''
+        retrieve the values of one or more tables for the input 
+        particle density, temperature, and metallicity
+
+        Parameters
+        ----------
+        dct_logT_logZ_lognH : dict of 1-D float arrays
+            dictionary containing the following arrays describing each 
+            resolution element:
+                'logT': log10 temperature [K]
+                'logZ': log10 metallicity [mass fraction, 
+                                           *not* normalized to solar]
+                'lognH': log10 hydrogen number density [cm**-3].
+            Contiguous float32 arrays are used without copying.
+        tables: list of 3D float arrays
+            the tables to interpolate (e.g., self.iontable_T_Z_nH,
+            self.depletiontable_T_Z_nH)
+        out: float32 array or None
+            C-contiguous output array, shape (len(tables), number of 
+            particles)
+
+        Raises
+        ------
+        ValueError
+            input arrays have different lengths
+            or the input table shapes don't match 
+            logTK, logZsol, lognHcm3.
+
+        Returns
+        -------
+        2D float32 array
+            the interpolated table values, shape (len(tables), number
+            of particles)
+
+        '''
+        for table in tables:
+            if len(table.shape) != 3:
+                msg = ('Interpolation is for 3 dimensional tables only, '
+                       'not shape {}'.format(table.shape))
+                raise ValueError(msg)
+        logZabs = self.logZsol + np.log10(self.solarZ)
+        interp = TableInterpolator(self.logTK, logZabs, self.lognHcm3,
+                                   tables)
+        return interp(dct_logT_logZ_lognH['logT'], 
+                      dct_logT_logZ_lognH['logZ'],
+                      dct_logT_logZ_lognH['lognH'], out=out)
+
     def interpolate_3Dtable(self, dct_logT_logZ_lognH, table):
         '''
         retrieve the table values for the input particle density,
@@ -575,7 +1071,6 @@ class Linetable_PS20:
         ------
         ValueError
             input arrays have different lengths
-            or the requested redshift is outside the tabulated range
             or the input table shape doesn't match 
             logTK, logZsol, lognHcm3.
 
@@ -585,82 +1080,84 @@ class Linetable_PS20:
             the fraction interpolated table values
 
         '''
-        if len(table.shape) != 3:
-            msg = ('Interpolation is for 3 dimensional tables only, '
-                   'not shape {}'.format(table.shape))
-            raise ValueError(msg)
-        
-        expected_tableshape = (len(self.logTK), 
-                               len(self.logZsol), 
-                               len(self.lognHcm3)) 
-        if table.shape != expected_tableshape: 
-            msg  = 'Table shape {} did not match expected {}'
-            msg = msg.format(table.shape, expected_tableshape)
-            raise ValueError(msg)
-            
-        logT  = dct_logT_logZ_lognH['logT']
-        logZ  = dct_logT_logZ_lognH['logZ']
-        lognH = dct_logT_logZ_lognH['lognH']
-        
-        NumPart = len(lognH)
-        inbalance = np.zeros(NumPart, dtype=np.float32)    
-        if len(logT) != NumPart or len(logZ) != NumPart:
-            msg = 'lognH, logZ, and logT  should have the same length'
-            raise ValueError(msg)
-    
-        # need to compile with some extra options to get this to work:
-        # make -f make_emission_only
-        msg = ('------------------- C interpolation function output'
-               ' --------------------------\n')
-        print(msg)
-        cfile = ol.c_interpfile
-    
-        acfile = ct.CDLL(cfile)
-        interpfunction = acfile.interpolate_3d 
-        # just a linear interpolator; works for non-emission stuff too
-        # retrieved ion balance tables are T x Z x nH
-    
-        type_partarray = np.ctypeslib.ndpointer(dtype=ct.c_float, 
-                                                shape=(NumPart,))
-        tablesize = np.prod(table.shape)
-        type_table = np.ctypeslib.ndpointer(dtype=ct.c_float,
-                                            shape=(tablesize,))
-        
-        interpfunction.argtypes = [type_partarray,
-                                   type_partarray,
-                                   type_partarray,
-                                   ct.c_longlong, 
-                                   type_table,
-                                   np.ctypeslib.ndpointer(dtype=ct.c_float,
-                                       shape=self.logTK.shape),
-                                   ct.c_int,
-                                   np.ctypeslib.ndpointer(dtype=ct.c_float,
-                                       shape=self.logZsol.shape),
-                                   ct.c_int,
-                                   np.ctypeslib.ndpointer(dtype=ct.c_float,
-                                       shape=self.lognHcm3.shape), 
-                                   ct.c_int,
-                                   type_partarray]
-    
-        logZabs = self.logZsol + np.log10(self.solarZ)
-        res = interpfunction(logT.astype(np.float32),
-                             logZ.astype(np.float32),
-                             lognH.astype(np.float32),
-                             ct.c_longlong(NumPart),
-                             np.ndarray.flatten(table.astype(np.float32)),
-                             self.logTK.astype(np.float32),
-                             ct.c_int(len(self.logTK)), 
-                             logZabs.astype(np.float32),
-                             ct.c_int(len(logZabs)), 
-                             self.lognHcm3.astype(np.float32),
-                             ct.c_int(len(self.lognHcm3)),
-                             inbalance,
-                             )
-        msg = ('-------------- C interpolation function output finished'
-               ' ----------------------\n')
-        print(msg)
-    
-        if res != 0:
-            msg = f'Something has gone wrong in the C function: output {res}.'
-            raise RuntimeError(msg)    
-        return inbalance
+        return self.interpolate_3Dtables(dct_logT_logZ_lognH, [table])[0]
+
+def find_ionbals(ions, z, dct_T_Z_nH, log=False, depletion=False,
+                 lintable=False, ionbalfile=ol.iontab_sylvia_ssh,
+                 usecache=True, backend=None, nthreads=None):
+    '''
+    retrieve the interpolated ion balance values for multiple ions
+    and the same particles. The tables for all the ions (and the dust
+    depletion of their parent elements) are interpolated together.
+    Only the NumPy backend calculates the grid positions and 
+    interpolation weights once for all the tables; with the C backend,
+    each table is interpolated separately, so the cost is still about
+    (number of tables) times that of one ion.
+
+    Parameters
+    ----------
+    ions: list of str
+        the ions (see Linetable_PS20)
+    z: float
+        redshift
+    dct_T_Z_nH : dict of 1-D float arrays
+        dictionary containing the following arrays describing each
+        resolution element:
+            'logT': log10 temperature [K]
+            'logZ': log10 metallicity [mass fraction, 
+                                       *not* normalized to solar]
+            'lognH': log10 hydrogen number density [cm**-3].
+    log: bool
+        return log ion balances if True
+    depletion: bool
+        multiply the ion balances by the fraction of the parent element
+        not depleted onto dust
+    lintable, ionbalfile, usecache:
+        see Linetable_PS20
+    backend, nthreads:
+        see TableInterpolator. The default (None) uses the module 
+        interp_backend setting.
+
+    Returns
+    -------
+    dict of float32 arrays
+        ion: ion balance (ion mass / gas phase parent element mass, or
+        parent element mass with depletion). The arrays are views of 
+        one (number of tables, number of particles) array.
+    '''
+    iontabs = [Linetable_PS20(ion, z, emission=False, vol=True,
+                              ionbalfile=ionbalfile, lintable=lintable,
+                              usecache=usecache)
+               for ion in ions]
+    tables = []
+    for iontab in iontabs:
+        iontab.findiontable()
+        tables.append(iontab.iontable_T_Z_nH)
+    # one depletion table per parent element
+    depltableinds = {}
+    if depletion:
+        for iontab in iontabs:
+            if iontab.element in depltableinds:
+                continue
+            iontab.finddepletiontable()
+            depltableinds[iontab.element] = len(tables)
+            tables.append(iontab.depletiontable_T_Z_nH)
+    iontab = iontabs[0]
+    logZabs = iontab.logZsol + np.log10(iontab.solarZ)
+    interp = TableInterpolator(iontab.logTK, logZabs, iontab.lognHcm3,
+                               tables, backend=backend, nthreads=nthreads)
+    res = interp(dct_T_Z_nH['logT'], dct_T_Z_nH['logZ'], 
+                 dct_T_Z_nH['lognH'])
+    if not lintable:
+        np.power(10., res, out=res)
+    for ind in depltableinds.values():
+        np.subtract(1., res[ind], out=res[ind])
+    out = {}
+    for ti, iontab in enumerate(iontabs):
+        ionbal = res[ti]
+        if depletion:
+            ionbal *= res[depltableinds[iontab.element]]
+        if log:
+            np.log10(ionbal, out=ionbal)
+        out[iontab.ion] = ionbal
+    return out
@@ -60,20 +60,7 @@ class CoordinateWranger:
                 self.filter = filterdct['filter']
     
     def __check_rotmatrix(self):
-        if self.rotmatrix is not None:
-            if self.rotmatrix.shape != (3, 3):
-                msg = ('Rotation matrix should have shape (3, 3) not input'
-                       f'{self.rotmatrix.shape} for matrix\n{self.rotmatrix}')
-                raise ValueError(msg)
-            if not (np.allclose(np.matmul(self.rotmatrix.T, self.rotmatrix),
-                                np.diag(np.ones((3,)))) 
-                    and np.isclose(np.linalg.det(self.rotmatrix), 1.)):
-                msg = ('input was not a valid rotation matrix.\n'
-                       'transpose (should be inverse):\n'
-                       f'{self.rotmatrix.T}, {self.rotmatrix}\n'
-                       'determinant (should be 1.): '
-                       f'{np.linalg.det(self.rotmatrix)}')
-                raise ValueError(msg)
+        check_rotmatrix(self.rotmatrix)
         
     def __startcalc_pos(self, subindex=None):
         '''
@@ -89,8 +76,9 @@ class CoordinateWranger:
         self.sel = (self.filter, slice(None, None, None)) \
                    if self._subindex is None else \
                    self.filter
-        self.coords_simxyz = self.snapobj.readarray(
-            h5path, subindex=self._subindex)[self.sel]
+        # centered in place; cached snapshot arrays are read-only
+        self.coords_simxyz = np.require(self.snapobj.readarray(
+            h5path, subindex=self._subindex)[self.sel], requirements='W')
         del self.sel
         self.toCGS_coords_simxyz = self.snapobj.toCGS
         self.__center_pos()
@@ -120,8 +108,8 @@ class CoordinateWranger:
         self.sel = (self.filter, slice(None, None, None)) \
               if self._subindex is None else \
               self.filter
-        self.vel_simxyz = self.snapobj.readarray(
-            h5path, subindex=self._subindex)[self.sel]
+        self.vel_simxyz = np.require(self.snapobj.readarray(
+            h5path, subindex=self._subindex)[self.sel], requirements='W')
         del self.sel
         self.toCGS_vel_simxyz = self.snapobj.toCGS
         self.__center_vel()
@@ -140,15 +128,16 @@ class CoordinateWranger:
     def __rotate_pos(self):
         self.rotmatrix = np.asarray(self.rotmatrix, 
                                     dtype=self.coords_simxyz.dtype)
-        self.coords_rotxyz = np.einsum('kj,ij->ik', self.rotmatrix,
-                                       self.coords_simxyz)
+        # in place: no rotated copy of the coordinate array
+        self.coords_rotxyz = center_rotate_inplace(self.coords_simxyz, 
+                                                   None, self.rotmatrix)
         self.toCGS_coords_rotxyz = self.toCGS_coords_simxyz
     
     def __rotate_vel(self):
         self.rotmatrix = np.asarray(self.rotmatrix, 
                                     dtype=self.vel_simxyz.dtype)
-        self.vel_rotxyz = np.einsum('kj,ij->ik', self.rotmatrix, 
-                                    self.vel_simxyz)
+        self.vel_rotxyz = center_rotate_inplace(self.vel_simxyz, None,
+                                                self.rotmatrix)
         self.toCGS_vel_rotxyz = self.toCGS_vel_simxyz
     
     def __center_pos(self):
@@ -630,4 +619,113 @@ def rotmatrix_from_zdir(newzdir):
         ynew = ynew / np.sqrt(np.sum(ynew**2))
         xnew = np.cross(ynew, znew)
     rotmat = np.array([xnew, ynew, znew])
-    return rotmat
\ No newline at end of file
+    return rotmat
+
+def check_rotmatrix(rotmatrix):
+    '''
+    raise a ValueError if rotmatrix is not None or a valid rotation 
+    matrix (shape (3, 3), orthonormal, determinant 1)
+    '''
+    if rotmatrix is not None:
+        if rotmatrix.shape != (3, 3):
+            msg = ('Rotation matrix should have shape (3, 3) not input'
+                   f'{rotmatrix.shape} for matrix\n{rotmatrix}')
+            raise ValueError(msg)
+        if not (np.allclose(np.matmul(rotmatrix.T, rotmatrix),
+                            np.diag(np.ones((3,)))) 
+                and np.isclose(np.linalg.det(rotmatrix), 1.)):
+            msg = ('input was not a valid rotation matrix.\n'
+                   'transpose (should be inverse):\n'
+                   f'{rotmatrix.T}, {rotmatrix}\n'
+                   'determinant (should be 1.): '
+                   f'{np.linalg.det(rotmatrix)}')
+            raise ValueError(msg)
+
+def boxexcess(coords, boxhalfsize, out=None):
+    '''
+    for (centered) coordinates coords (shape (N, 3)), get the largest 
+    distance outside the box with half-sizes boxhalfsize (length 3) 
+    along any axis: max_i(|coords_i| - boxhalfsize_i). Values <= 0 
+    are inside the box, and particles with values <= margin are 
+    within margin of the box along each axis. Result dtype matches
+    coords.
+    '''
+    boxhalfsize = np.asarray(boxhalfsize, dtype=coords.dtype)
+    if out is None:
+        out = np.empty(len(coords), dtype=coords.dtype)
+    np.abs(coords[:, 0], out=out)
+    out -= boxhalfsize[0]
+    _temp = np.empty(len(coords), dtype=coords.dtype)
+    for i in [1, 2]:
+        np.abs(coords[:, i], out=_temp)
+        _temp -= boxhalfsize[i]
+        np.maximum(out, _temp, out=out)
+    return out
+
+def center_rotate_inplace(arr, center, rotmatrix=None, boxhalfsize=None, 
+                          blocksize=2**18):
+    '''
+    center and rotate coordinates or velocities in place, in blocks of
+    particles, so that no full-size temporary arrays are needed. 
+    Rotation matches CoordinateWranger: the output is 
+    matmul(rotmatrix, (arr - center)) for each particle.
+
+    Parameters:
+    -----------
+    arr: float array, shape (N, 3)
+        the coordinates or velocities; modified in place. 
+        Calculations are done in the same float type (e.g., float32). 
+    center: float array, shape (3,), or None
+        subtracted from arr (same units), before the rotation. None 
+        means no centering.
+    rotmatrix: float array, shape (3, 3), or None
+        rotation matrix. None means no rotation.
+    boxhalfsize: float array, shape (3,), or None
+        if not None, also calculate boxexcess in the rotated frame 
+        for these box half-sizes (arr units) in the same pass
+    blocksize: int
+        number of particles to process at a time
+
+    Returns:
+    --------
+    arr (boxhalfsize is None) or 
+    boxexcess (float array, shape (N,), same dtype as arr; 
+    boxhalfsize is not None)
+    '''
+    if center is not None:
+        center = np.asarray(center, dtype=arr.dtype)
+    if rotmatrix is not None:
+        rotT = np.asarray(rotmatrix, dtype=arr.dtype).T
+        buf = np.empty((min(blocksize, len(arr)), 3), dtype=arr.dtype)
+    if boxhalfsize is not None:
+        excess = np.empty(len(arr), dtype=arr.dtype)
+    for start in range(0, len(arr), blocksize):
+        block = arr[start: start + blocksize]
+        if center is not None:
+            block -= center
+        if rotmatrix is not None:
+            _buf = buf[:len(block)]
+            np.matmul(block, rotT, out=_buf)
+            block[:] = _buf
+        if boxhalfsize is not None:
+            boxexcess(block, boxhalfsize, 
+                      out=excess[start: start + len(block)])
+    if boxhalfsize is not None:
+        return excess
+    return arr
+
+def compress_inplace(arr, sel, blocksize=2**18):
+    '''
+    equivalent to arr[sel] for a boolean array sel (along the first 
+    axis), but the selected elements are moved to the start of arr, 
+    in blocks, instead of copied to a new array. Returns a view of 
+    the first sum(sel) elements of arr.
+    '''
+    nout = 0
+    for start in range(0, len(arr), blocksize):
+        _sel = sel[start: start + blocksize]
+        # copy of the selected part of the block
+        _vals = arr[start: start + blocksize][_sel]
+        arr[nout: nout + len(_vals)] = _vals
+        nout += len(_vals)
+    return arr[:nout]
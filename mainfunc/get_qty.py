@@ -4,13 +4,219 @@ import numpy as np
 import string
 import numbers as num
 
-from fire_an.ionrad.ion_utils import Linetable_PS20, atomw_u_dct, elt_atomw_cgs
+from fire_an.ionrad.ion_utils import Linetable_PS20, atomw_u_dct, \
+    elt_atomw_cgs, find_ionbals, get_ps20_element
 import fire_an.mainfunc.coords as coords
 import fire_an.mainfunc.haloprop as hp
+import fire_an.readfire.gasstate as gs
 import fire_an.utils.constants_and_units as c
 import fire_an.utils.opts_locs as ol
 
 
+def _log10_inplace(arr):
+    '''
+    log10 of a floating-point array, overwriting the input array
+    '''
+    if arr.dtype.kind == 'f':
+        return np.log10(arr, out=arr)
+    return np.log10(arr)
+
+def read_eltmassfs(snap, parttype, elements, filter):
+    '''
+    read in the mass fractions of several elements. These are read in
+    from the snapshot in one pass over the metallicity data if the
+    snapshot reader supports it.
+
+    Parameters:
+    -----------
+    snap: snapshot reader obect
+        exact class depends on the simulation
+    parttype: int
+        particle type
+    elements: list of str
+        element names (e.g., 'Oxygen', 'Hydrogen'), or 'total' for the
+        total metal mass fraction
+    filter: bool array or slice
+        which resolution elements to return
+
+    Returns:
+    --------
+    eltmassfs: dict
+        element name: mass fraction array
+    toCGS: float
+        factor to convert the mass fractions to CGS units
+    '''
+    if hasattr(snap, 'readarray_elements'):
+        _eltmassfs = snap.readarray_elements(parttype, elements)
+        toCGS = snap.toCGS
+        # arrays from the readarray cache are read-only
+        eltmassfs = {elt: np.require(_eltmassfs[elt][filter], 
+                                     requirements='W') 
+                     for elt in elements}
+        del _eltmassfs
+    else:
+        basepath = 'PartType{}/'.format(parttype)
+        eltmassfs = {}
+        for elt in elements:
+            if elt == 'total':
+                eltpath = basepath + 'Metallicity'
+            else:
+                eltpath = basepath + 'ElementAbundance/' + elt
+            eltmassfs[elt] = np.require(
+                snap.readarray_emulateEAGLE(eltpath)[filter], 
+                requirements='W')
+            toCGS = snap.toCGS
+    return eltmassfs, toCGS
+
+def get_ionfrac_inputs(snap, indct=None, table='PS20', simtype='fire',
+                       usegasstate=True):
+    '''
+    Get the gas properties the ion fractions are interpolated in: 
+    temperature, hydrogen number density, and (depending on the table)
+    metallicity. Calculating these once allows them to be reused for
+    different ions (through the get_ionfrac indct).
+
+    Parameters:
+    -----------
+    snap, indct, table, simtype:
+        see get_ionfrac. Entries already present in indct are used
+        instead of being recalculated.
+    usegasstate: bool
+        read the properties from the snapshot's gas state file 
+        (see make_gasstate), if there is one that matches the 
+        snapshot. lognH is only read from the file if indct does not 
+        contain 'hmassf'.
+
+    Returns:
+    --------
+    interpdct: dict
+        'logT', 'lognH', and for table 'PS20', 'logZ' arrays (see 
+        get_ionfrac indct)
+    '''
+    if simtype == 'fire':
+        readfunc = snap.readarray_emulateEAGLE
+        prepath = 'PartType0/'
+    else:
+        raise ValueError('invalid simtype option: {}'.format(simtype))
+    if table not in ['PS20']:
+        raise ValueError('invalid table option: {}'.format(table))
+    
+    if indct is None:
+        indct = {}
+    if 'filter' in indct: # gas selection, e.g. a spatial region
+        filter = indct['filter']
+    else:
+        filter = slice(None, None, None)
+    if usegasstate and simtype == 'fire':
+        indct = _add_gasstate(snap, indct, filter)
+    # conversions and logarithms are done in place on the (copied) 
+    # read-in arrays, to avoid full-size temporary arrays and keep the
+    # snapshot read-in precision
+    if 'logT' in indct: # should be in [log10 K]
+        logT = indct['logT']
+    else:
+        logT = _log10_inplace(np.require(
+            readfunc(prepath + 'Temperature')[filter], requirements='W'))
+        tocgs = snap.toCGS
+        if not np.isclose(tocgs, 1.):
+            logT += np.log10(tocgs)
+    # read hydrogen and metal mass fractions in one pass if both are 
+    # needed
+    eltsneeded = []
+    if 'lognH' not in indct and 'hmassf' not in indct:
+        eltsneeded.append('Hydrogen')
+    if table in ['PS20'] and 'logZ' not in indct:
+        eltsneeded.append('total')
+    if len(eltsneeded) > 0:
+        eltmassfs, eltmassf_tocgs = read_eltmassfs(snap, 0, eltsneeded, 
+                                                   filter)
+    if 'lognH' in indct: # should be in log10 cm**-3
+        lognH = indct['lognH']
+    else:
+        hdens = np.require(readfunc(prepath + 'Density')[filter],
+                           requirements='W')
+        d_tocgs = snap.toCGS
+        if 'hmassf' in indct:
+            hmassfrac = indct['hmassf']
+            hmassfrac_tocgs = 1.
+        else:
+            hmassfrac = eltmassfs['Hydrogen']
+            hmassfrac_tocgs = eltmassf_tocgs
+        hdens *= hmassfrac 
+        hdens *= float(d_tocgs * hmassfrac_tocgs / (c.atomw_H * c.u))
+        del hmassfrac
+        lognH = _log10_inplace(hdens)
+        del hdens
+    if table in ['PS20']:
+        if 'logZ' in indct: # no solar normalization, 
+            #just straight mass fraction
+            logZ = indct['logZ']
+        else:
+            logZ = _log10_inplace(eltmassfs['total'])
+            if not np.isclose(eltmassf_tocgs, 1.):
+                logZ += np.log10(eltmassf_tocgs)
+        # Inputting logZ values of -np.inf (zero metallicity, does 
+        # happen) leads to NaN ion fractions in interpolation.
+        # Since the closest edge of the tabulated values is used anyway
+        # it's safe to substute a tiny value like -100.
+        if np.any(logZ == -np.inf):
+            logZ = logZ.copy()
+            logZ[logZ == -np.inf] = -100.
+    if len(eltsneeded) > 0:
+        del eltmassfs
+    interpdct = {'logT': logT, 'lognH': lognH}
+    if table in ['PS20']:
+        interpdct['logZ'] = logZ
+    return interpdct
+
+def _add_gasstate(snap, indct, filter):
+    '''
+    add the ion fraction inputs missing from indct from the gas state 
+    file, if there is a valid one. Returns a new dict.
+    '''
+    fields = [field for field in gs.gasstate_fields 
+              if field not in indct]
+    if 'hmassf' in indct and 'lognH' in fields:
+        fields.remove('lognH')
+    if len(fields) == 0:
+        return indct
+    stored = gs.read_gasstate(snap, fields, filter=filter)
+    if stored is None:
+        return indct
+    indct = indct.copy()
+    indct.update(stored)
+    return indct
+
+def make_gasstate(snap, outfilen=None, overwrite=False):
+    '''
+    calculate the ion fraction inputs (log temperature, hydrogen 
+    number density, and metallicity) for all gas particles in a 
+    snapshot, and store them in a gas state file 
+    (readfire.gasstate). get_ionfrac_inputs then reads them from this
+    file instead of recalculating them, for as long as the snapshot
+    files are unchanged.
+
+    Parameters:
+    -----------
+    snap: Firesnap object
+        the snapshot
+    outfilen: str or None
+        the file to write to. None means the default gas state file
+        (readfire.gasstate.gasstate_filen), which is the file that
+        get_ionfrac_inputs looks for.
+    overwrite: bool
+        overwrite an existing file
+
+    Returns:
+    --------
+    outfilen: str
+        the name of the gas state file
+    '''
+    interpdct = get_ionfrac_inputs(snap, indct=None, table='PS20', 
+                                   simtype='fire', usegasstate=False)
+    return gs.write_gasstate(snap, interpdct, outfilen=outfilen,
+                             overwrite=overwrite)
+
 # tested -> seems to work
 # dust on/off, redshifts 1.0, 2.8, Z=0.01, 0.0001
 # compared FIRE interpolation to neighboring table values
@@ -40,6 +246,8 @@ def get_ionfrac(snap, ion, indct=None, table='PS20', simtype='fire',
         'lognH': hydrogen number density in log10 particles / cm**3
         'logZ': metal mass fraction in log10 fraction of total mass (no 
                 solar scaling)
+        'hmassf': hydrogen mass fraction (no solar scaling); only used
+                if 'lognH' is not present
     table: {'PS20'}
         Which ionization tables to use.
     simtype: {'fire'}
@@ -57,62 +265,17 @@ def get_ionfrac(snap, ion, indct=None, table='PS20', simtype='fire',
         desired ion
     '''
     if simtype == 'fire':
-        readfunc = snap.readarray_emulateEAGLE
-        prepath = 'PartType0/'
         redshift = snap.cosmopars.z
     else:
         raise ValueError('invalid simtype option: {}'.format(simtype))
-    
-    if indct is None:
-        indct = {}
-    if 'filter' in indct: # gas selection, e.g. a spatial region
-        filter = indct['filter']
-    else:
-        filter = slice(None, None, None)
-    if 'logT' in indct: # should be in [log10 K]
-        logT = indct['logT']
-    else:
-        logT = np.log10(readfunc(prepath + 'Temperature')[filter])
-        tocgs = snap.toCGS
-        if not np.isclose(tocgs, 1.):
-            logT += np.log10(tocgs)
-    if 'lognH' in indct: # should be in log10 cm**-3
-        lognH = indct['lognH']
-    else:
-        hdens = readfunc(prepath + 'Density')[filter]
-        d_tocgs = snap.toCGS
-        hmassfrac = readfunc(prepath + 'ElementAbundance/Hydrogen')[filter]
-        hmassfrac_tocgs = snap.toCGS
-        hdens *= hmassfrac 
-        hdens *= d_tocgs * hmassfrac_tocgs / (c.atomw_H * c.u)
-        del hmassfrac
-        lognH = np.log10(hdens)
-        del hdens
-    if table in ['PS20']:
-        if 'logZ' in indct: # no solar normalization, 
-            #just straight mass fraction
-            logZ = indct['logZ']
-        else:
-            logZ = readfunc(prepath + 'Metallicity')[filter]    
-            logZ = np.log10(logZ)
-            tocgs = snap.toCGS
-            if not np.isclose(tocgs, 1.):
-                logZ += np.log10(tocgs)
-        # Inputting logZ values of -np.inf (zero metallicity, does 
-        # happen) leads to NaN ion fractions in interpolation.
-        # Since the closest edge of the tabulated values is used anyway
-        # it's safe to substute a tiny value like -100.
-        if np.any(logZ == -np.inf):
-            logZ = logZ.copy()
-            logZ[logZ == -np.inf] = -100.
+    interpdct = get_ionfrac_inputs(snap, indct=indct, table=table, 
+                                   simtype=simtype)
     if table == 'PS20':
-        interpdct = {'logT': logT, 'lognH': lognH, 'logZ': logZ}
         iontab = Linetable_PS20(ion, redshift, emission=False, vol=True,
                  ionbalfile=ol.iontab_sylvia_ssh, 
                  emtabfile=ol.emtab_sylvia_ssh, lintable=lintable)
-        ionfrac = iontab.find_ionbal(interpdct, log=False)
-        if ps20depletion:
-            ionfrac *= (1. - iontab.find_depletion(interpdct))
+        ionfrac = iontab.find_ionbal(interpdct, log=False, 
+                                     depletion=ps20depletion)
     else:
         raise ValueError('invalid table option: {}'.format(table))
     ## debug map NaN values
@@ -135,6 +298,49 @@ def get_ionfrac(snap, ion, indct=None, table='PS20', simtype='fire',
     #    print('lintable: ', lintable)
     return ionfrac
 
+def get_ionfracs(snap, ions, indct=None, table='PS20', simtype='fire',
+                 ps20depletion=True, lintable=True, backend=None):
+    '''
+    Get the fractions of elements in given ionization states for the 
+    same gas particles: like get_ionfrac, but for multiple ions at 
+    once. The gas properties are only calculated once, and the ion 
+    balance tables are interpolated together. Only the NumPy 
+    interpolation backend calculates grid positions and weights once
+    per particle for all tables; with the C backend, the cost is 
+    still about (number of ions) times that of get_ionfrac.
+
+    Parameters:
+    -----------
+    snap, indct, table, simtype, ps20depletion, lintable:
+        see get_ionfrac
+    ions: list of str
+        the ions to get the fractions of. Format e.g. 'o6', 'fe17'
+    backend: {'numpy', 'C', 'auto', None}
+        interpolation backend; see ion_utils.TableInterpolator. The
+        default (None) uses the ion_utils.interp_backend setting.
+
+    Returns:
+    --------
+    dict of float arrays:
+        ion: the fraction of the parent element nuclei that are a part
+        of the ion
+    '''
+    if simtype == 'fire':
+        redshift = snap.cosmopars.z
+    else:
+        raise ValueError('invalid simtype option: {}'.format(simtype))
+    interpdct = get_ionfrac_inputs(snap, indct=indct, table=table, 
+                                   simtype=simtype)
+    if table == 'PS20':
+        ionfracs = find_ionbals(ions, redshift, interpdct, log=False,
+                                depletion=ps20depletion, 
+                                lintable=lintable, 
+                                ionbalfile=ol.iontab_sylvia_ssh,
+                                backend=backend)
+    else:
+        raise ValueError('invalid table option: {}'.format(table))
+    return ionfracs
+
 # untested, including lintable option and consistency with table values
 # do a test like test_ionbal_calc before using
 # (note that element abundance rescaling and volume multiplication will
@@ -222,7 +428,8 @@ def get_loglinelum(snap, line, indct=None, table='PS20', simtype='fire',
     if 'lognH' in indct: # should be in log10 cm**-3
         lognH = indct['lognH']
     else:
-        hdens = readfunc(prepath + 'Density')[filter]
+        hdens = np.require(readfunc(prepath + 'Density')[filter],
+                           requirements='W')
         d_tocgs = snap.toCGS
         hdens *= hmassf
         hdens *= d_tocgs * hmassf_tocgs / (c.atomw_H * c.u)
@@ -421,7 +628,9 @@ def get_qty(snap, parttype, maptype, maptype_args, filterdct=None):
         toCGS = snap.toCGS
         todoc['units'] = 'g'
     elif maptype == 'Volume':
-        qty = snap.readarray_emulateEAGLE(basepath + 'Masses')[filter]
+        qty = np.require(
+            snap.readarray_emulateEAGLE(basepath + 'Masses')[filter],
+            requirements='W')
         toCGS = snap.toCGS
         qty /= snap.readarray_emulateEAGLE(basepath + 'Density')[filter]
         toCGS = toCGS / snap.toCGS
@@ -429,16 +638,15 @@ def get_qty(snap, parttype, maptype, maptype_args, filterdct=None):
         todoc['method'] = 'Masses / Density'
     elif maptype == 'Metal':
         element = maptype_args['element']
-        if element == 'total':
-            eltpath = basepath + 'Metallicity'
-        else:
-            eltpath = basepath + 'ElementAbundance/' + string.capwords(element)
+        if element != 'total':
+            element = string.capwords(element)
         if 'density' in maptype_args:
             output_density = maptype_args['density']
         else:
             output_density = False
-        qty = snap.readarray_emulateEAGLE(eltpath)[filter]
-        toCGS = snap.toCGS
+        eltmassfs, toCGS = read_eltmassfs(snap, parttype, [element], filter)
+        qty = eltmassfs[element]
+        del eltmassfs
         if output_density:
             qty *= snap.readarray_emulateEAGLE(basepath + 'Density')[filter]
         else:
@@ -479,14 +687,44 @@ def get_qty(snap, parttype, maptype, maptype_args, filterdct=None):
                 lintable = maptype_args['lintable']
             else:
                 lintable = True
-            # no tables read in here, just an easy way to get parent 
-            # element etc.
-            dummytab = Linetable_PS20(ion, snap.cosmopars.z, emission=False,
-                                      vol=True, lintable=lintable)
-            element = dummytab.element
-            eltpath = basepath + 'ElementAbundance/' + string.capwords(element)
-            qty = snap.readarray_emulateEAGLE(eltpath)[filter]
-            toCGS = snap.toCGS
+            # parent element from the table metadata; no tables read in
+            element, elementmass_u = get_ps20_element(ion)
+            element = string.capwords(element)
+            # parent element, hydrogen, and metallicity (for the ion
+            # fractions) from one pass over the metallicity data.
+            # Hydrogen and metallicity are not needed if the gas 
+            # properties are stored (make_gasstate).
+            ionindct = {} if filterdct is None else filterdct.copy()
+            ionindct = _add_gasstate(snap, ionindct, filter)
+            elements = [element]
+            if 'lognH' not in ionindct and 'hmassf' not in ionindct:
+                if element != 'Hydrogen':
+                    elements.append('Hydrogen')
+                getH = True
+            else:
+                getH = False
+            getZ = 'logZ' not in ionindct
+            if getZ:
+                elements.append('total')
+            eltmassfs, eltmassf_tocgs = read_eltmassfs(snap, parttype, 
+                                                       elements, filter)
+            if getH:
+                if element == 'Hydrogen':
+                    # qty is modified in place below
+                    hmassf = eltmassfs['Hydrogen'].copy()
+                else:
+                    hmassf = eltmassfs['Hydrogen']
+                if not np.isclose(eltmassf_tocgs, 1.):
+                    hmassf *= float(eltmassf_tocgs)
+                ionindct['hmassf'] = hmassf
+                del hmassf
+            if getZ:
+                ionindct['logZ'] = _log10_inplace(eltmassfs['total'])
+                if not np.isclose(eltmassf_tocgs, 1.):
+                    ionindct['logZ'] += np.log10(eltmassf_tocgs)
+            qty = eltmassfs[element]
+            toCGS = eltmassf_tocgs
+            del eltmassfs
             if output_density:
                 dpath = basepath + 'Density'
                 qty *= snap.readarray_emulateEAGLE(dpath)[filter]
@@ -494,19 +732,20 @@ def get_qty(snap, parttype, maptype, maptype_args, filterdct=None):
                 mpath = basepath + 'Masses'
                 qty *= snap.readarray_emulateEAGLE(mpath)[filter]
             toCGS =  toCGS * snap.toCGS
-            ionfrac = get_ionfrac(snap, ion, indct=filterdct, 
+            ionfrac = get_ionfrac(snap, ion, indct=ionindct, 
                                   table=ionfrac_method, 
                                   simtype=simtype, ps20depletion=ps20depletion,
                                   lintable=lintable)
             qty *= ionfrac
-            toCGS = toCGS / (dummytab.elementmass_u * c.u)
-            todoc['table'] = dummytab.ionbalfile
+            toCGS = toCGS / (elementmass_u * c.u)
+            todoc['table'] = ol.iontab_sylvia_ssh
             todoc['tableformat'] = ionfrac_method
             todoc['units'] = '(# ions)'
         if ionfrac_method == 'sim':
             if simtype == 'fire' and ion == 'H1':
                 eltpath = basepath + 'ElementAbundance/Hydrogen'
-                qty = snap.readarray_emulateEAGLE(eltpath)[filter]
+                qty = np.require(snap.readarray_emulateEAGLE(eltpath)[filter],
+                                 requirements='W')
                 toCGS = snap.toCGS
                 if output_density:
                     dpath = basepath + 'Density'
@@ -519,10 +758,8 @@ def get_qty(snap, parttype, maptype, maptype_args, filterdct=None):
                 qty *= snap.readarray_emulateEAGLE(hfpath)[filter]
                 toCGS = toCGS * snap.toCGS
                 # just for the element mass
-                dummytab = Linetable_PS20(ion, snap.cosmopars.z, 
-                                          emission=False,
-                                          vol=True, lintable=True)
-                toCGS = toCGS / (dummytab.elementmass_u * c.u)
+                elementmass_u = get_ps20_element(ion)[1]
+                toCGS = toCGS / (elementmass_u * c.u)
                 todoc['info'] = ('neutral H fraction from simulation'
                                  ' NeutralHydrogenAbundance')
                 todoc['units'] = '(# ions)'
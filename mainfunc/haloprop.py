@@ -55,8 +55,11 @@ def calchalocen(coordsmassesdict, shrinkfrac=0.025, minparticles=1000,
     '''
     coords = coordsmassesdict['coords']
     masses = coordsmassesdict['masses']
-    totmass = np.sum(masses)
-    com = np.sum(coords * masses[:, np.newaxis], axis=0) / totmass
+    # sums are accumulated in float64 (float32 input is not upcast as
+    # a whole)
+    totmass = np.sum(masses, dtype=np.float64)
+    com = np.sum(coords * masses[:, np.newaxis], axis=0, 
+                 dtype=np.float64) / totmass
     r2 = np.sum((coords - com[np.newaxis, :])**2, axis=1)
     searchrad2 = initialradiusfactor**2 * np.max(r2)
     Npart_conv = min(minparticles, len(masses) * 0.01)
@@ -71,8 +74,9 @@ def calchalocen(coordsmassesdict, shrinkfrac=0.025, minparticles=1000,
         mask = r2 <= searchrad2
         coords_it = coords_it[mask]
         masses_it = masses_it[mask]
-        com = np.sum(coords_it * masses_it[:, np.newaxis], axis=0) \
-               / np.sum(masses_it)
+        com = np.sum(coords_it * masses_it[:, np.newaxis], axis=0,
+                     dtype=np.float64) \
+               / np.sum(masses_it, dtype=np.float64)
         r2 = np.sum((coords_it - com[np.newaxis, :])**2, axis=1)
 
         it += 1
@@ -200,12 +204,14 @@ def calchalodata_shrinkingsphere(path, snapshot, meandef=('200c', 'BN98')):
     r2_order = r2[rorder]
     # apparent truncation error issues in cumsum for some 
     # simulations/snapshots using float32. (enclosed mass plateaus)
-    masses_order = np.asarray(masses[rorder], dtype=np.float64)
+    # -> accumulate in float64, but don't store a float64 copy of the
+    # masses
+    dens2_order = np.cumsum(masses[rorder], dtype=np.float64)
     del masses, r2, rorder
     dens_targets = [target / toCGS_m * toCGS_c**3 for target in \
                     dens_targets_cgs]
-    dens2_order = (np.cumsum(masses_order)**2) \
-                  / ((4. * np.pi / 3)**2 * r2_order**3)
+    dens2_order **= 2
+    dens2_order /= (4. * np.pi / 3)**2 * r2_order.astype(np.float64)**3
 
     rsols_cgs = []
     msols_cgs = []
@@ -580,7 +586,7 @@ def adddata_cenrvir(rmtemp=False):
                 os.remove(tfn)
 
 def calc_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
-              parttypes='all'):
+              parttypes='all', useindex=False):
     '''
     calculate center of mass velocity for specified particle 
     types in a specified fraction of the given virial radius
@@ -603,6 +609,11 @@ def calc_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
         which particle types to include in the calculation.
         'all' uses all types except 2 (low-resolution dark matter),
         and 5 if the simulation does not contain black holes.
+    useindex: bool
+        read in only the particles in spatial index cells overlapping
+        the sphere (Firesnap.select_sphere), instead of all particles.
+        Index files are made in opts_locs.dir_snapsidecars if needed.
+        The result is the same.
     '''
     halodat, todoc_cv = gethalodata_shrinkingsphere(path, snapshot, 
                                                     meandef=meandef_rvir)
@@ -618,16 +629,26 @@ def calc_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
         parttypes = parttypes
     dct_m = {}
     dct_r = {}
+    dct_i = {}
     toCGS_m = None
     toCGS_c = None
     for pt in parttypes:
         cpath = 'PartType{}/Coordinates'
         mpath = 'PartType{}/Mass'
         try:
-            ctemp = snap.readarray_emulateEAGLE(cpath.format(pt))
-            _toCGS_c = snap.toCGS
-            dct_m[pt] = snap.readarray_emulateEAGLE(mpath.format(pt))
-            _toCGS_m = snap.toCGS
+            if useindex:
+                dct_i[pt], ctemp = snap.select_sphere(
+                    cen_cm, radius_rvir * rvir_cm, parttype=pt, 
+                    makeindex=True, return_coords=True)
+                _toCGS_c = snap.toCGS
+                dct_m[pt] = snap.readarray_indices(
+                    'PartType{}/Masses'.format(pt), dct_i[pt])
+                _toCGS_m = snap.toCGS
+            else:
+                ctemp = snap.readarray_emulateEAGLE(cpath.format(pt))
+                _toCGS_c = snap.toCGS
+                dct_m[pt] = snap.readarray_emulateEAGLE(mpath.format(pt))
+                _toCGS_m = snap.toCGS
         except (OSError, rf.FieldNotFoundError):
             msg = 'Skipping PartType {} in COM vel. calc: not present on file'
             print(msg.format(pt))
@@ -672,7 +693,10 @@ def calc_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
     # get velocities
     for pt in pt_used:
         vpath = 'PartType{}/Velocities'
-        dct_v[pt] = snap.readarray_emulateEAGLE(vpath.format(pt))
+        if useindex:
+            dct_v[pt] = snap.readarray_indices(vpath.format(pt), dct_i[pt])
+        else:
+            dct_v[pt] = snap.readarray_emulateEAGLE(vpath.format(pt))
         _toCGS_v = snap.toCGS
         if toCGS_v is None:
             toCGS_v = _toCGS_v
@@ -923,7 +947,7 @@ def writedata_vcom(halodat, todoc,
                 vgrp.attrs.create(key, halodat[key])
 
 def get_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
-             parttypes='all'):
+             parttypes='all', useindex=False):
     '''
     same in/output as calchalodata_shrinkingsphere,
     but reads data from file if stored, and stores data to a temporary
@@ -940,7 +964,7 @@ def get_vcom(path, snapshot, radius_rvir, meandef_rvir='BN98',
         print(err)
         print('Calculating COM velocity')
         out = calc_vcom(path, snapshot, radius_rvir, meandef_rvir=meandef_rvir,
-                        parttypes=parttypes)
+                        parttypes=parttypes, useindex=useindex)
         print('Vcom calculated.')
         filen = ol.dir_halodata + f'temp_vcom_{uuid.uuid1()}.hdf5'
         print(f'Saving data to file {filen}')
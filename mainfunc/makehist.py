@@ -37,7 +37,7 @@ def histogram_radprof(dirpath, snapnum,
                       particle_type=0, 
                       center='shrinksph', rbins=(0., 1.), runit='Rvir',
                       logweights=True, logaxes=True, axbins=0.1,
-                      outfilen=None, overwrite=True):
+                      outfilen=None, overwrite=True, floattype=None):
     '''
     make a weightype, weighttype_args weighted histogram of 
     axtypes, axtypes_args.
@@ -108,6 +108,11 @@ def histogram_radprof(dirpath, snapnum,
     overwrite: bool
         If a file with name outfilen already exists, overwrite it (True) or
         raise a ValueError (False)
+    floattype: numpy floating-point type or None
+        type to read in and process the particle data as (e.g.,
+        np.float32, to reduce memory use); see Firesnap. None means 
+        the stored types are used. Histogram weights are always summed
+        in float64.
     Output:
     -------
     file with saved histogram data, if a file is specified
@@ -132,7 +137,7 @@ def histogram_radprof(dirpath, snapnum,
     if not hasattr(logaxes, '__len__'):
         logaxes = [logaxes] * len(axtypes)
 
-    snap = rf.get_Firesnap(dirpath, snapnum)
+    snap = rf.get_Firesnap(dirpath, snapnum, floattype=floattype)
     
     if center is not None:
         todoc_cen = {}
@@ -216,7 +221,10 @@ def histogram_radprof(dirpath, snapnum,
                                         filterdct=filterdct)
         todoc.update(_todoc)
         if logax:
-            qty = np.log10(qty)
+            if qty.dtype.kind == 'f':
+                qty = np.log10(qty, out=qty)
+            else:
+                qty = np.log10(qty)
         qty_good = np.isfinite(qty)
         minq = np.min(qty[qty_good])
         maxq = np.max(qty[qty_good])
@@ -255,6 +263,8 @@ def histogram_radprof(dirpath, snapnum,
                                          filterdct=filterdct)
     wt_todoc.update(_wt_todoc)
     #print(_axbins)
+    # histogramdd sums the weights in float64 (through np.bincount), 
+    # one chunk of (float32) weights at a time
     maxperloop = 752**3 // 8
     if len(wt) <= maxperloop:
         hist, edges = np.histogramdd(_axvals, weights=wt, bins=_axbins)
@@ -329,6 +339,9 @@ def histogram_radprof(dirpath, snapnum,
             igrp.attrs.create('dirpath', np.string_(dirpath))
             igrp.attrs.create('particle_type', particle_type)
             igrp.attrs.create('outfilen', np.string_(outfilen))
+            _floattype = 'None' if floattype is None \
+                         else np.dtype(floattype).name
+            igrp.attrs.create('floattype', np.string_(_floattype))
             h5u.savedict_hdf5(igrp, todoc_gen)
 
             if halodat is not None:
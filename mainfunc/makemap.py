@@ -2,12 +2,13 @@ import h5py
 import numbers as num
 import numpy as np
 
+import fire_an.mainfunc.coords as crd
 import fire_an.mainfunc.get_qty as gq
 import fire_an.mainfunc.haloprop as hp
 import fire_an.readfire.readin_fire_data as rf
 import fire_an.utils.constants_and_units as c
 import fire_an.utils.h5utils as h5u
-from fire_an.utils.projection import project
+from fire_an.utils.projection import project, project_tiled
 
 # AHF: sorta tested (enclosed 2D mass wasn't too far above Mvir)
 # Rockstar: untested draft
@@ -21,7 +22,10 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
             maptype='Mass', maptype_args=None,
             weighttype=None, weighttype_args=None,
             save_weightmap=False, logmap=True,
-            logweightmap=True, losradius_rvir=None):
+            logweightmap=True, losradius_rvir=None, floattype=None,
+            projbackend='C', projtiles=None, projnproc=1,
+            compression=None, compression_opts=None, shuffle=False,
+            pyramid_levels=0, mincol=None, radprof=None, rotmatrix=None):
     '''
     Creates a mass map projected perpendicular to a line of sight axis
     by assuming the simulation resolution elements divide their mass 
@@ -80,6 +84,66 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
     losradius_rvir: None or float
         half length along the line of sight direction, Rvir units. If
         None, radius_rvir is used.
+    floattype: numpy floating-point type or None
+        type to read in and process the particle data as (e.g.,
+        np.float32, to reduce memory use); see Firesnap. None means 
+        the stored types are used.
+    projbackend: ['C', 'numpy']
+        projection backend; see utils.projection.project. 'numpy' 
+        does not need the compiled HsmlAndProject libraries.
+    projtiles: None or tuple of 2 ints
+        if not None, split the map into (number along map x, 
+        number along map y) tiles, which are projected separately
+        (see utils.projection.project_tiled), to limit memory use or 
+        project in parallel.
+    projnproc: int
+        number of processes to project the tiles in (with projtiles).
+    compression: None, 'gzip', or 'lzf'
+        compression filter for the stored maps (chunked hdf5 
+        datasets). 'gzip' gives smaller files, 'lzf' is faster.
+    compression_opts: None or int
+        compression level for 'gzip' (0 -- 9, default 4)
+    shuffle: bool
+        apply the hdf5 shuffle filter (usually improves compression 
+        of float data)
+    pyramid_levels: int
+        also store this many coarser versions of the map(s), each 
+        a factor 2 coarser along both axes than the last, in groups 
+        'map_pyramid' and 'weightmap_pyramid' (datasets 'level<i>'). 
+        Coarse pixels are averages of the fine pixel quantities, or 
+        weighted averages for weighted maps (see mappyramid). 
+        get_2dprof.readmap reads these.
+    mincol: None or float
+        mask pixels where the (log10) projected quantity (weight, for
+        weighted maps) is below this value, in the output units. 
+        Masked pixels are set to -np.inf (log maps) or 0. (linear 
+        maps) for projected quantities, and NaN for weighted 
+        averages, which makes the maps compress much better.
+    radprof: None or dict
+        if a dict, also calculate statistics of the map values as a 
+        function of impact parameter (annularstats), and store them in
+        the group 'radprof_map' ('radprof_weightmap' for a stored 
+        weightmap). Read these with get_2dprof.get_profile_radprof.
+        Keys:
+        'rbins': impact parameter bin edges (required)
+        'rbin_units': 'pkpc', 'Rvir', or 'cm' (default 'pkpc')
+        'percentiles': percentiles (0 -- 1) to calculate 
+            (default (0.1, 0.5, 0.9))
+        'thresholds': get covering fractions for values >= these
+            (default: none)
+        'weightmap_thresholds': the same, for the weightmap
+        'hist_binsize', 'hist_edges': value histogram bins for the 
+            map (see annularstats)
+        'store_map': store the map(s) as well (default True)
+    rotmatrix: None or float array, shape (3, 3)
+        rotation matrix to make the map in a rotated frame, e.g., 
+        face-on or edge-on maps from coords.rotmatrix_from_zdir with 
+        the angular momentum direction. Coordinates are rotated 
+        around the halo center as in coords.CoordinateWranger, and 
+        axis (and 'los' coordinate quantities) refer to the rotated 
+        frame. The centering, rotation, and region selection are done
+        in place, in blocks, so no rotated copies of the coordinate 
+        array are made. None means no rotation.
     Output:
     -------
     massW: 2D array of floats
@@ -87,6 +151,24 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
     massQ: NaN array, for future work
 
 
+    '''
+    mapspecs = [(maptype, maptype_args, weighttype, weighttype_args)]
+    massmap_batch(dirpath, snapnum, mapspecs, [axis], [outfilen],
+                  radius_rvir=radius_rvir, particle_type=particle_type,
+                  pixsize_pkpc=pixsize_pkpc, center=center, norm=norm,
+                  save_weightmap=save_weightmap, logmap=logmap,
+                  logweightmap=logweightmap, 
+                  losradius_rvir=losradius_rvir, floattype=floattype,
+                  cache_maxbytes=None, projbackend=projbackend,
+                  projtiles=projtiles, projnproc=projnproc,
+                  compression=compression, 
+                  compression_opts=compression_opts, shuffle=shuffle,
+                  pyramid_levels=pyramid_levels, mincol=mincol,
+                  radprof=radprof, rotmatrix=rotmatrix)
+
+def projaxes(axis):
+    '''
+    Axis1, Axis2, Axis3 for a line-of-sight axis 'x', 'y', or 'z'
     '''
     if axis == 'z':
         Axis1 = 0
@@ -103,10 +185,18 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
     else:
         msg = 'axis should be "x", "y", or "z", not {}'
         raise ValueError(msg.format(axis))
-    
+    return Axis1, Axis2, Axis3
+
+def get_halocenter(dirpath, snapnum, center, floattype=None,
+                   cache_maxbytes=None):
+    '''
+    get the snapshot reader, halo data, halo center [cm], and Rvir 
+    [cm] for the massmap center options
+    '''
+    kwargs_snap = {'floattype': floattype, 'cache_maxbytes': cache_maxbytes}
     if center == 'AHFsmooth':
         halodat = hp.mainhalodata_AHFsmooth(dirpath, snapnum)
-        snap = rf.get_Firesnap(dirpath, snapnum) 
+        snap = rf.get_Firesnap(dirpath, snapnum, **kwargs_snap)
         cen = np.array([halodat['Xc_ckpcoverh'], 
                         halodat['Yc_ckpcoverh'], 
                         halodat['Zc_ckpcoverh']])
@@ -124,7 +214,7 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
                 raise ValueError(msg)
         halodat, _csm_halo = hp.halodata_rockstar(dirpath, snapnum, 
                                                   select=select)
-        snap = rf.get_Firesnap(dirpath, snapnum) 
+        snap = rf.get_Firesnap(dirpath, snapnum, **kwargs_snap)
         cen = np.array([halodat['Xc_ckpc'], 
                         halodat['Yc_ckpc'], 
                         halodat['Zc_ckpc']])
@@ -137,22 +227,180 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
                            halodat['Yc_cm'], 
                            halodat['Zc_cm']])
         rvir_cm = halodat['Rvir_cm']
-        snap = rf.get_Firesnap(dirpath, snapnum) 
+        snap = rf.get_Firesnap(dirpath, snapnum, **kwargs_snap)
     else:
         raise ValueError('Invalid center option {}'.format(center))
+    return snap, halodat, cen_cm, rvir_cm
+
+def _get_mapqtys(snap, dirpath, snapnum, particle_type, Axis3, mapspec,
+                 filterdct, ionfilterdct, rotmatrix=None):
+    '''
+    get the quantities to project for one map specification (see 
+    massmap_batch) in the selected region.
+    Returns qW, multipafterW (without the norm), todocW, qQ, 
+    multipafterQ, todocQ, and the (processed) maptype_args and 
+    weighttype_args
+    '''
+    maptype, maptype_args, weighttype, weighttype_args = mapspec
+    if rotmatrix is not None:
+        # coordinate quantities in the map frame
+        if maptype == 'coords' and 'rotmatrix' not in maptype_args:
+            maptype_args = maptype_args.copy()
+            maptype_args['rotmatrix'] = rotmatrix
+        if weighttype == 'coords' and 'rotmatrix' not in weighttype_args:
+            weighttype_args = weighttype_args.copy()
+            weighttype_args['rotmatrix'] = rotmatrix
+    fd_map = ionfilterdct if maptype == 'ion' else filterdct
+    if weighttype is None:
+        if maptype == 'coords':
+            maptype_args, todocW = gq.process_typeargs_coords(dirpath,
+                                                              snapnum,
+                                                              maptype_args,
+                                                              paxis=Axis3)
+        else:
+            todocW = {}
+        qW, toCGSW, _todocW = gq.get_qty(snap, particle_type, maptype,
+                                         maptype_args, filterdct=fd_map)
+        todocW.update(_todocW)
+        qQ = np.zeros(len(qW), dtype=np.float32)
+        toCGSQ = None
+        todocQ = None
+    else:
+        fd_weight = ionfilterdct if weighttype == 'ion' else filterdct
+        if maptype == 'coords':
+            maptype_args, todocQ = gq.process_typeargs_coords(dirpath, 
+                                                              snapnum,
+                                                              maptype_args,
+                                                              paxis=Axis3)
+        else:
+            todocQ = {}
+        qQ, toCGSQ, _todocQ = gq.get_qty(snap, particle_type, maptype,
+                                         maptype_args, filterdct=fd_map)
+        todocQ.update(_todocQ)
+        if weighttype == 'coords':
+            weighttype_args, todocW = gq.process_typeargs_coords(
+                dirpath, snapnum, weighttype_args, paxis=Axis3)
+        else:
+            todocW = {}
+        qW, toCGSW, _todocW = gq.get_qty(snap, particle_type, weighttype,
+                                         weighttype_args, 
+                                         filterdct=fd_weight)
+        todocW.update(_todocW)
+    return (qW, toCGSW, todocW, qQ, toCGSQ, todocQ, 
+            maptype_args, weighttype_args)
+
+def massmap_batch(dirpath, snapnum, mapspecs, axes, outfilens,
+                  radius_rvir=2., particle_type=0, pixsize_pkpc=3., 
+                  center='shrinksph', norm='pixsize_phys',
+                  save_weightmap=False, logmap=True,
+                  logweightmap=True, losradius_rvir=None, floattype=None,
+                  cache_maxbytes=2 * 1024**3, projbackend='C',
+                  projtiles=None, projnproc=1,
+                  compression=None, compression_opts=None, shuffle=False,
+                  pyramid_levels=0, mincol=None, radprof=None, 
+                  rotmatrix=None):
+    '''
+    Make maps for multiple quantities and/or line-of-sight axes for 
+    the same snapshot, halo, and region, in the massmap format (one 
+    file per map). The halo center is found and the particle 
+    coordinates and smoothing lengths are read in and filtered once, 
+    each quantity is calculated once for all axes, and the gas 
+    properties ion fractions depend on (temperature, density, 
+    metallicity) are calculated once for all ions.
+
+    Parameters:
+    -----------
+    dirpath, snapnum, radius_rvir, particle_type, pixsize_pkpc, center,
+    norm, save_weightmap, logmap, logweightmap, losradius_rvir, 
+    floattype, projbackend, projtiles, projnproc, compression, 
+    compression_opts, shuffle, pyramid_levels, mincol, radprof, 
+    rotmatrix:
+        see massmap; these are the same for all maps
+    mapspecs: list of tuples
+        the quantities to map; each tuple is 
+        (maptype, maptype_args[, weighttype[, weighttype_args]])
+        with the options as for massmap. weighttype and 
+        weighttype_args default to None.
+    axes: list of str ('x', 'y', or 'z')
+        line of sight axes to make each map for
+    outfilens: list of str
+        output file names (including the full path) for each map 
+        specification (matched by list index). Each should contain 
+        '{ax}', which is replaced by the line of sight axis, unless 
+        only one axis is used.
+    cache_maxbytes: int or None
+        memory budget for keeping read-in snapshot arrays (e.g., 
+        masses, element abundances) in memory between the different
+        map quantities; see Firesnap. None means no caching. 
+
+    Returns:
+    --------
+    None (the maps are saved to file)
+    '''
+    mapspecs = [tuple(spec) + (None,) * (4 - len(spec)) 
+                for spec in mapspecs]
+    if compression not in [None, 'gzip', 'lzf']:
+        msg = 'compression should be None, "gzip", or "lzf", not {}'
+        raise ValueError(msg.format(compression))
+    storeopts = {'compression': compression, 
+                 'compression_opts': compression_opts,
+                 'shuffle': shuffle, 'mincol': mincol}
+    if len(outfilens) != len(mapspecs):
+        msg = 'Got {} mapspecs, but {} outfilens'
+        raise ValueError(msg.format(len(mapspecs), len(outfilens)))
+    if len(axes) > 1:
+        for outfilen in outfilens:
+            if '{ax}' not in outfilen:
+                msg = ('outfilens should contain "{{ax}}" for multiple '
+                       'axes; got {}')
+                raise ValueError(msg.format(outfilen))
+    if rotmatrix is not None:
+        rotmatrix = np.asarray(rotmatrix)
+        crd.check_rotmatrix(rotmatrix)
+    snap, halodat, cen_cm, rvir_cm = get_halocenter(
+        dirpath, snapnum, center, floattype=floattype, 
+        cache_maxbytes=cache_maxbytes)
 
     # calculate pixel numbers and projection region based
     # on target size and extended for integer pixel number
-    target_size_cm = np.array([2. * radius_rvir * rvir_cm] * 3)
-    if losradius_rvir is not None:
-        target_size_cm[Axis3] = 2. * losradius_rvir * rvir_cm
     pixel_cm = pixsize_pkpc * c.cm_per_mpc * 1e-3
-    npix3 = (np.ceil(target_size_cm / pixel_cm)).astype(int)
-    npix_x = npix3[Axis1]
-    npix_y = npix3[Axis2]
-    size_touse_cm = target_size_cm
-    size_touse_cm[Axis1] = npix_x * pixel_cm
-    size_touse_cm[Axis2] = npix_y * pixel_cm
+    axpars = {}
+    for axis in axes:
+        Axis1, Axis2, Axis3 = projaxes(axis)
+        target_size_cm = np.array([2. * radius_rvir * rvir_cm] * 3)
+        if losradius_rvir is not None:
+            target_size_cm[Axis3] = 2. * losradius_rvir * rvir_cm
+        npix3 = (np.ceil(target_size_cm / pixel_cm)).astype(int)
+        npix_x = npix3[Axis1]
+        npix_y = npix3[Axis2]
+        size_touse_cm = target_size_cm
+        size_touse_cm[Axis1] = npix_x * pixel_cm
+        size_touse_cm[Axis2] = npix_y * pixel_cm
+        axpars[axis] = {'Axis1': Axis1, 'Axis2': Axis2, 'Axis3': Axis3,
+                        'npix_x': npix_x, 'npix_y': npix_y,
+                        'size_touse_cm': size_touse_cm}
+
+    if radprof is not None:
+        radprof = radprof.copy()
+        for key, default in [('rbin_units', 'pkpc'), 
+                             ('percentiles', (0.1, 0.5, 0.9)),
+                             ('thresholds', ()), 
+                             ('weightmap_thresholds', ()),
+                             ('hist_binsize', None), ('hist_edges', None),
+                             ('store_map', True)]:
+            if key not in radprof:
+                radprof[key] = default
+        if radprof['rbin_units'] == 'pkpc':
+            rbin_tocm = c.cm_per_mpc * 1e-3
+        elif radprof['rbin_units'] == 'Rvir':
+            rbin_tocm = rvir_cm
+        elif radprof['rbin_units'] == 'cm':
+            rbin_tocm = 1.
+        else:
+            msg = ('radprof rbin_units should be "pkpc", "Rvir", or "cm",'
+                   ' not {}')
+            raise ValueError(msg.format(radprof['rbin_units']))
+        radprof['rbins_cm'] = np.asarray(radprof['rbins']) * rbin_tocm
 
     if norm == 'pixsize_phys':
         multipafter_norm = 1. / pixel_cm**2
@@ -166,103 +414,259 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
         lsmooth = snap.readarray_emulateEAGLE(basepath + 'SmoothingLength')
         lsmooth_toCGS = snap.toCGS
 
-    coords = snap.readarray_emulateEAGLE(basepath + 'Coordinates')
+    # centered and rotated in place: read without the cache (which 
+    # would keep a second, read-only copy)
+    coords = snap.readarray_emulateEAGLE(basepath + 'Coordinates', 
+                                         usecache=False)
     coords_toCGS = snap.toCGS
-    # needed for projection step anyway
-    coords -= cen_cm / coords_toCGS
-    # select box region
+    # select box region: the union of the regions for all axes. 
+    # The regions and margins for each axis are selected from these 
+    # in the same way.
     # zoom regions are generally centered -> don't worry
     # about edge overlap
-    box_dims_coordunit = size_touse_cm / coords_toCGS
-
+    for axis in axes:
+        axpars[axis]['box_dims_coordunit'] = \
+            axpars[axis]['size_touse_cm'] / coords_toCGS
+    box_dims_all = np.max([axpars[axis]['box_dims_coordunit'] 
+                           for axis in axes], axis=0)
+    # centering (needed for projection step anyway), rotation, and
+    # distance outside the region in one pass
+    boxexcess = crd.center_rotate_inplace(coords, cen_cm / coords_toCGS,
+                                          rotmatrix=rotmatrix, 
+                                          boxhalfsize=0.5 * box_dims_all)
     if haslsmooth:
-        # extreme values will occur at zoom region edges -> restrict
-        filter_temp = np.all(np.abs((coords)) <= 0.5 * box_dims_coordunit, 
-                             axis=1)
-        lmax = np.max(lsmooth[filter_temp]) 
         conv = lsmooth_toCGS / coords_toCGS
-        del filter_temp
+        # extreme values will occur at zoom region edges -> restrict
+        lmax = np.max(lsmooth[boxexcess <= 0.]) 
         # might be lower-density stuff outside the region, but overlapping it
         lmargin = 2. * lmax * conv
-        filter = np.all(np.abs((coords)) <= 0.5 * box_dims_coordunit \
-                        + lmargin, axis=1)
+        filter = boxexcess <= lmargin
         lsmooth = lsmooth[filter]
         if not np.isclose(conv, 1.):
             lsmooth *= conv
-    
     else:
-        filter = np.all(np.abs((coords)) <= 0.5 * box_dims_coordunit, axis=1)   
-    
-    coords = coords[filter]
-    if weighttype is None:
-        if maptype == 'coords':
-            maptype_args, todocW = gq.process_typeargs_coords(dirpath,
-                                                              snapnum,
-                                                              maptype_args,
-                                                              paxis=Axis3)
-        else:
-            todocW = {}
-        qW, toCGSW, _todocW = gq.get_qty(snap, particle_type, maptype,
-                                      maptype_args,
-                                      filterdct={'filter': filter})
-        todocW.update(_todocW)
-        multipafterW = toCGSW * multipafter_norm
-        qQ = np.zeros(len(qW), dtype=np.float32)
-    else:
-        if maptype == 'coords':
-            maptype_args, todocQ = gq.process_typeargs_coords(dirpath, 
-                                                              snapnum,
-                                                              maptype_args,
-                                                              paxis=Axis3)
-        else:
-            todocQ = {}
-        qQ, toCGSQ, _todocQ = gq.get_qty(snap, particle_type, maptype,
-                                        maptype_args,
-                                        filterdct={'filter': filter})
-        multipafterQ = toCGSQ
-        todocQ.update(_todocQ)
-        if weighttype == 'coords':
-            maptype_args, todocW = gq.process_typeargs_coords(dirpath,
-                                                              snapnum,
-                                                              weighttype_args,
-                                                              paxis=Axis3)
-        else:
-            todocW = {}
-        qW, toCGSW, _todocW = gq.get_qty(snap, particle_type, weighttype,
-                                         weighttype_args,
-                                         filterdct={'filter': filter})
-        todocW.update(_todocW)
-        multipafterW = toCGSW * multipafter_norm
-        
+        filter = boxexcess <= 0.
+    del boxexcess
+    coords = crd.compress_inplace(coords, filter)
     if not haslsmooth:
         # minimum smoothing length is set in the projection
-        lsmooth = np.zeros(shape=(len(qW),), dtype=coords.dtype)
+        lsmooth = np.zeros(shape=(len(coords),), dtype=coords.dtype)
         lsmooth_toCGS = 1.
+    # selections for each axis, within the union region
+    for axis in axes:
+        box_dims_coordunit = axpars[axis]['box_dims_coordunit']
+        boxexcess = crd.boxexcess(coords, 0.5 * box_dims_coordunit)
+        if haslsmooth:
+            lmax = np.max(lsmooth[boxexcess <= 0.]) 
+            # lsmooth is already in coordinate units
+            axpars[axis]['lmargin'] = 2. * lmax
+            sel = boxexcess <= axpars[axis]['lmargin']
+        else:
+            sel = boxexcess <= 0.
+        del boxexcess
+        if np.all(sel):
+            sel = None
+        axpars[axis]['sel'] = sel
+    
+    filterdct = {'filter': filter}
+    # gas properties for the ion fractions: calculate once for all ions
+    ionfilterdct = filterdct
+    for spec in mapspecs:
+        for _mt, _margs in [(spec[0], spec[1]), (spec[2], spec[3])]:
+            if _mt != 'ion' or ionfilterdct is not filterdct:
+                continue
+            if _margs is not None and 'ionfrac-method' in _margs:
+                if _margs['ionfrac-method'] != 'PS20':
+                    continue
+            ionfilterdct = filterdct.copy()
+            ionfilterdct.update(gq.get_ionfrac_inputs(snap, indct=filterdct,
+                                                      table='PS20'))
     
     tree = False
     periodic = False # zoom region
-    NumPart = len(qW)
-    dct = {'coords': coords, 'lsmooth': lsmooth, 
-           'qW': qW, 
-           'qQ': qQ}
-    Ls = box_dims_coordunit
     # cosmopars uses EAGLE-style cMpc/h units for the box
     box3 = [snap.cosmopars.boxsize * c.cm_per_mpc / snap.cosmopars.h \
             / coords_toCGS] * 3
-    mapW, mapQ = project(NumPart, Ls, Axis1, Axis2, Axis3, box3,
-                         periodic, npix_x, npix_y,
-                         'C2', dct, tree, ompproj=True, 
-                         projmin=None, projmax=None)
-    if weighttype is None:
+    for spec, _outfilen in zip(mapspecs, outfilens):
+        maptype, maptype_args, weighttype, weighttype_args = spec
+        # coordinate quantity arguments depend on the line of sight
+        peraxis = maptype == 'coords' or weighttype == 'coords'
+        if not peraxis:
+            qtys = _get_mapqtys(snap, dirpath, snapnum, particle_type, 
+                                None, spec, filterdct, ionfilterdct,
+                                rotmatrix=rotmatrix)
+        for axis in axes:
+            Axis1 = axpars[axis]['Axis1']
+            Axis2 = axpars[axis]['Axis2']
+            Axis3 = axpars[axis]['Axis3']
+            sel = axpars[axis]['sel']
+            if peraxis:
+                qtys = _get_mapqtys(snap, dirpath, snapnum, particle_type, 
+                                    Axis3, spec, filterdct, ionfilterdct,
+                                    rotmatrix=rotmatrix)
+            qW, toCGSW, todocW, qQ, toCGSQ, todocQ, \
+                _maptype_args, _weighttype_args = qtys
+            todocW = todocW.copy()
+            multipafterW = toCGSW * multipafter_norm
+            if weighttype is not None:
+                todocQ = todocQ.copy()
+                multipafterQ = toCGSQ
+            if sel is None:
+                dct = {'coords': coords, 'lsmooth': lsmooth, 
+                       'qW': qW, 'qQ': qQ}
+            else:
+                dct = {'coords': coords[sel], 'lsmooth': lsmooth[sel], 
+                       'qW': qW[sel], 'qQ': qQ[sel]}
+            NumPart = len(dct['qW'])
+            Ls = axpars[axis]['box_dims_coordunit']
+            if projtiles is None:
+                mapW, mapQ = project(NumPart, Ls, Axis1, Axis2, Axis3, box3,
+                                     periodic, axpars[axis]['npix_x'], 
+                                     axpars[axis]['npix_y'],
+                                     'C2', dct, tree, ompproj=True, 
+                                     projmin=None, projmax=None,
+                                     backend=projbackend)
+            else:
+                mapW, mapQ = project_tiled(NumPart, Ls, Axis1, Axis2, Axis3,
+                                           box3, periodic, 
+                                           axpars[axis]['npix_x'], 
+                                           axpars[axis]['npix_y'],
+                                           'C2', dct, tree, 
+                                           ompproj=projnproc == 1, 
+                                           projmin=None, projmax=None,
+                                           backend=projbackend,
+                                           ntiles_x=projtiles[0],
+                                           ntiles_y=projtiles[1],
+                                           nproc=projnproc)
+            del dct
+            if weighttype is None:
+                mdoc = todocW
+                multipafterQ = None
+            else:
+                mdoc = todocQ
+            mlog = logmap
+            _mapQ = None if weighttype is None else mapQ
+            pyramid = mappyramid(mapW, _mapQ, levels=pyramid_levels)
+            outmaps = [_outmaps(_mapW, _mapQ, multipafterW, multipafterQ, 
+                                logmap, save_weightmap, logweightmap, 
+                                mincol=mincol)
+                       for _mapW, _mapQ in [(mapW, _mapQ)] + pyramid]
+            del mapW, mapQ, _mapQ, pyramid
+            rstats = {}
+            if radprof is not None:
+                # same impact parameters as in get_2dprof.readmap
+                npix_x = axpars[axis]['npix_x']
+                npix_y = axpars[axis]['npix_y']
+                xpix = (np.arange(npix_x) + 0.5 - 0.5 * npix_x) * pixel_cm
+                ypix = (np.arange(npix_y) + 0.5 - 0.5 * npix_y) * pixel_cm
+                rpix_cm = np.sqrt(xpix[:, np.newaxis]**2 
+                                  + ypix[np.newaxis, :]**2)
+                rstats['map'] = annularstats(
+                    outmaps[0][0], mlog, rpix_cm, radprof['rbins_cm'],
+                    percentiles=radprof['percentiles'],
+                    thresholds=radprof['thresholds'],
+                    hist_binsize=radprof['hist_binsize'],
+                    hist_edges=radprof['hist_edges'])
+                if outmaps[0][1] is not None:
+                    rstats['weightmap'] = annularstats(
+                        outmaps[0][1], logweightmap, rpix_cm, 
+                        radprof['rbins_cm'], 
+                        percentiles=radprof['percentiles'],
+                        thresholds=radprof['weightmap_thresholds'])
+            if len(axes) > 1 or '{ax}' in _outfilen:
+                outfilen = _outfilen.format(ax=axis)
+            else:
+                outfilen = _outfilen
+            lmargin_cm = axpars[axis]['lmargin'] * coords_toCGS \
+                         if haslsmooth else None
+            _savemap(outfilen, outmaps, mlog, mdoc, snap, dirpath, 
+                     radius_rvir, losradius_rvir, particle_type, 
+                     pixsize_pkpc, axis, norm, norm_units, floattype, 
+                     projbackend, Axis1, Axis2, Axis3, 
+                     axpars[axis]['size_touse_cm'],
+                     lmargin_cm, center, halodat, maptype, _maptype_args,
+                     weighttype, _weighttype_args, todocW, 
+                     save_weightmap, logweightmap, storeopts, 
+                     rstats=rstats, radprof=radprof, rotmatrix=rotmatrix)
+            del outmaps, rstats
+        del qtys
+
+def _blocksum2(arr):
+    '''
+    sums over 2 x 2 pixel blocks; odd dimensions are padded with zeros
+    '''
+    nx, ny = arr.shape
+    pad = ((0, nx % 2), (0, ny % 2))
+    if nx % 2 == 1 or ny % 2 == 1:
+        arr = np.pad(arr, pad)
+    return arr.reshape(arr.shape[0] // 2, 2, 
+                       arr.shape[1] // 2, 2).sum(axis=(1, 3))
+
+def mappyramid(mapW, mapQ=None, levels=1):
+    '''
+    coarser versions of projected maps, each a factor 2 coarser than
+    the last along both axes. 
+
+    Parameters:
+    -----------
+    mapW: 2D float array
+        the map of the projected quantity (linear, not log); coarse 
+        pixels get the average of the fine pixels they contain
+    mapQ: 2D float array or None
+        the map of the mapW-weighted average quantity (linear);
+        coarse pixels get the mapW-weighted average of the fine pixels
+    levels: int
+        number of coarser levels
+
+    Returns:
+    --------
+    list of (mapW, mapQ) tuples (float32), for levels 1, ..., levels.
+    (mapQ is None if the input mapQ is None.) At the map edges, pixels
+    for odd map sizes average over the available fine pixels.
+    '''
+    out = []
+    _W = mapW.astype(np.float64)
+    _n = np.ones(mapW.shape, dtype=np.float64)
+    if mapQ is not None:
+        _WQ = _W * mapQ
+    for level in range(levels):
+        _W = _blocksum2(_W)
+        _n = _blocksum2(_n)
+        _mapW = (_W / _n).astype(np.float32)
+        if mapQ is not None:
+            _WQ = _blocksum2(_WQ)
+            _mapQ = np.zeros(_W.shape, dtype=np.float64)
+            np.divide(_WQ, _W, out=_mapQ, where=_W != 0.)
+            _mapQ = _mapQ.astype(np.float32)
+        else:
+            _mapQ = None
+        out.append((_mapW, _mapQ))
+    return out
+
+def _outmaps(mapW, mapQ, multipafterW, multipafterQ, logmap, 
+             save_weightmap, logweightmap, mincol=None):
+    '''
+    convert projected maps to the stored values (units, log/linear), 
+    and mask low column pixels. (Input maps may be modified.)
+    Returns the 'map' and 'weightmap' arrays (the latter None if 
+    it is not stored).
+    Masked pixels are set to -np.inf (log) or 0. (linear) for 
+    projected quantities, and NaN for weighted averages.
+    '''
+    if mincol is not None:
+        with np.errstate(divide='ignore'):
+            mask = np.log10(mapW) + np.log10(multipafterW) < mincol
+    omapW = None
+    if mapQ is None:
         if logmap:
             omapW = np.log10(mapW)
             omapW += np.log10(multipafterW)
         else:
             mapW *= multipafterW
             omapW = mapW
-        mmap = omapW
-        mdoc = todocW
-        mlog = logmap
+        if mincol is not None:
+            omapW[mask] = -np.inf if logmap else 0.
+        return omapW, None
     else:
         if logmap:
             omapQ = np.log10(mapQ)
@@ -277,20 +681,226 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
             else:
                 mapW *= multipafterW
                 omapW = mapW
-        mmap = omapQ
-        mdoc = todocQ
-        mlog = logmap
+        if mincol is not None:
+            omapQ[mask] = np.nan
+            if save_weightmap:
+                omapW[mask] = -np.inf if logweightmap else 0.
+        return omapQ, omapW
+
+def annularstats(mmap, islog, rpix, rbins, percentiles=(0.1, 0.5, 0.9),
+                 thresholds=(), hist_binsize=None, hist_edges=None):
+    '''
+    statistics of map values in annuli around the map center, 
+    including a histogram of the values, which can be combined across
+    maps to get percentiles for a sample. NaN values are ignored.
+
+    Parameters:
+    -----------
+    mmap: 2D float array
+        the map values
+    islog: bool
+        are the map values log10 values?
+    rpix: 2D float array
+        impact parameter for each map pixel (same units as rbins)
+    rbins: 1D float array
+        impact parameter bin edges
+    percentiles: iterable of floats
+        percentiles (0 -- 1) of the map values to calculate in each 
+        annulus
+    thresholds: iterable of floats
+        get the fraction of pixels >= each threshold in each annulus
+        (covering fractions)
+    hist_binsize: float or None
+        histogram bin size. Bin edges are multiples of this value, so
+        histograms for different maps can be combined. The default is 
+        0.01 for log maps, and 1/200 of the value range for linear 
+        maps.
+    hist_edges: 1D float array or None
+        histogram bin edges (overrides hist_binsize)
 
+    Returns:
+    --------
+    dictionary with arrays:
+    'npix': number of (non-NaN) pixels in each annulus
+    'npix_nan': number of NaN pixels in each annulus
+    'sum_lin': sum of (linear) values
+    'sum_log': sum of log10 values
+    'min', 'max': minimum and maximum values
+    'perc': percentiles, shape (number of annuli, len(percentiles))
+    'fcov': covering fractions, shape (annuli, len(thresholds))
+    'hist': counts, shape (annuli, len(hist_edges) + 1). The first 
+        and last columns are counts below and above the bin range.
+    'hist_edges': the histogram bin edges
+    '''
+    rbins = np.asarray(rbins)
+    nbins = len(rbins) - 1
+    rinds = np.searchsorted(rbins, rpix.ravel()) - 1
+    vals = mmap.ravel()
+    inr = np.logical_and(rinds >= 0, rinds < nbins)
+    isnan = np.isnan(vals)
+    out = {}
+    out['npix_nan'] = np.bincount(rinds[np.logical_and(inr, isnan)], 
+                                  minlength=nbins)
+    sel = np.logical_and(inr, np.logical_not(isnan))
+    rinds = rinds[sel]
+    vals = vals[sel].astype(np.float64)
+    del inr, isnan, sel
+    out['npix'] = np.bincount(rinds, minlength=nbins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if islog:
+            out['sum_lin'] = np.bincount(rinds, weights=10**vals, 
+                                         minlength=nbins)
+            out['sum_log'] = np.bincount(rinds, weights=vals, 
+                                         minlength=nbins)
+        else:
+            out['sum_lin'] = np.bincount(rinds, weights=vals, 
+                                         minlength=nbins)
+            out['sum_log'] = np.bincount(rinds, weights=np.log10(vals), 
+                                         minlength=nbins)
+    
+    order = np.lexsort((vals, rinds))
+    rinds = rinds[order]
+    vals = vals[order]
+    del order
+    starts = np.searchsorted(rinds, np.arange(nbins), side='left')
+    ends = np.searchsorted(rinds, np.arange(nbins), side='right')
+    hasvals = ends > starts
+    out['min'] = np.nan * np.ones(nbins)
+    out['min'][hasvals] = vals[starts[hasvals]]
+    out['max'] = np.nan * np.ones(nbins)
+    out['max'][hasvals] = vals[ends[hasvals] - 1]
+    out['perc'] = np.nan * np.ones((nbins, len(percentiles)))
+    for bi in np.where(hasvals)[0]:
+        out['perc'][bi, :] = np.quantile(vals[starts[bi]: ends[bi]], 
+                                         percentiles)
+    out['fcov'] = np.zeros((nbins, len(thresholds)))
+    for ti, threshold in enumerate(thresholds):
+        _count = np.bincount(rinds, weights=vals >= threshold, 
+                             minlength=nbins)
+        out['fcov'][hasvals, ti] = _count[hasvals] \
+                                   / out['npix'][hasvals]
+    
+    if hist_edges is None:
+        finite = np.isfinite(vals)
+        if np.any(finite):
+            vmin = np.min(vals[finite])
+            vmax = np.max(vals[finite])
+        else:
+            vmin = 0.
+            vmax = 0.
+        if hist_binsize is None:
+            if islog:
+                hist_binsize = 0.01
+            else:
+                hist_binsize = (vmax - vmin) / 200.
+                if hist_binsize <= 0.:
+                    hist_binsize = 1.
+        imin = np.floor(vmin / hist_binsize)
+        imax = np.floor(vmax / hist_binsize) + 1.
+        hist_edges = np.arange(imin, imax + 0.5) * hist_binsize
+    hist_edges = np.asarray(hist_edges)
+    nedges = len(hist_edges)
+    # 0: below the first edge, nedges: at or above the last edge
+    vinds = np.searchsorted(hist_edges, vals, side='right')
+    out['hist'] = np.bincount(rinds * (nedges + 1) + vinds, 
+                              minlength=nbins * (nedges + 1))
+    out['hist'] = out['hist'].reshape(nbins, nedges + 1)
+    out['hist_edges'] = hist_edges
+    return out
+
+def _saveannularstats(f, name, rstats, radprof, islog):
+    '''
+    store annularstats output in group radprof_<name>
+    '''
+    grp = f.create_group('radprof_' + name)
+    grp.attrs.create('log', islog)
+    grp.create_dataset('rbins', data=np.asarray(radprof['rbins']))
+    grp['rbins'].attrs.create('units', np.string_(radprof['rbin_units']))
+    grp.create_dataset('rbins_cm', data=radprof['rbins_cm'])
+    for key in rstats:
+        grp.create_dataset(key, data=rstats[key])
+    grp['perc'].attrs.create('percentiles', 
+                             np.array(radprof['percentiles']))
+    grp['fcov'].attrs.create('thresholds', 
+                             np.array(radprof['thresholds']))
+    _info = ('statistics of the map values in impact parameter bins '
+             'rbins (from the map center): see makemap.annularstats')
+    grp.attrs.create('info', np.string_(_info))
+
+def _savemapds(grp, name, mmap, mlog, storeopts):
+    '''
+    store a map and its min/max attributes
+    '''
+    dskwargs = {}
+    if storeopts['compression'] is not None:
+        dskwargs['compression'] = storeopts['compression']
+        if storeopts['compression_opts'] is not None:
+            dskwargs['compression_opts'] = storeopts['compression_opts']
+    if storeopts['shuffle']:
+        dskwargs['shuffle'] = True
+    if len(dskwargs) > 0:
+        dskwargs['chunks'] = True
+    ds = grp.create_dataset(name, data=mmap, **dskwargs)
+    ds.attrs.create('log', mlog)
+    # all pixels can be masked (mincol) or NaN (weighted maps): 
+    # min/max attributes without any (finite) values are NaN
+    if mlog:
+        finite = np.isfinite(mmap)
+        minfinite = np.min(mmap[finite]) if np.any(finite) else np.NaN
+        ds.attrs.create('minfinite', minfinite)
+    notnan = np.logical_not(np.isnan(mmap))
+    if np.any(notnan):
+        if not mlog:
+            ds.attrs.create('min', np.min(mmap[notnan]))
+        ds.attrs.create('max', np.max(mmap[notnan]))
+    else:
+        if not mlog:
+            ds.attrs.create('min', np.NaN)
+        ds.attrs.create('max', np.NaN)
+    return ds
+
+def _savepyramid(f, name, outmaps, mindex, mlog, pixsize_pkpc, storeopts):
+    '''
+    store the coarse levels of a map (outmaps entries 1, ...; mindex 
+    selects the map or weightmap) in group <name>_pyramid
+    '''
+    if len(outmaps) < 2:
+        return None
+    grp = f.create_group(name + '_pyramid')
+    shape0 = outmaps[0][mindex].shape
+    for level in range(1, len(outmaps)):
+        ds = _savemapds(grp, f'level{level}', outmaps[level][mindex], 
+                        mlog, storeopts)
+        factor = 2**level
+        ds.attrs.create('level', level)
+        ds.attrs.create('downsample_factor', factor)
+        ds.attrs.create('pixsize_pkpc', pixsize_pkpc * factor)
+        # map center, in units of this level's pixels
+        ds.attrs.create('xcen_pix', 0.5 * shape0[0] / factor)
+        ds.attrs.create('ycen_pix', 0.5 * shape0[1] / factor)
+
+def _savemap(outfilen, outmaps, mlog, mdoc, snap, dirpath, radius_rvir, 
+             losradius_rvir, particle_type, pixsize_pkpc, axis, norm,
+             norm_units, floattype, projbackend, Axis1, Axis2, Axis3, 
+             size_touse_cm, lmargin_cm, center, halodat, maptype, 
+             maptype_args, weighttype, weighttype_args, todocW, 
+             save_weightmap, logweightmap, storeopts, rstats=None,
+             radprof=None, rotmatrix=None):
+    '''
+    write a map and its metadata in the massmap format
+    '''
+    mmap, omapW = outmaps[0]
+    store_map = radprof is None or radprof['store_map']
     with h5py.File(outfilen, 'w') as f:
         # map (emulate make_maps format)
-        f.create_dataset('map', data=mmap)
-        f['map'].attrs.create('log', mlog)
-        if mlog:
-            minfinite = np.min(mmap[np.isfinite(mmap)])
-            f['map'].attrs.create('minfinite', minfinite)
-        else:
-            f['map'].attrs.create('min', np.min(mmap))
-        f['map'].attrs.create('max', np.max(mmap))
+        if store_map:
+            _savemapds(f, 'map', mmap, mlog, storeopts)
+            _savepyramid(f, 'map', outmaps, 0, mlog, pixsize_pkpc, 
+                         storeopts)
+        if rstats is not None:
+            for name in rstats:
+                islog = mlog if name == 'map' else logweightmap
+                _saveannularstats(f, name, rstats[name], radprof, islog)
         
         # cosmopars (emulate make_maps format)
         hed = f.create_group('Header')
@@ -312,14 +922,31 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
         igrp.attrs.create('axis', np.string_(axis))
         igrp.attrs.create('norm', np.string_(norm))
         igrp.attrs.create('outfilen', np.string_(outfilen))
+        _floattype = 'None' if floattype is None \
+                     else np.dtype(floattype).name
+        igrp.attrs.create('floattype', np.string_(_floattype))
+        igrp.attrs.create('projbackend', np.string_(projbackend))
+        for key in ['compression', 'compression_opts', 'mincol']:
+            if storeopts[key] is None:
+                igrp.attrs.create(key, np.string_('None'))
+            elif isinstance(storeopts[key], str):
+                igrp.attrs.create(key, np.string_(storeopts[key]))
+            else:
+                igrp.attrs.create(key, storeopts[key])
+        igrp.attrs.create('shuffle', storeopts['shuffle'])
+        igrp.attrs.create('pyramid_levels', len(outmaps) - 1)
         # useful derived/used stuff
         igrp.attrs.create('Axis1', Axis1)
         igrp.attrs.create('Axis2', Axis2)
         igrp.attrs.create('Axis3', Axis3)
         igrp.attrs.create('diameter_used_cm', np.array(size_touse_cm))
-        if haslsmooth:
-            igrp.attrs.create('margin_lsmooth_cm', lmargin * coords_toCGS)
+        if lmargin_cm is not None:
+            igrp.attrs.create('margin_lsmooth_cm', lmargin_cm)
         igrp.attrs.create('center', np.string_(center))
+        if rotmatrix is None:
+            igrp.attrs.create('rotmatrix', np.string_('None'))
+        else:
+            igrp.attrs.create('rotmatrix', np.asarray(rotmatrix))
         _grp = igrp.create_group('halodata')
         h5u.savedict_hdf5(_grp, halodat)
         igrp.attrs.create('maptype', np.string_(maptype))
@@ -346,15 +973,10 @@ def massmap(dirpath, snapnum, radius_rvir=2., particle_type=0,
                 if 'units' in todocW:
                     todocW['units'] = todocW['units'] + norm_units
                 h5u.savedict_hdf5(igrp, todocW)
-            if save_weightmap:
-                f.create_dataset('weightmap', data=omapW)
-                f['weightmap'].attrs.create('log', logweightmap)
-                if logweightmap:
-                    minfinite = np.min(omapW[np.isfinite(omapW)])
-                    f['weightmap'].attrs.create('minfinite', minfinite)
-                else:
-                    f['weightmap'].attrs.create('min', np.min(omapW))
-                f['weightmap'].attrs.create('max', np.max(omapW))
+            if save_weightmap and store_map:
+                _savemapds(f, 'weightmap', omapW, logweightmap, storeopts)
+                _savepyramid(f, 'weightmap', outmaps, 1, logweightmap, 
+                             pixsize_pkpc, storeopts)
 
 
 def massmap_wholezoom(dirpath, snapnum, pixsize_pkpc=3.,
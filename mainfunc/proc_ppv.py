@@ -4,11 +4,18 @@ process ppv data cubes into maps
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.fft as spfft
 import scipy.special as spspec
 import scipy.signal as spsig
+import string
 
+import fire_an.ionrad.ion_utils as iu
+import fire_an.mainfunc.coords as crd
+import fire_an.mainfunc.get_qty as gq
+import fire_an.mainfunc.makemap as mm
 import fire_an.simlists as sl
 import fire_an.utils.constants_and_units as c
+import fire_an.utils.projection as pr
 import fire_an.simlists as sl
 
 def smoothmax_ppv(filen, vax=3, p1ax=1, p2ax=2, 
@@ -167,14 +174,411 @@ def run_ppv_proc(opt):
     print(snapnum, ', ',  pax)
     smoothmax_ppv(filen, vax=3, p1ax=1, p2ax=2, 
                   smoothsigmas=smooths)
+
+
+def _vkernel_rfft(bpar, dv, nfft):
+    '''
+    rfft of the velocity kernel exp(-(v / bpar)**2), integrated over 
+    velocity bins of size dv (as in smoothmax_ppv), for circular 
+    convolution over nfft bins. bpar = 0 gives a delta function.
+    '''
+    if bpar == 0.:
+        return np.ones(nfft // 2 + 1, dtype=np.complex128)
+    # kernel bin offsets, with negative offsets wrapped around
+    offs = np.fft.fftfreq(nfft, d=1. / nfft)
+    kern = spspec.erf((offs + 0.5) * dv / bpar) \
+           - spspec.erf((offs - 0.5) * dv / bpar)
+    kern *= 1. / np.sum(kern)
+    return spfft.rfft(kern)
+
+def ppv_peakvels(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, 
+                 npix_x, npix_y, kernel, dct, vmin, vmax, dv, 
+                 smoothsigmas=(), projmin=None, projmax=None,
+                 dlogb_thermal=0.05, nsig_calc=3., maxcells=2**24):
+    '''
+    build position-position-velocity (p-p-v) cubes directly from 
+    particles, and get the velocity of the cube maximum along each 
+    sightline, for different velocity smoothing widths. 
+
+    The particles are distributed over the map pixels with the SPH 
+    kernel as in utils.projection.project_numpy, and over velocity 
+    bins with a thermal broadening profile exp(-(v / b_th)**2). For 
+    this, particles are grouped by b_th (log bins of size 
+    dlogb_thermal); each group is binned in velocity (nearest bin), 
+    Fourier transformed along the velocity axis, and convolved with 
+    the (bin-integrated) thermal profile for the group. All 
+    smoothing widths are then applied as products with the smoothing
+    kernel transforms, with one inverse transform for all smoothing 
+    widths. The map is processed in tiles of at most maxcells 
+    p-p-v cells, so only the tile cube and the output maps are 
+    in memory.
+
+    Parameters:
+    -----------
+    NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
+    kernel, projmin, projmax:
+        as for utils.projection.project
+    dct: dict
+        particle data:
+        'coords': positions (as for project)
+        'lsmooth': smoothing lengths (as for project)
+        'qW': the weights (e.g., ion numbers)
+        'vlos': line-of-sight velocities (units of dv)
+        'bth' (optional): thermal b parameters, sqrt(2 k T / m) (units
+        of dv). If not included, there is no thermal broadening.
+    vmin, vmax: float
+        range of velocities to include (units of dv). Particles 
+        outside this range are left out. The cube is extended by 
+        nsig_calc times the largest broadening width on either side. 
+    dv: float
+        velocity bin size
+    smoothsigmas: iterable of floats
+        smoothing widths (b parameters, units of dv) for the velocity
+        kernel exp(-(v / sigma)**2), as in smoothmax_ppv
+    dlogb_thermal: float
+        log10 bin size for the thermal broadening groups
+    nsig_calc: float
+        extend the kernels to this many times their widths
+    maxcells: int
+        maximum number of p-p-v cells per tile
+
+    Returns:
+    --------
+    mapW: float64 array, shape (npix_x, npix_y)
+        projected weights (not normalized by the pixel size)
+    vcens: float64 array
+        the velocity bin centers of the extended cube
+    vpeak: float32 array, shape (len(smoothsigmas) + 1, npix_x, npix_y)
+        velocity of the cube maximum (nearest bin center) along each 
+        sightline; index 0 is without smoothing (only thermal 
+        broadening), the others for each of the smoothsigmas. NaN for 
+        pixels without weight.
+    '''
+    smoothsigmas = list(smoothsigmas)
+    nv = int(np.ceil((vmax - vmin) / dv - 1e-6))
+    vlos = dct['vlos'][:NumPart]
+    vsel = np.logical_and(vlos >= vmin, vlos < vmin + nv * dv)
+    if not np.all(vsel):
+        print('Leaving out {} / {} particles outside the velocity '
+              'range'.format(np.sum(np.logical_not(vsel)), NumPart))
+    # thermal broadening groups
+    if 'bth' in dct:
+        bth = dct['bth'][:NumPart].astype(np.float64)
+        posb = bth > 0.
+        bgroup = np.full(NumPart, -2**30, dtype=np.int64)
+        bgroup[posb] = np.floor(np.log10(bth[posb]) 
+                                / dlogb_thermal).astype(np.int64)
+        bmax = 10**((np.max(bgroup[vsel], initial=-2**30) + 1.) 
+                    * dlogb_thermal)
+        del bth, posb
+    else:
+        bgroup = np.full(NumPart, -2**30, dtype=np.int64)
+        bmax = 0.
+    bmax_tot = np.sqrt(bmax**2 + max(smoothsigmas, default=0.)**2)
+    npad = int(np.ceil(nsig_calc * bmax_tot / dv))
+    # padding on both sides of the velocity range: no wrap-around
+    nfft = spfft.next_fast_len(nv + 2 * npad, real=True)
+    vcens = vmin - (npad - 0.5) * dv + np.arange(nfft) * dv
+    vbin = np.floor((vlos - vmin) / dv).astype(np.int64) + npad
+    smoothfilters = np.array([_vkernel_rfft(sig, dv, nfft) 
+                              for sig in smoothsigmas])
+    gkeys = np.unique(bgroup[vsel])
+    thermfilters = {gkey: _vkernel_rfft(0. if gkey == -2**30 else
+                                        10**((gkey + 0.5) * dlogb_thermal),
+                                        dv, nfft)
+                    for gkey in gkeys}
     
-    
+    ncells = npix_x * npix_y * nfft
+    ntiles = int(np.ceil(ncells / maxcells))
+    ntiles_x = min(npix_x, int(np.ceil(np.sqrt(ntiles))))
+    ntiles_y = min(npix_y, int(np.ceil(ntiles / ntiles_x)))
+    tiles = pr.maptiles(npix_x, npix_y, ntiles_x, ntiles_y)
+    Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
+    _dct = {'coords': dct['coords'][:NumPart][vsel], 
+            'lsmooth': dct['lsmooth'][:NumPart][vsel],
+            'qW': dct['qW'][:NumPart][vsel], 
+            'vbin': vbin[vsel], 'bgroup': bgroup[vsel]}
+    del vbin, bgroup, vsel
+    mapW = np.zeros((npix_x, npix_y), dtype=np.float64)
+    vpeak = np.zeros((len(smoothsigmas) + 1, npix_x, npix_y), 
+                     dtype=np.float32)
+    for ti, tile in enumerate(tiles):
+        print('p-p-v tile {} / {}'.format(ti, len(tiles)))
+        tdct, kwargs = pr.tileinput(_dct, len(_dct['qW']), Ls, 
+                                    Axis1, Axis2, Axis3, box3, 
+                                    periodic, npix_x, npix_y, tile, 
+                                    projmin=projmin, projmax=projmax,
+                                    Hmax=Hmax)
+        ix0, ix1, iy0, iy1 = tile
+        ntpix = (ix1 - ix0) * (iy1 - iy0)
+        tspec = np.zeros((ntpix, nfft // 2 + 1), dtype=np.complex128)
+        tmapW = np.zeros(ntpix, dtype=np.float64)
+        for gkey in np.unique(tdct['bgroup']):
+            gsel = tdct['bgroup'] == gkey
+            gdct = {key: tdct[key][gsel] for key in tdct}
+            cube = np.zeros(ntpix * nfft, dtype=np.float64)
+            kwargs['NumPart'] = len(gdct['qW'])
+            for pinds, pixinds, wk in pr.kernelpairs(kernel=kernel, 
+                                                     dct=gdct, **kwargs):
+                wk *= gdct['qW'][pinds]
+                tmapW += np.bincount(pixinds, weights=wk, minlength=ntpix)
+                cinds = pixinds * nfft + gdct['vbin'][pinds]
+                cmin = np.min(cinds)
+                cinds -= cmin
+                _sum = np.bincount(cinds, weights=wk)
+                cube[cmin: cmin + len(_sum)] += _sum
+                del pinds, pixinds, wk, cinds, _sum
+            del gdct
+            cube = cube.reshape((ntpix, nfft))
+            _spec = spfft.rfft(cube, axis=1)
+            del cube
+            _spec *= thermfilters[gkey][np.newaxis, :]
+            tspec += _spec
+            del _spec
+        del tdct
+        # all smoothing widths in one inverse transform; sightlines in 
+        # blocks to stay within the cell budget
+        nblock = max(1, maxcells // (nfft * (len(smoothsigmas) + 1)))
+        tpeak = np.zeros((len(smoothsigmas) + 1, ntpix), dtype=np.float32)
+        for bstart in range(0, ntpix, nblock):
+            bend = min(bstart + nblock, ntpix)
+            _spec = np.empty((len(smoothsigmas) + 1, bend - bstart, 
+                              nfft // 2 + 1), dtype=np.complex128)
+            _spec[0] = tspec[bstart: bend]
+            if len(smoothsigmas) > 0:
+                np.multiply(tspec[np.newaxis, bstart: bend, :], 
+                            smoothfilters[:, np.newaxis, :], 
+                            out=_spec[1:])
+            cubes = spfft.irfft(_spec, n=nfft, axis=2)
+            del _spec
+            tpeak[:, bstart: bend] = vcens[np.argmax(cubes, axis=2)]
+            del cubes
+        del tspec
+        tpeak[:, tmapW == 0.] = np.nan
+        mapW[ix0: ix1, iy0: iy1] = tmapW.reshape((ix1 - ix0, iy1 - iy0))
+        vpeak[:, ix0: ix1, iy0: iy1] = tpeak.reshape(
+            (len(smoothsigmas) + 1, ix1 - ix0, iy1 - iy0))
+    return mapW, vcens, vpeak
 
+def thermal_mass_u(weighttype, weighttype_args):
+    '''
+    get the particle mass (atomic mass units) to use for thermal 
+    broadening in ppvmap: the mass of the weighted element for ions and
+    metals, the hydrogen mass otherwise.
+    '''
+    if weighttype == 'ion':
+        # just for the element mass
+        return iu.get_ps20_element(weighttype_args['ion'])[1]
+    elif weighttype == 'Metal':
+        element = weighttype_args['element']
+        if element == 'total':
+            msg = ('Thermal broadening is undefined for the total metal '
+                   'mass; specify an element')
+            raise ValueError(msg)
+        return iu.elt_atomw_cgs(string.capwords(element)) / c.u
+    else:
+        return c.atomw_H
 
+def ppvmap(dirpath, snapnum, weighttype, weighttype_args, outfilen,
+           axis='z', radius_rvir=2., losradius_rvir=None, 
+           pixsize_pkpc=3., vmin_cmps=-500e5, vmax_cmps=500e5, 
+           dv_cmps=10e5, 
+           smoothsigmas=(10.e5, 20.e5, 30.e5, 40.e5, 50.e5, 
+                         60.e5, 70.e5, 80.e5, 90.e5, 100.e5),
+           thermal=True, center='shrinksph', vel_args=None,
+           dlogb_thermal=0.05, maxcells=2**24, floattype=None):
+    '''
+    make column density and peak velocity maps for a halo from 
+    position-position-velocity cubes built directly from the 
+    particles (ppv_peakvels), without storing the cubes. This 
+    replaces making p-p-v histograms and running smoothmax_ppv on 
+    them. Gas (PartType0) only.
 
+    Parameters:
+    -----------
+    dirpath, snapnum, axis, radius_rvir, losradius_rvir, pixsize_pkpc,
+    center, floattype:
+        as for makemap.massmap
+    weighttype, weighttype_args:
+        the quantity to project (maptype, maptype_args in massmap), 
+        e.g., 'ion', {'ion': 'Ne8'}
+    outfilen: str
+        output file (including the full path)
+    vmin_cmps, vmax_cmps, dv_cmps: float
+        velocity range and bin size [cm/s]
+    smoothsigmas: iterable of floats
+        velocity smoothing widths [cm/s], as in smoothmax_ppv
+    thermal: bool
+        include thermal broadening, with b = sqrt(2 k T / m), using
+        the element mass for 'ion' and 'Metal' weights, and the 
+        hydrogen mass otherwise.
+    vel_args: dict or None
+        the maptype_args for the 'coords' line-of-sight velocity. The
+        default is {'vel': 'doplos'} (doppler velocity, relative to 
+        the halo center of mass velocity).
+    dlogb_thermal, maxcells:
+        see ppv_peakvels
 
+    Returns:
+    --------
+    None (the maps are saved to file)
+    '''
+    if vel_args is None:
+        vel_args = {'vel': 'doplos'}
+    snap, halodat, cen_cm, rvir_cm = mm.get_halocenter(
+        dirpath, snapnum, center, floattype=floattype)
+    Axis1, Axis2, Axis3 = mm.projaxes(axis)
+    pixel_cm = pixsize_pkpc * c.cm_per_mpc * 1e-3
+    target_size_cm = np.array([2. * radius_rvir * rvir_cm] * 3)
+    if losradius_rvir is not None:
+        target_size_cm[Axis3] = 2. * losradius_rvir * rvir_cm
+    npix3 = (np.ceil(target_size_cm / pixel_cm)).astype(int)
+    npix_x = npix3[Axis1]
+    npix_y = npix3[Axis2]
+    size_touse_cm = target_size_cm
+    size_touse_cm[Axis1] = npix_x * pixel_cm
+    size_touse_cm[Axis2] = npix_y * pixel_cm
 
+    basepath = 'PartType0/'
+    lsmooth = snap.readarray_emulateEAGLE(basepath + 'SmoothingLength')
+    lsmooth_toCGS = snap.toCGS
+    # centered in place: read without the cache (read-only shared copy)
+    coords = snap.readarray_emulateEAGLE(basepath + 'Coordinates',
+                                         usecache=False)
+    coords_toCGS = snap.toCGS
+    box_dims_coordunit = size_touse_cm / coords_toCGS
+    # centering and distance outside the region in one pass
+    boxexcess = crd.center_rotate_inplace(coords, cen_cm / coords_toCGS,
+                                          boxhalfsize=0.5 * box_dims_coordunit)
+    conv = lsmooth_toCGS / coords_toCGS
+    lmax = np.max(lsmooth[boxexcess <= 0.]) 
+    lmargin = 2. * lmax * conv
+    filter = boxexcess <= lmargin
+    del boxexcess
+    coords = crd.compress_inplace(coords, filter)
+    lsmooth = lsmooth[filter]
+    if not np.isclose(conv, 1.):
+        lsmooth *= conv
+    filterdct = {'filter': filter}
 
+    qW, toCGSW, todocW = gq.get_qty(snap, 0, weighttype, weighttype_args,
+                                    filterdct=filterdct)
+    _vel_args, todocV = gq.process_typeargs_coords(dirpath, snapnum, 
+                                                   vel_args, paxis=Axis3)
+    vlos, toCGSV, _todocV = gq.get_qty(snap, 0, 'coords', _vel_args,
+                                       filterdct=filterdct)
+    todocV.update(_todocV)
+    # velocities in units of dv
+    vlos = vlos * (toCGSV / dv_cmps)
+    dct = {'coords': coords, 'lsmooth': lsmooth, 'qW': qW, 'vlos': vlos}
+    if thermal:
+        mass_u = thermal_mass_u(weighttype, weighttype_args)
+        temp = snap.readarray_emulateEAGLE(basepath + 'Temperature')[filter]
+        temp_toCGS = snap.toCGS
+        bth = np.sqrt(temp * (2. * c.boltzmann * temp_toCGS 
+                              / (mass_u * c.u))) / dv_cmps
+        del temp
+        dct['bth'] = bth
+    
+    box3 = [snap.cosmopars.boxsize * c.cm_per_mpc / snap.cosmopars.h \
+            / coords_toCGS] * 3
+    mapW, vcens, vpeak = ppv_peakvels(len(qW), box_dims_coordunit, 
+                                      Axis1, Axis2, Axis3, box3, False, 
+                                      npix_x, npix_y, 'C2', dct, 
+                                      vmin_cmps / dv_cmps, 
+                                      vmax_cmps / dv_cmps, 1., 
+                                      smoothsigmas=np.array(smoothsigmas) 
+                                                   / dv_cmps,
+                                      dlogb_thermal=dlogb_thermal, 
+                                      maxcells=maxcells)
+    del dct, coords, lsmooth, qW, vlos
+    vcens = vcens * dv_cmps
+    vpeak *= dv_cmps
+    with np.errstate(divide='ignore'):
+        colmap = np.log10(mapW) + np.log10(toCGSW / pixel_cm**2)
 
+    with h5py.File(outfilen, 'w') as f:
+        ds = f.create_dataset('map_pp', data=colmap.astype(np.float32))
+        ds.attrs.create('log', True)
+        ds.attrs.create('units', np.string_(todocW['units'] 
+                                            + ' / (physical cm)**2'))
+        ds = f.create_dataset('v_maxcol_nosmooth', data=vpeak[0])
+        ds.attrs.create('units', np.string_('cm/s'))
+        for si, smoothsigma in enumerate(smoothsigmas):
+            ds = f.create_dataset(f'v_maxcol_smooth_{smoothsigma:.0f}',
+                                  data=vpeak[si + 1])
+            ds.attrs.create('sigma_v_smooth_cmps', smoothsigma)
+            ds.attrs.create('units', np.string_('cm/s'))
+        f.create_dataset('vcens_cmps', data=vcens)
+        hed = f.create_group('Header')
+        hed.attrs.create('p1ax', Axis1)
+        hed.attrs.create('p2ax', Axis2)
+        hed.attrs.create('vax', Axis3)
+        cosmopars = snap.cosmopars.getdct()
+        csm = hed.create_group('cosmopars')
+        for key in cosmopars:
+            csm.attrs.create(key, cosmopars[key])
+        igrp = hed.create_group('inputpars')
+        igrp.attrs.create('snapnum', snapnum)
+        igrp.attrs.create('dirpath', np.string_(dirpath))
+        igrp.attrs.create('radius_rvir', radius_rvir)
+        igrp.attrs.create('losradius_rvir', np.nan if losradius_rvir is None
+                                            else losradius_rvir)
+        igrp.attrs.create('pixsize_pkpc', pixsize_pkpc)
+        igrp.attrs.create('axis', np.string_(axis))
+        igrp.attrs.create('center', np.string_(center))
+        igrp.attrs.create('diameter_used_cm', np.array(size_touse_cm))
+        igrp.attrs.create('weighttype', np.string_(weighttype))
+        _grp = igrp.create_group('weighttype_args')
+        for key in weighttype_args:
+            _grp.attrs.create(key, np.string_(str(weighttype_args[key])))
+        _grp = igrp.create_group('weighttype_doc')
+        for key in todocW:
+            _grp.attrs.create(key, np.string_(str(todocW[key])))
+        _grp = igrp.create_group('vel_doc')
+        for key in todocV:
+            _grp.attrs.create(key, np.string_(str(todocV[key])))
+        igrp.attrs.create('vmin_cmps', vmin_cmps)
+        igrp.attrs.create('vmax_cmps', vmax_cmps)
+        igrp.attrs.create('dv_cmps', dv_cmps)
+        igrp.attrs.create('thermal', thermal)
+        igrp.attrs.create('dlogb_thermal', dlogb_thermal)
+        igrp.attrs.create('Rvir_cm', rvir_cm)
+    print('Saved p-p-v maps to {}'.format(outfilen))
 
+def run_ppvmap(opt):
+    simnames = sl.m12_sr_all2 + sl.m12_hr_all2 +\
+               sl.m13_sr_all2 + sl.m13_hr_all2
+    sims_sr = sl.m12_sr_all2 +  sl.m13_sr_all2
+    sims_hr = sl.m12_hr_all2 +  sl.m13_hr_all2
+    snaps_sr = sl.snaps_sr
+    snaps_hr = sl.snaps_hr
+    numsnaps = 6
+    for sn in sl.buglist1:
+        if sn in simnames:
+            simnames.remove(sn)
+    if opt == -1:
+        return simnames
+    paxes = ['x', 'y', 'z']
+    
+    smi = opt // (numsnaps * len(paxes))
+    sni = (opt % (numsnaps * len(paxes))) // len(paxes) 
+    pai = opt % len(paxes) 
 
+    simname = simnames[smi]
+    snaps = snaps_sr if simname in sims_sr \
+            else snaps_hr if simname in sims_hr \
+            else None
+    snapnum = snaps[sni]
+    pax = paxes[pai]
+    dirpath = sl.dirpath_from_simname(simname)
+    
+    outdir = '/projects/b1026/nastasha/hists/ppv_all2/'
+    outfilen = outdir + (f'ppvmap_{pax}ax_by_Ne8_{simname}_snap{snapnum}'
+                         '_smoothed_vmaxcols.hdf5')
+    smooths = 1e5 * np.arange(10., 105., 10.)
+    print(simname)
+    print(snapnum, ', ',  pax)
+    ppvmap(dirpath, snapnum, 'ion', {'ion': 'Ne8', 'ps20depletion': False},
+           outfilen, axis=pax, radius_rvir=2., pixsize_pkpc=9.,
+           dv_cmps=10e5, smoothsigmas=smooths)
@@ -5,8 +5,135 @@ import numpy as np
 import fire_an.utils.constants_and_units as c
 
 
+def readmap(f, weightmap=False, level=0):
+    '''
+    read in a map from a massmap file, at full resolution or a coarser
+    level (if stored; see makemap.massmap pyramid_levels)
+
+    Parameters:
+    -----------
+    f: h5py File object
+        the opened map file
+    weightmap: bool
+        get the 'weightmap' array instead of the 'map' array
+    level: int
+        0 for the full-resolution map, or a coarser level. Each level
+        has 2x coarser pixels along each axis than the last.
+
+    Returns:
+    --------
+    map: 2D float array
+        the map values
+    pixsize_pkpc: float
+        pixel size for this level [pkpc]
+    center_pix: tuple of 2 floats
+        the map center (halo center position) in pixel units, for
+        pixel index 0 spanning 0 -- 1 
+    islog: bool
+        whether the map values are log10 values
+    '''
+    name = 'weightmap' if weightmap else 'map'
+    if level == 0:
+        ds = f[name]
+        _map = ds[:]
+        pixsize_pkpc = f['Header/inputpars'].attrs['pixsize_pkpc']
+        center_pix = (0.5 * float(_map.shape[0]), 
+                      0.5 * float(_map.shape[1]))
+    else:
+        path = f'{name}_pyramid/level{level}'
+        if path not in f:
+            msg = f'Map level {level} is not stored in {f.filename}'
+            raise ValueError(msg)
+        ds = f[path]
+        _map = ds[:]
+        pixsize_pkpc = ds.attrs['pixsize_pkpc']
+        center_pix = (ds.attrs['xcen_pix'], ds.attrs['ycen_pix'])
+    islog = bool(ds.attrs['log'])
+    return _map, pixsize_pkpc, center_pix, islog
+
+class RadiusIndex:
+    '''
+    distances of map pixel centers to the map center (pixel units), 
+    and their sorted order, for fast impact parameter binning of 
+    maps with the same shape and center. Use get_radiusindex to get 
+    cached instances.
+    '''
+    # number of cached scaled distance arrays per instance
+    maxscaled = 4
+
+    def __init__(self, shape, center_pix):
+        xcen, ycen = center_pix
+        xinds, yinds = np.indices(shape).astype(np.float32)
+        # centered on halo
+        dpix2 = (xinds + 0.5 - xcen)**2 + (yinds + 0.5 - ycen)**2
+        del xinds, yinds
+        self.dpix = np.sqrt(dpix2)
+        del dpix2
+        self.shape = shape
+        self.order = np.argsort(self.dpix, axis=None, kind='stable')
+        self.dsorted = self.dpix.ravel()[self.order]
+        # shared between calls for maps of the same shape
+        for arr in (self.dpix, self.order, self.dsorted):
+            arr.flags.writeable = False
+        self._scaled = {}
+    
+    def scaled(self, factor):
+        '''
+        sorted distances multiplied by factor (e.g. pixel size), 
+        with the same (float32) rounding as scaling dpix
+        '''
+        if factor not in self._scaled:
+            if len(self._scaled) >= self.maxscaled:
+                del self._scaled[next(iter(self._scaled))]
+            _scaled = self.dsorted.copy()
+            _scaled *= factor
+            self._scaled[factor] = _scaled
+        return self._scaled[factor]
+
+    def segments(self, rbins, factor=1.):
+        '''
+        for impact parameter bins rbins (units: factor x pixel size),
+        get the start and end indices of each bin in the sorted pixel
+        order (self.order). Bin i includes distances
+        rbins[i] < r <= rbins[i + 1].
+        '''
+        edges = np.searchsorted(self.scaled(factor), rbins, side='right')
+        return edges[:-1], edges[1:]
+
+# RadiusIndex instances by map shape and center 
+_radiusindices = {}
+_radiusindices_max = 16
+
+def get_radiusindex(shape, center_pix):
+    '''
+    get a (cached) RadiusIndex for a map shape and center (pixel 
+    units). The pixel size does not matter here: impact parameter bins
+    are converted to pixel units.
+    '''
+    key = (tuple(shape), float(center_pix[0]), float(center_pix[1]))
+    if key not in _radiusindices:
+        if len(_radiusindices) >= _radiusindices_max:
+            del _radiusindices[next(iter(_radiusindices))]
+        _radiusindices[key] = RadiusIndex(shape, center_pix)
+    return _radiusindices[key]
+
+def _rfactor(f, pixsize_pkpc, units):
+    '''
+    conversion factor from pixels to impact parameter units
+    '''
+    if units == 'pkpc':
+        return pixsize_pkpc
+    elif units == 'Rvir':
+        # using Imran's shrinking spheres method
+        rvir_cm = f['Header/inputpars/halodata'].attrs['Rvir_cm']
+        return pixsize_pkpc * c.cm_per_mpc * 1e-3 / rvir_cm
+    elif units == 'cm':
+        return pixsize_pkpc * c.cm_per_mpc * 1e-3
+    else:
+        raise ValueError('Invalid units option {}'.format(units))
+
 def get_rval_massmap(filen, units='pkpc', weightmap=False,
-                     absvals=False, weightrange=None):
+                     absvals=False, weightrange=None, level=0):
     '''
     get radius and map quantity matched arrays
 
@@ -20,6 +147,8 @@ def get_rval_massmap(filen, units='pkpc', weightmap=False,
         get the 'weightmap' array instead of the 'map' array
     absvals: bool
         get absolute values
+    level: int
+        map resolution level (see readmap); 0 is the full resolution
     Returns:
     --------
     radii: float array (1D)
@@ -28,12 +157,11 @@ def get_rval_massmap(filen, units='pkpc', weightmap=False,
         map values, matching impact parameters 
     '''
     with h5py.File(filen, 'r') as f:
-        if weightmap:
-            _map = f['weightmap'][:]
-        else:
-            _map = f['map'][:]
+        _map, pixssize_pkpc, (xcen, ycen), _ = readmap(f, 
+                                                       weightmap=weightmap,
+                                                       level=level)
         if weightrange is not None:
-            _smap = f['weightmap'][:]
+            _smap, _, _, _ = readmap(f, weightmap=True, level=level)
             mapsel = _smap >= weightrange[0]
             mapsel &= _smap < weightrange[1]
             del _smap
@@ -41,31 +169,15 @@ def get_rval_massmap(filen, units='pkpc', weightmap=False,
             mapsel = (slice(None, None, None),) * 2
         if absvals:
             _map = np.abs(_map)
-        shape = _map.shape
-        xinds, yinds = np.indices(shape).astype(np.float32)
-        # centered on halo
-        xcen = 0.5 * float(shape[0])
-        ycen = 0.5 * float(shape[1])
-        dpix2 = (xinds + 0.5 - xcen)**2 + (yinds + 0.5 - ycen)**2
-        dpix = np.sqrt(dpix2)
-        
-        dpix = dpix[mapsel]
+        ri = get_radiusindex(_map.shape, (xcen, ycen))
+        # ri.dpix is shared: don't scale it in place
+        dpix = ri.dpix[mapsel] * _rfactor(f, pixssize_pkpc, units)
         _map = _map[mapsel]
-        
-        pixssize_pkpc = f['Header/inputpars'].attrs['pixsize_pkpc']
-        if units == 'pkpc':
-            dpix *= pixssize_pkpc
-        elif units == 'Rvir':
-            # using Imran's shrinking spheres method
-            rvir_cm = f['Header/inputpars/halodata'].attrs['Rvir_cm']
-            dpix *= pixssize_pkpc * c.cm_per_mpc * 1e-3 / rvir_cm
-        elif units == 'cm':
-            dpix *= pixssize_pkpc * c.cm_per_mpc * 1e-3
     return dpix.flatten(), _map.flatten()
 
 def get_profile_massmap(filen, rbins, rbin_units='pkpc',
                         profiles=[], weightmap=False,
-                        absvals=False, weightrange=None):
+                        absvals=False, weightrange=None, level=0):
     '''
     get values with impact parameter from maps. If multiple files
     are given, averages, percentiles, etc. are taken over the full
@@ -88,6 +200,8 @@ def get_profile_massmap(filen, rbins, rbin_units='pkpc',
             'min' (minimum)
             'max' (maximum)
             'fcov-<float>' (fraction of values >= given value)
+    level: int
+        map resolution level (see readmap); 0 is the full resolution
     Returns:
     --------
     profiles: each an array of floats
@@ -102,20 +216,27 @@ def get_profile_massmap(filen, rbins, rbin_units='pkpc',
     first = True
     for _filen in filens:
         with h5py.File(_filen, 'r') as f:
-            if weightmap:
-                _islog = bool(f['weightmap'].attrs['log'])
-            else:
-                _islog = bool(f['map'].attrs['log'])
-        rvals, mvs = get_rval_massmap(_filen, units=rbin_units,
-                                      weightmap=weightmap,
-                                      absvals=absvals,
-                                      weightrange=weightrange)
-        
-        # searchsorted index 0 means value < rbins[0], 
-        # index len(rbins) means values > rbins[-1] 
-        rinds = np.searchsorted(rbins, rvals) - 1 
-        _mvs_by_bin = [mvs[rinds == i] for i in range(len(rbins))]
-        _mvs_by_bin = _mvs_by_bin[:-1]
+            mvs, pixsize_pkpc, center_pix, _islog = readmap(
+                f, weightmap=weightmap, level=level)
+            if weightrange is not None:
+                _smap, _, _, _ = readmap(f, weightmap=True, level=level)
+                mapsel = _smap >= weightrange[0]
+                mapsel &= _smap < weightrange[1]
+                del _smap
+            rfactor = _rfactor(f, pixsize_pkpc, rbin_units)
+        if absvals:
+            mvs = np.abs(mvs)
+        # pixel values sorted by impact parameter -> bins are slices
+        ri = get_radiusindex(mvs.shape, center_pix)
+        starts, ends = ri.segments(rbins, factor=rfactor)
+        mvs = mvs.ravel()[ri.order]
+        if weightrange is not None:
+            mapsel = mapsel.ravel()[ri.order]
+            _mvs_by_bin = [mvs[start: end][mapsel[start: end]] 
+                           for start, end in zip(starts, ends)]
+        else:
+            _mvs_by_bin = [mvs[start: end] 
+                           for start, end in zip(starts, ends)]
         if first:
             mvs_by_bin = _mvs_by_bin
             islog = _islog
@@ -146,7 +267,7 @@ def get_profile_massmap(filen, rbins, rbin_units='pkpc',
                                     for _mvs in mvs_by_bin])
         elif prof == 'max':
             _pr = np.array([np.max(_mvs) for _mvs in mvs_by_bin])
-        elif prof == 'max':
+        elif prof == 'min':
             _pr = np.array([np.min(_mvs) for _mvs in mvs_by_bin])
         elif prof.startswith('perc-'):
             pv = float(prof.split('-')[-1])
@@ -157,4 +278,308 @@ def get_profile_massmap(filen, rbins, rbin_units='pkpc',
             _pr = np.array([np.sum(_mvs >= pv) / float(len(_mvs)) \
                             for _mvs in mvs_by_bin])
         out.append(_pr)
-    return out
\ No newline at end of file
+    return out
+
+def get_profiles_massmaps(filens, rbins, rbin_units='pkpc',
+                          profiles=[], weightmap=False, absvals=False,
+                          level=0):
+    '''
+    get values with impact parameter from maps, separately for each 
+    map. Maps with the same shape, center, and impact parameter units
+    are processed together: the pixel values are gathered in impact
+    parameter order, and the profiles are segmented reductions over 
+    the impact parameter bins.
+
+    Parameters:
+    -----------
+    filens: iterable of strings
+        names of the files containing the maps (with full path)
+    rbins, rbin_units, profiles, weightmap, absvals, level:
+        as for get_profile_massmap
+
+    Returns:
+    --------
+    profiles: each a float array, shape (number of files, number of 
+        impact parameter bins)
+        the profile values in each radial bin, for each file
+    '''
+    rbins = np.asarray(rbins)
+    nbins = len(rbins) - 1
+    # group the maps by radius index and bin scaling
+    groups = {}
+    for fi, _filen in enumerate(filens):
+        with h5py.File(_filen, 'r') as f:
+            _map, pixsize_pkpc, center_pix, islog = readmap(
+                f, weightmap=weightmap, level=level)
+            rfactor = _rfactor(f, pixsize_pkpc, rbin_units)
+        if absvals:
+            _map = np.abs(_map)
+        ri = get_radiusindex(_map.shape, center_pix)
+        key = (id(ri), rfactor, islog)
+        if key not in groups:
+            groups[key] = (ri, [], [])
+        groups[key][1].append(fi)
+        groups[key][2].append(_map.ravel())
+    
+    out = [np.nan * np.ones((len(filens), nbins)) for prof in profiles]
+    for (_, rfactor, islog), (ri, finds, maps) in groups.items():
+        starts, ends = ri.segments(rbins, factor=rfactor)
+        start0 = starts[0]
+        # single gather: (maps, pixels in the rbins range)
+        vals = np.array(maps)[:, ri.order[start0: ends[-1]]]
+        del maps
+        counts = ends - starts
+        hasvals = counts > 0
+        segstarts = starts[hasvals] - start0
+        finds = np.array(finds)
+        def segsum(_vals):
+            _out = np.nan * np.ones((_vals.shape[0], nbins))
+            if len(segstarts) > 0:
+                _out[:, hasvals] = np.add.reduceat(_vals, segstarts, 
+                                                   axis=1)
+            return _out
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for pi, prof in enumerate(profiles):
+                if prof == 'av-lin':
+                    _pr = segsum(10**vals if islog else vals) / counts
+                    if islog:
+                        _pr = np.log10(_pr)
+                elif prof == 'av-log':
+                    _pr = segsum(vals if islog else np.log10(vals)) \
+                          / counts
+                    if not islog:
+                        _pr = 10**_pr
+                elif prof in ['min', 'max']:
+                    _pr = np.nan * np.ones((vals.shape[0], nbins))
+                    if len(segstarts) > 0:
+                        func = np.minimum if prof == 'min' else np.maximum
+                        _pr[:, hasvals] = func.reduceat(vals, segstarts, 
+                                                        axis=1)
+                elif prof.startswith('perc-'):
+                    pv = float(prof.split('-')[-1])
+                    _pr = np.nan * np.ones((vals.shape[0], nbins))
+                    for bi in np.where(hasvals)[0]:
+                        _pr[:, bi] = np.quantile(
+                            vals[:, starts[bi] - start0: ends[bi] - start0],
+                            pv, axis=1)
+                elif prof.startswith('fcov-'):
+                    pv = float(prof.split('-')[-1])
+                    _pr = segsum((vals >= pv).astype(np.float64)) / counts
+                else:
+                    raise ValueError('Invalid profile option {}'.format(prof))
+                out[pi][finds, :] = _pr
+    return out
+
+def _histpercentiles(hist, edges, percentiles):
+    '''
+    percentiles from a histogram, linearly interpolated within bins.
+    hist includes counts below the first (index 0) and at or above the
+    last edge (index -1); percentiles falling there are returned as 
+    -np.inf and np.inf, respectively.
+    '''
+    total = np.sum(hist)
+    out = np.nan * np.ones(len(percentiles))
+    if total == 0:
+        return out
+    cumul = np.cumsum(hist)
+    for pi, perc in enumerate(percentiles):
+        target = perc * total
+        bi = np.searchsorted(cumul, target, side='left')
+        if bi == 0:
+            out[pi] = -np.inf
+        elif bi >= len(edges):
+            out[pi] = np.inf
+        else:
+            # histogram index bi covers edges[bi - 1] -- edges[bi]
+            below = cumul[bi - 1]
+            frac = (target - below) / hist[bi]
+            out[pi] = edges[bi - 1] + frac * (edges[bi] - edges[bi - 1])
+    return out
+
+def get_profile_radprof(filen, profiles=[], weightmap=False):
+    '''
+    get impact parameter profiles from the annular statistics stored 
+    with the maps (makemap.massmap radprof option), combined over the 
+    files if multiple are given, weighted by map pixel. This does not
+    need to read in the maps themselves.
+
+    Parameters:
+    -----------
+    filen: str or iterable of strings
+        name(s) of the file(s) containing the map (with full path).
+        All files must use the same impact parameter bins.
+    profiles: iterable of strings
+        which profiles to extract. Returned in order of input
+        options are:
+            'av-lin' (linear average), 
+            'av-log' (log-space average),
+            'perc-<float>' (percentile, values 0 -- 1). For single 
+                maps, stored percentiles are exact; otherwise, these
+                are interpolated from the stored histograms
+            'min' (minimum)
+            'max' (maximum)
+            'fcov-<float>' (fraction of values >= given value; must be
+                one of the stored thresholds)
+    weightmap: bool
+        get the profiles for the weightmap instead of the map
+    Returns:
+    --------
+    rbins: float array
+        the impact parameter bin edges
+    rbin_units: str
+        units of rbins
+    profiles: each an array of floats
+        the profile values in each radial bin
+    '''
+    if isinstance(filen, type('')):
+        filens = [filen]
+    else:
+        filens = filen
+    grpn = 'radprof_weightmap' if weightmap else 'radprof_map'
+    for fi, _filen in enumerate(filens):
+        with h5py.File(_filen, 'r') as f:
+            grp = f[grpn]
+            _rbins = grp['rbins'][:]
+            _rbin_units = grp['rbins'].attrs['units'].decode()
+            _st = {key: grp[key][:] for key in 
+                   ['npix', 'sum_lin', 'sum_log', 'min', 'max', 'perc', 
+                    'fcov', 'hist', 'hist_edges']}
+            _st['percentiles'] = grp['perc'].attrs['percentiles']
+            _st['thresholds'] = grp['fcov'].attrs['thresholds']
+            _islog = bool(grp.attrs['log'])
+        if fi == 0:
+            rbins = _rbins
+            rbin_units = _rbin_units
+            st = _st
+            islog = _islog
+            continue
+        if _islog != islog:
+            msg = 'Different files have log vs. non-log map values'
+            raise RuntimeError(msg)
+        if not (np.allclose(rbins, _rbins) and rbin_units == _rbin_units):
+            msg = 'Files {} and {} have different impact parameter bins'
+            raise ValueError(msg.format(filens[0], _filen))
+        st = combine_annularstats(st, _st)
+    out = profiles_annularstats(st, islog, profiles)
+    return rbins, rbin_units, out
+
+def combine_annularstats(st1, st2):
+    '''
+    combine makemap.annularstats outputs for two maps (or sets of 
+    maps) with the same impact parameter bins, weighted by map pixel.
+    The dictionaries should also contain the covering fraction 
+    'thresholds'; only thresholds in both are kept. Exact percentiles
+    cannot be combined, so 'perc' is set to None (profiles_annularstats
+    then uses the histograms).
+    '''
+    st1 = st1.copy()
+    st2 = st2.copy()
+    thresholds = np.asarray(st1['thresholds'])
+    _thresholds = np.asarray(st2['thresholds'])
+    if not (len(thresholds) == len(_thresholds) 
+            and np.allclose(thresholds, _thresholds)):
+        # only keep common thresholds
+        keep = np.array([np.any(np.isclose(th, _thresholds)) 
+                         for th in thresholds], dtype=bool)
+        _keep = np.array([np.any(np.isclose(th, thresholds)) 
+                          for th in _thresholds], dtype=bool)
+        thresholds = thresholds[keep]
+        st1['fcov'] = st1['fcov'][:, keep]
+        st2['fcov'] = st2['fcov'][:, _keep]
+    st = {'thresholds': thresholds, 'perc': None}
+    # covering fractions -> counts
+    st['fcov'] = st1['fcov'] * st1['npix'][:, np.newaxis] \
+                 + st2['fcov'] * st2['npix'][:, np.newaxis]
+    st['npix'] = st1['npix'] + st2['npix']
+    with np.errstate(invalid='ignore'):
+        st['fcov'] /= st['npix'][:, np.newaxis]
+    if 'npix_nan' in st1 and 'npix_nan' in st2:
+        st['npix_nan'] = st1['npix_nan'] + st2['npix_nan']
+    st['sum_lin'] = st1['sum_lin'] + st2['sum_lin']
+    st['sum_log'] = st1['sum_log'] + st2['sum_log']
+    st['min'] = np.fmin(st1['min'], st2['min'])
+    st['max'] = np.fmax(st1['max'], st2['max'])
+    st['hist'], st['hist_edges'] = _combinehists(st1['hist'], 
+                                                 st1['hist_edges'],
+                                                 st2['hist'], 
+                                                 st2['hist_edges'])
+    return st
+
+def profiles_annularstats(st, islog, profiles):
+    '''
+    get impact parameter profiles (options as for get_profile_radprof) 
+    from (combined) makemap.annularstats output. For percentiles, the
+    exact values are used if st['perc'] is not None and includes them
+    (st['percentiles']), otherwise, they are interpolated from the 
+    histograms. Covering fraction thresholds must be in 
+    st['thresholds'].
+    '''
+    thresholds = st['thresholds']
+    out = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for prof in profiles:
+            if prof == 'av-lin':
+                _pr = st['sum_lin'] / st['npix']
+                if islog:
+                    _pr = np.log10(_pr)
+            elif prof == 'av-log':
+                _pr = st['sum_log'] / st['npix']
+                if not islog:
+                    _pr = 10**_pr
+            elif prof == 'max':
+                _pr = st['max']
+            elif prof == 'min':
+                _pr = st['min']
+            elif prof.startswith('perc-'):
+                pv = float(prof.split('-')[-1])
+                if st['perc'] is not None:
+                    match = np.isclose(pv, st['percentiles'])
+                else:
+                    match = np.array([False])
+                if np.any(match):
+                    _pr = st['perc'][:, np.where(match)[0][0]]
+                else:
+                    _pr = np.array([_histpercentiles(_hist, 
+                                                     st['hist_edges'], 
+                                                     [pv])[0]
+                                    for _hist in st['hist']])
+            elif prof.startswith('fcov-'):
+                pv = float(prof.split('-')[-1])
+                match = np.isclose(pv, thresholds)
+                if not np.any(match):
+                    msg = ('Covering fraction threshold {} was not stored;'
+                           ' options are {}')
+                    raise ValueError(msg.format(pv, thresholds))
+                _pr = st['fcov'][:, np.where(match)[0][0]]
+            else:
+                raise ValueError('Invalid profile option {}'.format(prof))
+            out.append(_pr)
+    return out
+
+def _combinehists(hist1, edges1, hist2, edges2):
+    '''
+    add histograms from annularstats. Bin edges must be the same, 
+    or on the same grid (default binning with the same bin size).
+    '''
+    if len(edges1) == len(edges2) and np.allclose(edges1, edges2):
+        return hist1 + hist2, edges1
+    binsize = edges1[1] - edges1[0] if len(edges1) > 1 else None
+    if binsize is None or len(edges2) < 2 \
+            or not np.isclose(edges2[1] - edges2[0], binsize):
+        raise ValueError('Cannot combine histograms with different bins')
+    i1 = int(np.round(edges1[0] / binsize))
+    i2 = int(np.round(edges2[0] / binsize))
+    if not (np.isclose(edges1[0], i1 * binsize) 
+            and np.isclose(edges2[0], i2 * binsize)):
+        raise ValueError('Cannot combine histograms with different bins')
+    imin = min(i1, i2)
+    imax = max(i1 + len(edges1), i2 + len(edges2))
+    edges = np.arange(imin, imax) * binsize
+    hist = np.zeros((hist1.shape[0], len(edges) + 1), dtype=hist1.dtype)
+    for _hist, _i in [(hist1, i1), (hist2, i2)]:
+        # under- and overflow bins stay at the ends
+        hist[:, 0] += _hist[:, 0]
+        hist[:, -1] += _hist[:, -1]
+        start = _i - imin + 1
+        hist[:, start: start + _hist.shape[1] - 2] += _hist[:, 1:-1]
+    return hist, edges
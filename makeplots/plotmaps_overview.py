@@ -7,17 +7,25 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gsp
 import numpy as np
 
+import fire_an.makeplots.get_2dprof as gpr
 import fire_an.makeplots.plot_utils as pu
 import fire_an.simlists as sl
 import fire_an.utils.constants_and_units as c
 
-def readmap(filen, weightmap=False):
+def readmap(filen, weightmap=False, level=0):
+    '''
+    level: coarser map level to read (if stored), 0 for the 
+    full-resolution map. See get_2dprof.readmap.
+    '''
     with h5py.File(filen, 'r') as f:
         if weightmap:
             mapkey = 'weightmap'
         else:
             mapkey = 'map'
-        _map = f[mapkey][:]
+        if level > 0:
+            mapkey = f'{mapkey}_pyramid/level{level}'
+        _map, pixsize_pkpc, center_pix, _ = gpr.readmap(
+            f, weightmap=weightmap, level=level)
         vmin = f[mapkey].attrs['minfinite']
         vmax = f[mapkey].attrs['max']
 
@@ -36,14 +44,21 @@ def readmap(filen, weightmap=False):
         box_pkpc = box_cm / (1e-3 * c.cm_per_mpc)
         extent = (-0.5 * box_pkpc[xax], 0.5 * box_pkpc[xax],
                   -0.5 * box_pkpc[yax], 0.5 * box_pkpc[yax])
+        if level > 0:
+            # edge pixels may extend past the full-resolution map 
+            extent = (-center_pix[0] * pixsize_pkpc, 
+                      (_map.shape[0] - center_pix[0]) * pixsize_pkpc,
+                      -center_pix[1] * pixsize_pkpc, 
+                      (_map.shape[1] - center_pix[1]) * pixsize_pkpc)
     out = {'map': _map, 'vmin': vmin, 'vmax': vmax,
            'rvir_pkpc': rvir_pkpc, 'extent': extent}
     return out    
 
 def plotmaps(filens, clabel, ctrans=13.3, sizeindic_pkpc=50., weightmap=False,
-             axtitles=None, outname=None, vmin=None, vmax=None):
+             axtitles=None, outname=None, vmin=None, vmax=None, level=0):
 
-    mapdata = [readmap(filen, weightmap=weightmap) for filen in filens]
+    mapdata = [readmap(filen, weightmap=weightmap, level=level) 
+               for filen in filens]
     if vmin is None:
         vmin = min([md['vmin'] for md in mapdata])
     if vmax is None:
@@ -0,0 +1,385 @@
+'''
+Stacking massmap outputs (makemap.massmap) for ensembles of haloes:
+different simulations, ICs, line-of-sight axes, and redshifts.
+
+Impact parameter distributions are stacked from per-map reductions
+(makemap.annularstats: pixel counts, sums, histograms, and covering
+fraction counts in impact parameter bins), which are combined
+across maps. These reductions are cached per map file in
+opts_locs.dir_mapstackcache, keyed by a hash of the file contents and
+the reduction parameters, so adding maps to a stack only requires
+processing the new files.
+
+Pixel-by-pixel stacks (mean, median, covering fraction maps) are
+calculated in blocks of map rows, reading only those rows from each
+file, so memory use does not scale with the full stack size.
+
+File reductions and map blocks can be processed in parallel.
+'''
+
+import concurrent.futures as cf
+import glob
+import hashlib
+import h5py
+import numpy as np
+import os
+
+import fire_an.mainfunc.makemap as mm
+import fire_an.makeplots.get_2dprof as gpr
+import fire_an.utils.opts_locs as ol
+
+
+def select_mapfiles(pattern=None, filen_template=None, simnames=None,
+                    snapnums=None, axes=None):
+    '''
+    get a list of map files to stack, from a glob pattern or a file
+    name template and simulation list
+
+    Parameters:
+    -----------
+    pattern: str or None
+        glob pattern for the file names (including the full path)
+    filen_template: str or None
+        file name (including the full path) with any of '{simname}',
+        '{snapnum}', and '{ax}' to fill in with all combinations of
+        simnames, snapnums, and axes. Files that do not exist are
+        skipped (with a message).
+    simnames: list of str or None
+        e.g., from simlists
+    snapnums: list of int or None
+        snapshot numbers
+    axes: list of str or None
+        line-of-sight axes ('x', 'y', 'z')
+
+    Returns:
+    --------
+    filens: list of str
+        the map files
+    '''
+    if (pattern is None) == (filen_template is None):
+        raise ValueError('Specify one of pattern and filen_template')
+    if pattern is not None:
+        return sorted(glob.glob(pattern))
+    filens = []
+    for simname in ([None] if simnames is None else simnames):
+        for snapnum in ([None] if snapnums is None else snapnums):
+            for ax in ([None] if axes is None else axes):
+                filen = filen_template.format(simname=simname,
+                                              snapnum=snapnum, ax=ax)
+                if os.path.isfile(filen):
+                    filens.append(filen)
+                else:
+                    print('Skipping {}: file not found'.format(filen))
+    return filens
+
+def filehash(filen, blocksize=2**24):
+    '''
+    md5 hash (hex string) of a file's contents
+    '''
+    md5 = hashlib.md5()
+    with open(filen, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+def _reductionpars(rbins, rbin_units, weightmap, level, thresholds,
+                   hist_binsize, hist_edges):
+    '''
+    the per-file reduction parameters and their hash (for the cache)
+    '''
+    pars = {'rbins': np.asarray(rbins, dtype=np.float64),
+            'rbin_units': rbin_units, 'weightmap': bool(weightmap),
+            'level': int(level),
+            'thresholds': np.array(sorted(thresholds), dtype=np.float64),
+            'hist_binsize': hist_binsize,
+            'hist_edges': None if hist_edges is None else
+                          np.asarray(hist_edges, dtype=np.float64)}
+    md5 = hashlib.md5()
+    for key in sorted(pars):
+        val = pars[key]
+        md5.update(key.encode())
+        if isinstance(val, np.ndarray):
+            md5.update(val.tobytes())
+        else:
+            md5.update(repr(val).encode())
+    return pars, md5.hexdigest()[:12]
+
+def reduce_mapfile(filen, pars, parhash, usecache=True, cachedir=None):
+    '''
+    get the annularstats reduction of one map file, from the cache if
+    available
+
+    Parameters:
+    -----------
+    filen: str
+        the map file (including the full path)
+    pars, parhash:
+        reduction parameters and their hash (_reductionpars)
+    usecache: bool
+        read the reduction from, and save it to, the cache
+    cachedir: str or None
+        cache directory. The default is opts_locs.dir_mapstackcache.
+
+    Returns:
+    --------
+    st: dict
+        makemap.annularstats output, plus the map properties 'islog'
+        and 'thresholds'
+    '''
+    if cachedir is None:
+        cachedir = ol.dir_mapstackcache
+    if usecache:
+        cachefilen = os.path.join(cachedir, '{}_{}.hdf5'.format(
+                                  filehash(filen), parhash))
+        if os.path.isfile(cachefilen):
+            with h5py.File(cachefilen, 'r') as f:
+                st = {key: f[key][:] for key in f}
+                st['islog'] = bool(f.attrs['islog'])
+            st['perc'] = None
+            return st
+    with h5py.File(filen, 'r') as f:
+        mmap, pixsize_pkpc, center_pix, islog = gpr.readmap(
+            f, weightmap=pars['weightmap'], level=pars['level'])
+        rfactor = gpr._rfactor(f, pixsize_pkpc, pars['rbin_units'])
+    ri = gpr.get_radiusindex(mmap.shape, center_pix)
+    rpix = ri.dpix.copy()
+    rpix *= rfactor
+    st = mm.annularstats(mmap, islog, rpix, pars['rbins'], percentiles=(),
+                         thresholds=pars['thresholds'],
+                         hist_binsize=pars['hist_binsize'],
+                         hist_edges=pars['hist_edges'])
+    del mmap, rpix
+    st['thresholds'] = pars['thresholds']
+    st['perc'] = None
+    st['islog'] = islog
+    if usecache:
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            # write to a temporary file first: other processes might
+            # be reading the cache
+            tempfilen = cachefilen + '.{}.tmp'.format(os.getpid())
+            with h5py.File(tempfilen, 'w') as f:
+                for key in st:
+                    if key in ['perc', 'islog']:
+                        continue
+                    f.create_dataset(key, data=st[key])
+                f.attrs.create('islog', islog)
+                f.attrs.create('mapfile', np.string_(filen))
+                _info = ('makemap.annularstats output for mapfile, '
+                         'for use in stacks (makeplots.stackmaps)')
+                f.attrs.create('info', np.string_(_info))
+            os.replace(tempfilen, cachefilen)
+        except OSError as err:
+            print('Warning: could not save map reduction '
+                  '{}:\n{}'.format(cachefilen, err))
+    return st
+
+def stack_profiles(filens, rbins, rbin_units='pkpc', profiles=[],
+                   weightmap=False, level=0, thresholds=(),
+                   hist_binsize=None, hist_edges=None, nproc=1,
+                   usecache=True, cachedir=None):
+    '''
+    get impact parameter profiles for a stack of maps, weighted by
+    map pixel (as get_2dprof.get_profile_massmap for multiple files).
+
+    Parameters:
+    -----------
+    filens: list of str
+        the map files (including the full path); see select_mapfiles
+    rbins: float array
+        impact parameter bin edges
+    rbin_units: {'pkpc', 'Rvir', 'cm'}
+        units of rbins
+    profiles: iterable of strings
+        which profiles to get; options as for
+        get_2dprof.get_profile_radprof. Percentiles are interpolated
+        from histograms of the map values, with bin size
+        hist_binsize. Covering fraction thresholds ('fcov-<float>')
+        are added to thresholds.
+    weightmap: bool
+        stack the weightmaps instead of the maps
+    level: int
+        map resolution level (see get_2dprof.readmap)
+    thresholds: iterable of floats
+        covering fraction thresholds to get, in addition to those in
+        profiles (the reductions are cached for all of them)
+    hist_binsize: float or None
+        histogram bin size for the map values (percentiles). The
+        default is 0.01 for log maps; for linear maps, this should
+        be set, since the default depends on the map value range.
+    hist_edges: float array or None
+        histogram bin edges (overrides hist_binsize)
+    nproc: int
+        number of processes for the per-file reductions
+    usecache: bool
+        use and store cached per-file reductions
+    cachedir: str or None
+        cache directory. The default is opts_locs.dir_mapstackcache.
+
+    Returns:
+    --------
+    profiles: each an array of floats
+        the profile values in each radial bin
+    '''
+    thresholds = set(thresholds)
+    for prof in profiles:
+        if prof.startswith('fcov-'):
+            thresholds.add(float(prof.split('-')[-1]))
+    pars, parhash = _reductionpars(rbins, rbin_units, weightmap, level,
+                                   thresholds, hist_binsize, hist_edges)
+    if len(filens) == 0:
+        raise ValueError('No files to stack')
+    if nproc == 1:
+        sts = (reduce_mapfile(filen, pars, parhash, usecache=usecache,
+                              cachedir=cachedir)
+               for filen in filens)
+        st = _combinestack(sts, filens)
+    else:
+        with cf.ProcessPoolExecutor(max_workers=nproc) as ex:
+            # map keeps the file order
+            sts = ex.map(reduce_mapfile, filens, [pars] * len(filens),
+                         [parhash] * len(filens),
+                         [usecache] * len(filens),
+                         [cachedir] * len(filens))
+            st = _combinestack(sts, filens)
+    return gpr.profiles_annularstats(st, st['islog'], profiles)
+
+def _combinestack(sts, filens):
+    '''
+    combine the per-file reductions (iterable) for stack_profiles
+    '''
+    for fi, _st in enumerate(sts):
+        if fi == 0:
+            st = _st
+            islog = _st['islog']
+            continue
+        if _st['islog'] != islog:
+            msg = 'Files {} and {} have log vs. non-log map values'
+            raise ValueError(msg.format(filens[0], filens[fi]))
+        st = gpr.combine_annularstats(st, _st)
+    st['islog'] = islog
+    return st
+
+def _stackblock(filens, name, ix0, ix1, stats):
+    '''
+    pixel-by-pixel statistics for map rows ix0:ix1 of all files
+    '''
+    vals = []
+    for filen in filens:
+        with h5py.File(filen, 'r') as f:
+            ds = f[name]
+            vals.append(ds[ix0: ix1].astype(np.float64))
+            islog = bool(ds.attrs['log'])
+    vals = np.array(vals)
+    out = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for stat in stats:
+            if stat == 'av-lin':
+                _out = np.nanmean(10**vals if islog else vals, axis=0)
+                if islog:
+                    _out = np.log10(_out)
+            elif stat == 'av-log':
+                _out = np.nanmean(vals if islog else np.log10(vals),
+                                  axis=0)
+                if not islog:
+                    _out = 10**_out
+            elif stat == 'min':
+                _out = np.nanmin(vals, axis=0)
+            elif stat == 'max':
+                _out = np.nanmax(vals, axis=0)
+            elif stat.startswith('perc-'):
+                pv = float(stat.split('-')[-1])
+                _out = np.nanquantile(vals, pv, axis=0)
+            elif stat.startswith('fcov-'):
+                pv = float(stat.split('-')[-1])
+                count = np.sum(np.logical_not(np.isnan(vals)), axis=0)
+                _out = np.sum(vals >= pv, axis=0) / count
+            else:
+                raise ValueError('Invalid stack option {}'.format(stat))
+            out.append(_out)
+    return ix0, ix1, out
+
+def stack_maps(filens, stats=('av-lin', 'perc-0.5'), weightmap=False,
+               level=0, blockrows=64, nproc=1):
+    '''
+    pixel-by-pixel stacks of maps with the same shape and pixel size,
+    e.g., for the same halo at different times or along different
+    axes, or haloes with similar sizes. Maps are centered on the
+    halo. NaN values (e.g., masked weighted maps) are ignored.
+
+    Parameters:
+    -----------
+    filens: list of str
+        the map files (including the full path); see select_mapfiles
+    stats: iterable of str
+        which statistics to get for each pixel:
+        'av-lin' (linear average),
+        'av-log' (log-space average),
+        'perc-<float>' (percentile, values 0 -- 1; 'perc-0.5' is the
+            median)
+        'min' (minimum)
+        'max' (maximum)
+        'fcov-<float>' (fraction of maps with values >= given value)
+    weightmap: bool
+        stack the weightmaps instead of the maps
+    level: int
+        map resolution level (see get_2dprof.readmap)
+    blockrows: int
+        number of map rows to process at a time
+    nproc: int
+        number of processes (row blocks are processed in parallel)
+
+    Returns:
+    --------
+    maps: list of 2D float arrays
+        the stacked maps for each of stats. For 'av-lin', 'av-log',
+        'min', 'max', and 'perc-<float>', these are log10 values if
+        the input maps are.
+    '''
+    if len(filens) == 0:
+        raise ValueError('No files to stack')
+    name = 'weightmap' if weightmap else 'map'
+    if level > 0:
+        name = f'{name}_pyramid/level{level}'
+    shape = None
+    for filen in filens:
+        with h5py.File(filen, 'r') as f:
+            if name not in f:
+                msg = 'Map {} is not stored in {}'
+                raise ValueError(msg.format(name, filen))
+            _shape = f[name].shape
+            if level == 0:
+                _pixsize = f['Header/inputpars'].attrs['pixsize_pkpc']
+            else:
+                _pixsize = f[name].attrs['pixsize_pkpc']
+        if shape is None:
+            shape = _shape
+            pixsize = _pixsize
+        elif _shape != shape or not np.isclose(_pixsize, pixsize):
+            msg = ('Map {} has a different shape or pixel size than {}: '
+                   '{}, {} pkpc vs. {}, {} pkpc')
+            raise ValueError(msg.format(filen, filens[0], _shape, _pixsize,
+                                        shape, pixsize))
+    out = [np.zeros(shape, dtype=np.float64) for stat in stats]
+    blocks = [(ix0, min(ix0 + blockrows, shape[0]))
+              for ix0 in range(0, shape[0], blockrows)]
+    if nproc == 1:
+        results = (_stackblock(filens, name, ix0, ix1, stats)
+                   for ix0, ix1 in blocks)
+        for ix0, ix1, _out in results:
+            for si in range(len(stats)):
+                out[si][ix0: ix1] = _out[si]
+    else:
+        with cf.ProcessPoolExecutor(max_workers=nproc) as ex:
+            futures = [ex.submit(_stackblock, filens, name, ix0, ix1,
+                                 stats)
+                       for ix0, ix1 in blocks]
+            for future in cf.as_completed(futures):
+                ix0, ix1, _out = future.result()
+                for si in range(len(stats)):
+                    out[si][ix0: ix1] = _out[si]
+    return out
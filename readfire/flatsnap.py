@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Extract snapshot fields to flat binary files, one file per field 
+(so each array starts at a page boundary), with a JSON manifest 
+describing the arrays (dtype, shape, CGS conversion) and the snapshot
+(cosmological parameters, particle numbers, metallicity array 
+columns). The extracted snapshot is read in with 
+readin_fire_data.Flatsnap, which returns np.memmap views of the files.
+
+This is meant for snapshots that are analysed many times (e.g., maps
+for many ions and axes): after the first read-in, the data are served
+from the page cache without HDF5 decoding or copies.
+'''
+
+import hashlib
+import json
+import numpy as np
+import os
+
+import fire_an.readfire.readin_fire_data as rf
+import fire_an.utils.opts_locs as ol
+
+
+def flatsnap_dir(snap, outdir=None):
+    '''
+    default directory for the extracted fields of a snapshot 
+    (Firesnap object)
+    '''
+    if outdir is None:
+        outdir = ol.dir_snapsidecars
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    snapfile = os.path.abspath(snap.firstfilen)
+    # snapshot file names are only unique with the directory path
+    tag = hashlib.md5(snapfile.encode()).hexdigest()[:12]
+    base = os.path.basename(snapfile).split('.')[0]
+    return outdir + f'flatsnap_{base}_{tag}/'
+
+def _metallicity_atomnos(snap):
+    if 'name_to_atomnumber' in snap.ff['Header'].attrs:
+        atomnos = snap.ff['Header'].attrs['name_to_atomnumber']
+    else:
+        atomnos = rf.standard_atomno_indices
+    return [int(atomno) for atomno in atomnos]
+
+def extract_flatsnap(snap, fields, outdir=None, blocksize=2**24,
+                     overwrite=False):
+    '''
+    extract snapshot fields to flat binary files. Fields can be added 
+    to an existing extraction of the same snapshot.
+
+    Parameters:
+    -----------
+    snap: Firesnap object
+        the snapshot to extract the fields from. The fields are stored
+        with the data types this object reads them in as (see the 
+        Firesnap floattype option).
+    fields: list of str
+        the fields to extract (full paths to the datasets in the hdf5
+        file, e.g., 'PartType0/Coordinates'). These should be stored
+        fields; derived fields (e.g., temperature) are calculated by 
+        Flatsnap from the extracted fields they depend on.
+    outdir: str or None
+        directory to store the files and manifest in. If None, the
+        flatsnap_dir default is used.
+    blocksize: int
+        number of particles to read in and write at a time
+    overwrite: bool
+        re-extract fields that are already present (True), or skip 
+        them (False)
+
+    Returns:
+    --------
+    manifestfilen: str
+        the manifest file name (including the full path); this can be
+        passed to Flatsnap
+    '''
+    if outdir is None:
+        outdir = flatsnap_dir(snap)
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifestfilen = outdir + rf.flatsnap_manifest
+    
+    numpart_total = snap.ff['Header'].attrs['NumPart_Total']
+    numpart_total = [int(snap.get_fileoffsets(pt)[-1]) 
+                     for pt in range(len(numpart_total))]
+    if os.path.isfile(manifestfilen):
+        with open(manifestfilen, 'r') as f:
+            manifest = json.load(f)
+        if manifest['snapfiles'] != list(snap.filens) \
+                or manifest['NumPart_Total'] != numpart_total:
+            msg = ('The flat snapshot files in {} are for snapshot {}, '
+                   'not {}')
+            raise ValueError(msg.format(outdir, manifest['snapfiles'][0],
+                                        snap.firstfilen))
+    else:
+        manifest = {'format': 'fire_an flatsnap',
+                    'version': 1,
+                    'snapfiles': list(snap.filens),
+                    'parameterfile': snap.parfilen,
+                    'cosmopars': {key: float(val) for key, val in 
+                                  snap.cosmopars.getdct().items()},
+                    'NumPart_Total': numpart_total,
+                    'metallicity_atomnos': _metallicity_atomnos(snap),
+                    'fields': {}}
+    
+    for path in fields:
+        if path in manifest['fields'] and not overwrite:
+            print(f'Skipping {path}: already extracted')
+            continue
+        parttype = int(path.split('/')[0][-1])
+        numpart = numpart_total[parttype]
+        if numpart == 0:
+            print(f'Skipping {path}: no PartType{parttype} particles')
+            continue
+        filen = path.replace('/', '_') + '.bin'
+        mm = None
+        for start in range(0, numpart, blocksize):
+            stop = min(start + blocksize, numpart)
+            block = snap.readarray_slice(path, start, stop)
+            if mm is None:
+                dtype = block.dtype
+                shape = (numpart,) + block.shape[1:]
+                mm = np.memmap(outdir + filen, dtype=dtype, mode='w+', 
+                               shape=shape)
+            mm[start: stop] = block
+            del block
+        toCGS = snap.toCGS
+        mm.flush()
+        del mm
+        manifest['fields'][path] = {'file': filen,
+                                    'dtype': dtype.str,
+                                    'shape': [int(dim) for dim in shape],
+                                    'toCGS': float(toCGS)}
+        print(f'Extracted {path} to {outdir + filen}')
+        # keep the manifest consistent with the files written so far
+        _tempfilen = manifestfilen + '.tmp'
+        with open(_tempfilen, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(_tempfilen, manifestfilen)
+    return manifestfilen
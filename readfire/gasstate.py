@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Gas state 'sidecar' files for FIRE snapshots: the derived gas
+properties used to interpolate ion balance tables (log temperature,
+log hydrogen number density, log metallicity) are stored for all
+PartType0 particles, in CGS units, as float32. These are slow to
+calculate from the stored fields (internal energy, electron
+abundance, helium and hydrogen mass fractions, density), and the
+same values are needed for every ion.
+
+The files are made with mainfunc.get_qty.make_gasstate;
+get_qty.get_ionfrac_inputs (and so get_ionfrac, get_ionfracs, and
+get_qty ion quantities) use them if they exist. The snapshot file
+names, sizes, and modification times are stored with the data, and
+a file is ignored if these don't match the snapshot anymore.
+Snapshot objects without files (e.g., MockFireSpec) and setups
+without an opts_locs.dir_snapsidecars directory don't use gas state
+files.
+'''
+
+import h5py
+import hashlib
+import numpy as np
+import os
+
+import fire_an.utils.opts_locs as ol
+
+# logT: log10 K, lognH: log10 cm**-3, logZ: log10 metal mass fraction
+# (not solar-normalized)
+gasstate_fields = ['logT', 'lognH', 'logZ']
+
+def gasstate_filen(snap, outdir=None):
+    '''
+    default gas state file name for a snapshot (Firesnap object),
+    or None if there is no default directory
+    (opts_locs.dir_snapsidecars) or the snapshot has no files
+    '''
+    if outdir is None:
+        outdir = getattr(ol, 'dir_snapsidecars', None)
+    if outdir is None or not hasattr(snap, 'firstfilen'):
+        return None
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    snapfile = os.path.abspath(snap.firstfilen)
+    # snapshot file names are only unique with the directory path
+    tag = hashlib.md5(snapfile.encode()).hexdigest()[:12]
+    base = os.path.basename(snapfile).split('.')[0]
+    return outdir + f'gasstate_{base}_{tag}.hdf5'
+
+def snapfilestats(snap):
+    '''
+    sizes and modification times of the snapshot files
+    '''
+    stats = [os.stat(filen) for filen in snap.filens]
+    sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    mtimes = np.array([stat.st_mtime for stat in stats], dtype=np.float64)
+    return sizes, mtimes
+
+def write_gasstate(snap, arrays, outfilen=None, overwrite=False):
+    '''
+    store gas state arrays for a snapshot
+
+    Parameters:
+    -----------
+    snap: Firesnap object
+        the snapshot the arrays are for
+    arrays: dict of float arrays
+        arrays for all PartType0 particles, for the keys in
+        gasstate_fields. These are stored as float32.
+    outfilen: str or None
+        file to write to (including the full path). If None, the
+        gasstate_filen default is used.
+    overwrite: bool
+        overwrite an existing file (True) or raise a ValueError (False)
+
+    Returns:
+    --------
+    outfilen: str
+        the name of the gas state file
+    '''
+    if outfilen is None:
+        outfilen = gasstate_filen(snap)
+        if outfilen is None:
+            msg = ('No default gas state file for this snapshot; set '
+                   'opts_locs.dir_snapsidecars or give outfilen')
+            raise ValueError(msg)
+    if os.path.isfile(outfilen) and not overwrite:
+        raise ValueError('File {} already exists.'.format(outfilen))
+    numpart = snap.get_fileoffsets(0)[-1]
+    for field in gasstate_fields:
+        if len(arrays[field]) != numpart:
+            msg = ('{} array length {} does not match the number of '
+                   'PartType0 particles {}')
+            raise ValueError(msg.format(field, len(arrays[field]),
+                                        numpart))
+    outdir = os.path.dirname(outfilen)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    sizes, mtimes = snapfilestats(snap)
+    # write to a temporary file first: other processes might be
+    # reading the file
+    tempfilen = outfilen + '.{}.tmp'.format(os.getpid())
+    with h5py.File(tempfilen, 'w') as f:
+        for field in gasstate_fields:
+            f.create_dataset(field, data=arrays[field].astype(np.float32))
+        hed = f.create_group('Header')
+        hed.attrs.create('snapfiles',
+                         np.array([np.string_(filen)
+                                   for filen in snap.filens]))
+        hed.attrs.create('snapfilesizes', sizes)
+        hed.attrs.create('snapfilemtimes', mtimes)
+        hed.attrs.create('NumPart_Total', numpart)
+        _info = ('PartType0 gas properties for ion balance table '
+                 'interpolation, in CGS units: logT [log10 K], lognH '
+                 '[log10 cm**-3], logZ [log10 metal mass fraction, not '
+                 'normalized to solar; zero metallicity as -100.]')
+        hed.attrs.create('info', np.string_(_info))
+    os.replace(tempfilen, outfilen)
+    print(f'Saved gas state to {outfilen}')
+    return outfilen
+
+def gasstate_isvalid(snap, filen):
+    '''
+    check whether a gas state file exists and matches the snapshot
+    files (names, sizes, modification times, particle number)
+    '''
+    if not os.path.isfile(filen):
+        return False
+    try:
+        with h5py.File(filen, 'r') as f:
+            hed = f['Header']
+            snapfiles = [_filen.decode() for _filen in 
+                         hed.attrs['snapfiles']]
+            sizes = hed.attrs['snapfilesizes']
+            mtimes = hed.attrs['snapfilemtimes']
+            numpart = hed.attrs['NumPart_Total']
+    except (OSError, KeyError):
+        return False
+    if snapfiles != list(snap.filens):
+        return False
+    try:
+        _sizes, _mtimes = snapfilestats(snap)
+    except OSError:
+        return False
+    if not (np.array_equal(sizes, _sizes)
+            and np.array_equal(mtimes, _mtimes)):
+        return False
+    return numpart == snap.get_fileoffsets(0)[-1]
+
+def read_gasstate(snap, fields, filter=None, filen=None):
+    '''
+    read in stored gas state arrays for a snapshot, if there is a
+    valid gas state file
+
+    Parameters:
+    -----------
+    snap: Firesnap object
+        the snapshot
+    fields: list of str
+        the arrays to read in (from gasstate_fields)
+    filter: bool array, index array, slice, or None
+        selection of PartType0 particles to return
+    filen: str or None
+        the gas state file. If None, the gasstate_filen default is
+        used.
+
+    Returns:
+    --------
+    dict of float32 arrays or None
+        the arrays for each field (keys), or None if there is no
+        valid file
+    '''
+    if not hasattr(snap, 'filens'):
+        return None
+    if filen is None:
+        filen = gasstate_filen(snap)
+        if filen is None:
+            return None
+    if not gasstate_isvalid(snap, filen):
+        return None
+    if filter is None:
+        filter = slice(None, None, None)
+    out = {}
+    with h5py.File(filen, 'r') as f:
+        for field in fields:
+            if isinstance(filter, slice):
+                out[field] = f[field][filter]
+            else:
+                out[field] = f[field][:][filter]
+    print(f'Read {fields} from gas state file {filen}')
+    return out
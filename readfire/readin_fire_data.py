@@ -3,10 +3,16 @@
 
 # quest location FIRE data: /projects/b1026/snapshots
 
+from collections import OrderedDict
+import concurrent.futures as cf
 import h5py
+import json
 import os
 import numpy as np
+import tempfile
 
+import fire_an.readfire.snapcatalogue as sc
+import fire_an.readfire.spatialindex as si
 import fire_an.readfire.units_fire as uf
 import fire_an.utils.opts_locs as ol
 
@@ -16,6 +22,21 @@ def isstr(object): # should be python 2/3 robust
 def isbstr(object):
     return isinstance(object, bytes) 
 
+def _readdirect_mmap(filen, path, source_sel, dest_sel, mmapfilen, shape,
+                     dtype):
+    '''
+    worker function for parallel Firesnap.readarray: read part of the
+    dataset <path> in file <filen> into the memory-mapped array file
+    <mmapfilen>.
+    '''
+    arr = np.memmap(mmapfilen, dtype=np.dtype(dtype), mode='r+', 
+                    shape=shape)
+    with h5py.File(filen, 'r') as f:
+        f[path].read_direct(arr, source_sel=source_sel, dest_sel=dest_sel)
+    arr.flush()
+    del arr
+    return filen
+
 # setup from the internets
 class FieldNotFoundError(Exception):
     def __init__(self, *args):
@@ -54,7 +75,14 @@ atomnumber_to_name = {1:  'Hydrogen',
 name_to_atomnumber = {atomnumber_to_name[key]: key \
                       for key in atomnumber_to_name}
 standard_atomno_indices = [0, 2, 6, 7, 8, 10, 12, 14, 16, 20, 26]     
-gamma_gas = 5. / 3.                 
+gamma_gas = 5. / 3.
+# fields read in at the stored precision regardless of the Firesnap 
+# floattype: float32 positions are only good to ~1e-7 times the box
+# size, which can be comparable to the (zoom region) smoothing lengths
+fullprecision_fields = ('Coordinates',)
+# manifest file name for snapshots extracted to flat binary files
+# (readfire.flatsnap, Flatsnap)
+flatsnap_manifest = 'flatsnap_manifest.json'                 
                       
 
 class Cosmopars:
@@ -78,7 +106,8 @@ class Cosmopars:
         return dct
         
 class Firesnap:
-    def __init__(self, basename, parameterfile=None):
+    def __init__(self, basename, parameterfile=None, cache_maxbytes=None,
+                 numreaders=1, floattype=None, metadata=None):
         '''
         Parameters:
         -----------
@@ -89,12 +118,44 @@ class Firesnap:
         parameterfile: str
             name of the parameter file (including the full directory 
             path) used for the simulation we're using the snapshot of.
+        cache_maxbytes: int or None
+            if not None, keep arrays read in with readarray in memory
+            (up to this many bytes in total), so that repeated reads
+            of the same field don't go back to the files. The least
+            recently used arrays are dropped first when the budget is
+            exceeded. The default (None) means no caching.
+            With caching on, the arrays returned by readarray (and 
+            readarray_emulateEAGLE, readarray_elements) are the cached
+            ones: they are shared and read-only, so callers should 
+            copy them (e.g., np.require(arr, requirements='W')) before
+            modifying them in place.
+        numreaders: int
+            default number of processes to use for reading in arrays 
+            from split snapshots (one file per process at a time).
+            The default is 1 (serial read-in).
+        floattype: numpy floating-point type or None
+            if not None (e.g., np.float32), floating-point arrays are
+            read in as this type; the conversion happens during the 
+            HDF5 read-in, so no full-precision copy is made. Derived 
+            fields are calculated in this type as well. Fields in 
+            fullprecision_fields are kept at the stored precision.
+            None (default) means arrays are returned as stored.
+        metadata: dict or None
+            stored snapshot metadata (output of getmetadata; see 
+            readfire.snapcatalogue). If given, the file list, units,
+            and cosmological parameters are taken from this instead of
+            from the files, and basename and parameterfile are 
+            ignored.
         Returns:
         --------
         Firesnap object, for reading in datasets and attributes from
         FIRE snapshots. 
         '''
         
+        if metadata is not None:
+            self._init_from_metadata(metadata, cache_maxbytes, numreaders,
+                                     floattype)
+            return None
         done = False
         if os.path.isfile(basename):
             parts = basename.split('.')
@@ -121,6 +182,8 @@ class Firesnap:
             self.filens = [basename + '.{num}.hdf5'.format(num=i)
                            for i in range(self.numfiles)]
         
+        self.numreaders = numreaders
+        self.floattype = floattype
         self.parfilen = parameterfile
         if self.parfilen is not None:
             self.units = uf.Units(self.firstfilen, self.parfilen)
@@ -130,6 +193,109 @@ class Firesnap:
         # for quick attributes access
         self.ff = h5py.File(self.firstfilen, 'r')   
         self.find_cosmopars()
+        self.set_cache(cache_maxbytes)
+        self._fileoffsets = {}
+        self._spatialindices = {}
+    
+    def _init_from_metadata(self, metadata, cache_maxbytes, numreaders,
+                            floattype):
+        self.filens = list(metadata['filens'])
+        self.firstfilen = self.filens[0]
+        self.numfiles = len(self.filens)
+        self.numreaders = numreaders
+        self.floattype = floattype
+        self.parfilen = metadata['parameterfile']
+        self.units = uf.Units.fromdct(metadata['units'])
+        self.ff = h5py.File(self.firstfilen, 'r') 
+        self.cosmopars = Cosmopars(metadata['cosmopars'])
+        self.set_cache(cache_maxbytes)
+        self._fileoffsets = {}
+        self._spatialindices = {}
+
+    def getmetadata(self):
+        '''
+        get the snapshot metadata needed to recreate this object 
+        without file discovery or unit/header parsing (see the 
+        metadata argument), plus the redshift and total particle 
+        numbers, and the size and modification time of the first 
+        file. The dictionary is JSON-serializable.
+        '''
+        stat = os.stat(self.firstfilen)
+        metadata = {'filens': list(self.filens),
+                    'parameterfile': self.parfilen,
+                    'units': self.units.getdct(),
+                    'cosmopars': {key: float(val) for key, val in 
+                                  self.cosmopars.getdct().items()},
+                    'redshift': float(self.cosmopars.z),
+                    'NumPart_Total': [int(num) for num in 
+                        self.ff['Header'].attrs['NumPart_Total']],
+                    'firstfilesize': int(stat.st_size),
+                    'firstfilemtime': float(stat.st_mtime),
+                    }
+        return metadata
+
+    def set_cache(self, maxbytes):
+        '''
+        turn the readarray cache on (maxbytes: int, the memory budget
+        in bytes) or off (maxbytes: None). Any stored arrays are
+        dropped, and the hit/miss counters are reset.
+        '''
+        self.cache_maxbytes = maxbytes
+        self._cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    def clear_cache(self):
+        '''
+        drop all arrays stored in the readarray cache (counters are
+        kept)
+        '''
+        self._cache.clear()
+        self.cache_bytes = 0
+    
+    def cache_info(self):
+        '''
+        returns a dict with the readarray cache hits, misses, 
+        current size (bytes), maximum size (bytes) and number of 
+        stored arrays
+        '''
+        return {'hits': self.cache_hits, 
+                'misses': self.cache_misses,
+                'bytes': self.cache_bytes, 
+                'maxbytes': self.cache_maxbytes,
+                'numarrays': len(self._cache)}
+    
+    def _cache_get(self, key):
+        if self.cache_maxbytes is None:
+            return None
+        if key not in self._cache:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self._cache.move_to_end(key)
+        # shared, read-only array: no copy
+        return self._cache[key]
+
+    def _cache_drop(self, key):
+        if key in self._cache:
+            self.cache_bytes -= self._cache.pop(key)[0].nbytes
+    
+    def _cache_put(self, key, arr, toCGS):
+        if self.cache_maxbytes is None:
+            return None
+        if arr.nbytes > self.cache_maxbytes:
+            return None
+        if key in self._cache:
+            self.cache_bytes -= self._cache.pop(key)[0].nbytes
+        while self.cache_bytes + arr.nbytes > self.cache_maxbytes:
+            _key, (_arr, _toCGS) = self._cache.popitem(last=False)
+            self.cache_bytes -= _arr.nbytes
+        # the caller gets the same array: stored without a copy, 
+        # so in-place changes are blocked instead
+        arr.flags.writeable = False
+        self._cache[key] = (arr, toCGS)
+        self.cache_bytes += arr.nbytes
         
     def readattr(self, path, attribute):
         '''
@@ -212,7 +378,30 @@ class Firesnap:
         return partdict
     
     # read-in and subsampling tested
-    def readarray(self, path, subsample=1, errorflag=np.nan, subindex=None):
+    def _readdtype(self, path, dtype):
+        '''
+        the data type to read a dataset with stored type dtype into, 
+        following the floattype setting
+        '''
+        dtype = np.dtype(dtype)
+        if self.floattype is None or dtype.kind != 'f':
+            return dtype
+        if path.split('/')[-1] in fullprecision_fields:
+            return dtype
+        return np.dtype(self.floattype)
+
+    def _castfloat(self, field, arr):
+        '''
+        convert a (calculated) floating-point array to the floattype
+        '''
+        if self.floattype is None or arr.dtype.kind != 'f':
+            return arr
+        if field.split('/')[-1] in fullprecision_fields:
+            return arr
+        return arr.astype(self.floattype, copy=False)
+
+    def readarray(self, path, subsample=1, errorflag=np.nan, subindex=None,
+                  numreaders=None, usecache=True):
         '''
         read in an array from the snapshot file
         note that subsample read-ins are slow
@@ -232,6 +421,17 @@ class Firesnap:
         subindex: int or None
             specific index to read in if the array is 2D instead of 1D
             (e.g., only read in the X coordinates -> subindex=0)
+        numreaders: int or None
+            number of processes to read the different files of a 
+            split snapshot with, each filling a different part of the
+            output array. None means the numreaders value set for the
+            Firesnap object is used. Ignored for single-file snapshots.
+        usecache: bool
+            if False, the readarray cache is not used: the array is 
+            read from the files and not stored, and any stored copy is
+            dropped. The returned array is then writable and not 
+            shared, e.g., for modification in place without a second 
+            full-size copy.
 
         Returns:
         --------
@@ -245,6 +445,15 @@ class Firesnap:
         # overwrite and old values to avoid undetected errors
         self.toCGS = np.NaN 
         
+        cachekey = (path, subsample, subindex)
+        if usecache:
+            cached = self._cache_get(cachekey)
+            if cached is not None:
+                arr, self.toCGS = cached
+                return arr
+        else:
+            self._cache_drop(cachekey)
+        
         # simple h5py read
         if self.numfiles == 1:
             if path not in self.ff:
@@ -252,7 +461,12 @@ class Firesnap:
             sel = slice(None, None, subsample)
             if subindex is not None:
                 sel = (sel, subindex)
-            arr = self.ff[path][sel]
+            ds = self.ff[path]
+            dtype = self._readdtype(path, ds.dtype)
+            if dtype == ds.dtype:
+                arr = ds[sel]
+            else:
+                arr = ds.astype(dtype)[sel]
         
         # needs a bit more planning to mimic the slice object result
         # (don't want to introduce dependencies on how files are split)
@@ -267,41 +481,29 @@ class Firesnap:
             # 'nan', 'na', or 'n' for string/bytes data (depends on max. 
             # string length)
             
-            start = 0
-            combindex = 0
-            array_init = False
-            for filen in self.filens:
-                print(filen)
-                with h5py.File(filen, 'r') as f:
-                    npt = 'NumPart_ThisFile'
-                    sublen_tot = f['Header'].attrs[npt][parttypeindex]
-                    if sublen_tot == 0:
-                        continue
-                    if not array_init:
-                        dtype = f[path].dtype
-                        if subindex is None:
-                            shape = (arrsize,) + f[path].shape[1:]
-                        else:
-                            shape = (arrsize,)
-                        # empty means values will not stand out if 
-                        # 'filled in' wrong
-                        arr = np.empty(shape=shape, dtype=dtype)
-                        arr[:] = errorflag 
-                        print('Array shape: ', arr.shape)
-                        array_init = True
-                    ds = f[path]
-                    print('size on file: ', sublen_tot)
-                    # in combined array indices: 
-                    # next multiple of subsample - first element in subarray
-                    subsel_offset = (-1 * start) % subsample 
-                    subsel = slice(subsel_offset, None, subsample)
-                    if subindex is not None:
-                        subsel = (subsel, subindex)
-                    
-                    numsel = (sublen_tot - 1 - subsel_offset) // subsample + 1
-                    totsel = slice(combindex, combindex + numsel, None)
-                    print('selected: ', numsel)
-                    
+            filesels = self._get_filesels(path, parttypeindex, subsample,
+                                          subindex)
+            if len(filesels) == 0:
+                # evidently, the field wasn't in any file
+                raise FieldNotFoundError(('Field {} not found'.format(path)))
+            with h5py.File(filesels[0][0], 'r') as f:
+                dtype = self._readdtype(path, f[path].dtype)
+                if subindex is None:
+                    shape = (arrsize,) + f[path].shape[1:]
+                else:
+                    shape = (arrsize,)
+            if numreaders is None:
+                numreaders = self.numreaders
+            numreaders = min(numreaders, len(filesels))
+            if numreaders <= 1:
+                # empty means values will not stand out if 
+                # 'filled in' wrong
+                arr = np.empty(shape=shape, dtype=dtype)
+                arr[:] = errorflag 
+                print('Array shape: ', arr.shape)
+                for filen, subsel, totsel in filesels:
+                    print(filen)
+                    print('selected: ', totsel.stop - totsel.start)
                     ## test on quest, snapshot 600 (z=0)
                     # /projects/b1026/snapshots/metal_diffusion/m12i_res7100
                     # /output
@@ -311,149 +513,776 @@ class Firesnap:
                     # -> 888.8572574020363
                     # arr[totsel] = ds[subsel]:
                     # -> 961.0126019851305
-                    
-                    ds.read_direct(arr, source_sel=subsel, dest_sel=totsel)
-                    #arr[totsel] = ds[subsel]
-                    
-                    start += sublen_tot
-                    combindex += numsel
-            if not array_init:
-                # evidently, the field wasn't in any file
-                raise FieldNotFoundError(('Field {} not found'.format(path)))
+                    with h5py.File(filen, 'r') as f:
+                        f[path].read_direct(arr, source_sel=subsel, 
+                                            dest_sel=totsel)
+            else:
+                arr = self._readarray_parallel(path, filesels, shape, dtype,
+                                               errorflag, numreaders)
         self.toCGS = self.units.getunits(path)
+        if usecache:
+            self._cache_put(cachekey, arr, self.toCGS)
         return arr
     
-    def readarray_emulateEAGLE(self, field, subsample=1, errorflag=np.nan):
+    def get_fileoffsets(self, parttype):
+        '''
+        get the cumulative particle offsets of the different snapshot
+        files for a particle type. The particles in file i have global
+        indices offsets[i] -- offsets[i + 1]. The table is stored after
+        the first call.
+
+        Parameters:
+        -----------
+        parttype: int
+            particle type (PartType<parttype> in the files)
+        
+        Returns:
+        --------
+        offsets: int array, length (number of files + 1)
+        '''
+        if parttype in self._fileoffsets:
+            return self._fileoffsets[parttype]
+        if self.numfiles == 1:
+            numpart = [self.ff['Header'].attrs['NumPart_ThisFile'][parttype]]
+        else:
+            numpart = []
+            for filen in self.filens:
+                with h5py.File(filen, 'r') as f:
+                    npt = 'NumPart_ThisFile'
+                    numpart.append(f['Header'].attrs[npt][parttype])
+        offsets = np.zeros(len(numpart) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(numpart)
+        self._fileoffsets[parttype] = offsets
+        return offsets
+
+    def readarray_indices(self, path, indices, subindex=None, mergegap=1024):
+        '''
+        read in only the selected (global) particle indices from an 
+        array in the snapshot file(s). The indices are grouped into
+        contiguous runs in each file, and each run is read in 
+        separately. Sets the .toCGS attribute like readarray.
+        
+        Parameters:
+        -----------
+        path: str
+            the full path to the dataset in the hdf5 file
+        indices: int array or bool array
+            the particle indices to read in (global indices, i.e., 
+            matching the readarray output indices), or a boolean array
+            with True values for the particles to read in
+        subindex: int or None
+            specific index to read in if the array is 2D instead of 1D
+            (e.g., only read in the X coordinates -> subindex=0)
+        mergegap: int
+            runs of indices separated by fewer than mergegap particles
+            are read in as a single block (then subselected), to avoid 
+            the overhead of many small reads.
+
+        Returns:
+        --------
+        the desired array values, in the order of the input indices
+        
+        Errors:
+        -------
+        FieldNotFoundError: the desired field was not present in (any)
+        file
+        '''
+        self.toCGS = np.NaN 
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.where(indices)[0]
+        parttype = int(path.split('/')[0][-1]) 
+        offsets = self.get_fileoffsets(parttype)
+        if len(indices) > 0:
+            if np.min(indices) < 0 or np.max(indices) >= offsets[-1]:
+                msg = 'indices out of range 0 -- {} for {}'
+                raise IndexError(msg.format(offsets[-1], path))
+        
+        cachekey = (path, 1, subindex)
+        if self.cache_maxbytes is not None and cachekey in self._cache:
+            arr, self.toCGS = self._cache_get(cachekey)
+            return arr[indices]
+        
+        order = np.argsort(indices, kind='stable')
+        sind = indices[order]
+        arr = None
+        for fi in range(len(offsets) - 1):
+            if offsets[fi + 1] == offsets[fi]:
+                continue
+            filen = self.filens[fi]
+            with h5py.File(filen, 'r') as f:
+                if path not in f:
+                    msg = 'Field {} not found in {}'.format(path, filen)
+                    raise FieldNotFoundError(msg)
+                ds = f[path]
+                if arr is None:
+                    if subindex is None:
+                        shape = (len(indices),) + ds.shape[1:]
+                    else:
+                        shape = (len(indices),)
+                    arr = np.empty(shape, 
+                                   dtype=self._readdtype(path, ds.dtype))
+                imin, imax = np.searchsorted(sind, offsets[fi:fi + 2])
+                if imin == imax:
+                    continue
+                local = sind[imin: imax] - offsets[fi]
+                # starts of blocks to read in: where the gap to the 
+                # previous index exceeds mergegap
+                bstarts = np.where(np.diff(local) > mergegap)[0] + 1
+                bstarts = np.append(0, bstarts)
+                bends = np.append(bstarts[1:], len(local))
+                for bs, be in zip(bstarts, bends):
+                    first = local[bs]
+                    last = local[be - 1]
+                    sel = slice(first, last + 1, None)
+                    if subindex is not None:
+                        sel = (sel, subindex)
+                    block = ds[sel]
+                    outsel = order[imin + bs: imin + be]
+                    arr[outsel] = block[local[bs: be] - first]
+                    del block
+        if arr is None:
+            raise FieldNotFoundError(('Field {} not found'.format(path)))
+        self.toCGS = self.units.getunits(path)
+        return arr
+
+    def get_spatialindex(self, parttype, indexfile=None, makeindex=False):
+        '''
+        get the spatial index (readfire.spatialindex.SpatialIndex) 
+        for a particle type. The index is stored after the first call.
+
+        Parameters:
+        -----------
+        parttype: int
+            particle type (PartType<parttype> in the files)
+        indexfile: str or None
+            the index file to use. None means the default sidecar file
+            name (spatialindex.sidecar_filen) is used.
+        makeindex: bool
+            if the index file does not exist, or does not match the 
+            snapshot files anymore, (re)make it (True) or raise
+            a FileNotFoundError or ValueError (False)
+        '''
+        if parttype in self._spatialindices:
+            return self._spatialindices[parttype]
+        if indexfile is None:
+            indexfile = si.sidecar_filen(self, parttype)
+        if not os.path.isfile(indexfile):
+            if makeindex:
+                si.make_spatialindex(self, parttype, outfilen=indexfile)
+            else:
+                msg = ('No spatial index file {} found; make one with '
+                       'spatialindex.make_spatialindex')
+                raise FileNotFoundError(msg.format(indexfile))
+        elif makeindex and not si.spatialindex_isvalid(self, indexfile,
+                                                       parttype):
+            print(f'Remaking outdated spatial index {indexfile}')
+            si.make_spatialindex(self, parttype, outfilen=indexfile,
+                                 overwrite=True)
+        self._spatialindices[parttype] = si.SpatialIndex(indexfile, snap=self)
+        return self._spatialindices[parttype]
+    
+    def select_box(self, boxmin_cm, boxmax_cm, parttype=0, indexfile=None,
+                   makeindex=False, return_coords=False):
+        '''
+        get the (global) indices of particles in a box, reading only the
+        particles in spatial index cells overlapping the box.
+
+        Parameters:
+        -----------
+        boxmin_cm, boxmax_cm: length 3 float arrays
+            the box edges along the simulation x, y, z axes, in 
+            physical cm
+        parttype: int
+            particle type (PartType<parttype> in the files)
+        indexfile: str or None
+            spatial index file to use. None means the default 
+            sidecar file.
+        makeindex: bool
+            make the spatial index file if it does not exist
+        return_coords: bool
+            also return the coordinates of the selected particles 
+            (simulation units; sets the .toCGS attribute)
+        
+        Returns:
+        --------
+        indices: int array
+            sorted indices of the selected particles, for use with
+            readarray_indices or to index readarray outputs
+        coords: float array, shape (len(indices), 3)
+            returned if return_coords is True
+        '''
+        sind = self.get_spatialindex(parttype, indexfile=indexfile,
+                                     makeindex=makeindex)
+        cpath = f'PartType{parttype}/Coordinates'
+        coords_toCGS = self.units.getunits(cpath)
+        boxmin = np.asarray(boxmin_cm) / coords_toCGS
+        boxmax = np.asarray(boxmax_cm) / coords_toCGS
+        cands = sind.candidates_box(boxmin, boxmax)
+        coords = self.readarray_indices(cpath, cands)
+        sel = np.all(coords >= boxmin[np.newaxis, :], axis=1)
+        sel &= np.all(coords <= boxmax[np.newaxis, :], axis=1)
+        if return_coords:
+            return cands[sel], coords[sel]
+        return cands[sel]
+    
+    def select_sphere(self, center_cm, radius_cm, parttype=0, 
+                      indexfile=None, makeindex=False, return_coords=False):
+        '''
+        get the (global) indices of particles in a sphere, reading only
+        the particles in spatial index cells overlapping the sphere.
+
+        Parameters:
+        -----------
+        center_cm: length 3 float array
+            the sphere center along the simulation x, y, z axes, in 
+            physical cm
+        radius_cm: float
+            the sphere radius in physical cm
+        other parameters and returns:
+            see select_box
+        '''
+        sind = self.get_spatialindex(parttype, indexfile=indexfile,
+                                     makeindex=makeindex)
+        cpath = f'PartType{parttype}/Coordinates'
+        coords_toCGS = self.units.getunits(cpath)
+        cen = np.asarray(center_cm) / coords_toCGS
+        rad = radius_cm / coords_toCGS
+        cands = sind.candidates_sphere(cen, rad)
+        coords = self.readarray_indices(cpath, cands)
+        r2 = np.sum((coords - cen[np.newaxis, :])**2, axis=1)
+        sel = r2 <= rad**2
+        if return_coords:
+            return cands[sel], coords[sel]
+        return cands[sel]
+
+    def _get_filesels(self, path, parttypeindex, subsample, subindex):
+        '''
+        for a split snapshot, get the (file name, file selection, 
+        output array selection) for each file containing particles of
+        the requested type. The output array selections are disjoint
+        and follow the NumPart_ThisFile values in each file.
+        '''
+        filesels = []
+        start = 0
+        combindex = 0
+        for filen in self.filens:
+            with h5py.File(filen, 'r') as f:
+                npt = 'NumPart_ThisFile'
+                sublen_tot = f['Header'].attrs[npt][parttypeindex]
+                if sublen_tot == 0:
+                    continue
+                if path not in f:
+                    msg = 'Field {} not found in {}'.format(path, filen)
+                    raise FieldNotFoundError(msg)
+            # in combined array indices: 
+            # next multiple of subsample - first element in subarray
+            subsel_offset = (-1 * start) % subsample 
+            subsel = slice(subsel_offset, None, subsample)
+            if subindex is not None:
+                subsel = (subsel, subindex)
+            numsel = (sublen_tot - 1 - subsel_offset) // subsample + 1
+            totsel = slice(combindex, combindex + numsel, None)
+            filesels.append((filen, subsel, totsel))
+            start += sublen_tot
+            combindex += numsel
+        return filesels
+    
+    def _readarray_parallel(self, path, filesels, shape, dtype, errorflag,
+                            numreaders):
+        '''
+        read the different files of a split snapshot in numreaders 
+        processes, directly into a shared memory-mapped file (in 
+        /dev/shm if available). The file is removed once the read-in 
+        is done; the returned array keeps the mapping (and the memory)
+        alive, so no copy is made.
+        '''
+        dtype = np.dtype(dtype)
+        tmpdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, mmapfilen = tempfile.mkstemp(suffix='.readarray', dir=tmpdir)
+        os.close(fd)
+        try:
+            arr = np.memmap(mmapfilen, dtype=dtype, mode='w+', shape=shape)
+            arr[:] = errorflag
+            print('Array shape: ', arr.shape)
+            print('Reading {} files with {} processes'.format(len(filesels),
+                                                              numreaders))
+            with cf.ProcessPoolExecutor(max_workers=numreaders) as ex:
+                futures = [ex.submit(_readdirect_mmap, filen, path, subsel,
+                                     totsel, mmapfilen, shape, dtype.str)
+                           for filen, subsel, totsel in filesels]
+                for future in cf.as_completed(futures):
+                    # re-raises any errors from the worker processes
+                    future.result()
+        finally:
+            os.remove(mmapfilen)
+        # plain ndarray view; still backed by the mapping
+        return arr.view(np.ndarray)
+
+    def readarray_emulateEAGLE(self, field, subsample=1, errorflag=np.nan,
+                               usecache=True):
         '''
         Read in an array and set to toCGS attribute. Includes 
-        conversions from field names in EAGLE and calculation of gas 
-        temperature
+        conversions from field names in EAGLE and calculation of 
+        derived quantities, such as the gas temperature (see 
+        derived_fields and register_derived_field). usecache=False 
+        bypasses the readarray cache (see readarray).
+        Stored fields needed for several derived fields (e.g., Helium
+        for Temperature and the hydrogen mass fraction) are read in
+        once per call. Between calls, they (and the derived fields) 
+        are only reused if the Firesnap has a cache budget 
+        (cache_maxbytes); otherwise, each call reads them in again.
 
         note, 'PartType0/Pressure' returns only the /Thermal/ pressure
         '''
+        return self._readarray_emulateEAGLE(field, subsample=subsample,
+                                            errorflag=errorflag, memo={},
+                                            usecache=usecache)
+    
+    def _readarray_emulateEAGLE(self, field, subsample=1, errorflag=np.nan,
+                                memo=None, blocksel=None, usecache=True):
+        '''
+        readarray_emulateEAGLE, with a dictionary memo to store 
+        arrays needed for multiple derived fields in one calculation,
+        and an optional global particle index range (blocksel: slice)
+        to read instead of the full array
+        '''
         self.toCGS = np.NaN # overwrite and old values to avoid undetected errors
+        if 'Smoothed' in field:
+            msg = ('Warning: smoothed abundances are unavailable in FIRE'
+                   '; using non-smoothed values')
+            print(msg)
+            field = field.replace('Smoothed', '')
+        if memo is None:
+            memo = {}
+        parttypestr = field.split('/')[0]
+        relfield = '/'.join(field.split('/')[1:])
+        if relfield in derived_fields:
+            return self._calc_derived(field, subsample=subsample,
+                                      errorflag=errorflag, memo=memo,
+                                      blocksel=blocksel, usecache=usecache)
         # Metals: field names match, but structure is different
         if 'Metallicity' in field:
-            if 'Smoothed' in field:
-                msg = ('Warning: smoothed abundances are unavailable in FIRE'
-                       '; using non-smoothed values')
-                print(msg)
-                field = field.replace('Smoothed', '')
-            if 'name_to_atomnumber' in self.ff['Header'].attrs:
-                atomnos = self.ff['Header'].attrs['name_to_atomnumber']
-                index = np.where([atomno == 0 for atomno in atomnos])[0][0]
-            else:
-                # assume “standard” runs with METAL_SPECIES_COOLING enabled
-                index = np.where([atomno == 0 for atomno \
-                                  in standard_atomno_indices])[0][0]
-            out = self.readarray(field, subsample=subsample, 
-                                 errorflag=errorflag, subindex=index)
+            index = self._metallicity_index('total')
+            out = self._readraw(field, subsample=subsample, 
+                                errorflag=errorflag, subindex=index,
+                                blocksel=blocksel, usecache=usecache)
             self.toCGS = self.units.getunits(field)
             return out
             
         elif 'ElementAbundance' in field:
-            if 'Smoothed' in field:
-                msg = ('Warning: smoothed abundances are unavailable in FIRE'
-                       '; using non-smoothed values')
-                print(msg)
-                field = field.replace('Smoothed', '')
             element = field.split('/')[-1]
-            if element == 'Hydrogen':
-                _fieldstart = '/'.join(field.split('/')[:-1])
-                he = self.readarray_emulateEAGLE(_fieldstart + '/Helium', 
-                                                 subsample=subsample, 
-                                                 errorflag=np.nan)
-                _fieldstart = '/'.join(field.split('/')[:-2])
-                me = self.readarray_emulateEAGLE(_fieldstart + '/Metallicity', 
-                                                 subsample=subsample, 
-                                                 errorflag=np.nan)
-                hfrac = 1. - he - me
-                del he
-                del me
-                return hfrac
-                
-            if 'name_to_atomnumber' in self.ff['Header'].attrs:
-                atomnos = self.ff['Header'].attrs['name_to_atomnumber']
-                atomno = name_to_atomnumber[element]
-                index = np.where([_atomno == atomno for _atomno
-                                  in atomnos])[0][0]
-            else:
-                atomnos = standard_atomno_indices
-                atomno = name_to_atomnumber[element]
-                index = np.where([_atomno == atomno for _atomno
-                                  in standard_atomno_indices])[0][0]
-            parttypestr = field.split('/')[0]
+            index = self._metallicity_index(element)
             field = parttypestr + '/Metallicity'
-            out = self.readarray(field, subsample=subsample, 
-                                 errorflag=errorflag, subindex=index)
+            out = self._readraw(field, subsample=subsample, 
+                                errorflag=errorflag, subindex=index,
+                                blocksel=blocksel, usecache=usecache)
             self.toCGS = self.units.getunits(field)
             return out
         # lots of fields are just the same
         else:
             try: 
                 self.toCGS = self.units.getunits(field)
-                return self.readarray(field, subsample=subsample, 
-                                      errorflag=errorflag)   
+                return self._readraw(field, subsample=subsample, 
+                                     errorflag=errorflag, blocksel=blocksel,
+                                     usecache=usecache)
             except (FieldNotFoundError, uf.UnitsNotFoundError) as err:
                 # same stuff, different name
                 if field.endswith('Mass'): # Mass in EAGLE = Masses in FIRE
                     _field = field + 'es'
                     self.toCGS = self.units.getunits(_field)
-                    return self.readarray(_field, subsample=subsample, 
-                                          errorflag=errorflag)
-                # temperature: need to calculate instead of read in
-                elif field == 'PartType0/Temperature':
-                    hekey = 'PartType0/ElementAbundance/Helium'
-                    hefrac = self.readarray_emulateEAGLE(hekey, 
-                                                         subsample=subsample,
-                                                         errorflag=errorflag)
-                    etoh = self.readarray('PartType0/ElectronAbundance',
-                                           subsample=subsample, 
-                                           errorflag=errorflag)  
-                    print(etoh)
-                    print(hefrac)                      
-                    yhe = hefrac / (4. * (1. - hefrac))             
-                    mu = (1. + 4. * yhe) / ( 1. + yhe + etoh)
-                    print(mu)
-                    del etoh
-                    del hefrac
-                    mean_molecular_weight = mu * uf.c.atomw_H * uf.c.u
-                    temperature = self.readarray('PartType0/InternalEnergy',
-                                                 subsample=subsample, 
-                                                 errorflag=errorflag)
-                    uconv = self.units.getunits('PartType0/InternalEnergy')
-                    scalar = uconv * (gamma_gas - 1.) / uf.c.boltzmann 
-                    print(scalar)
-                    print(mean_molecular_weight)
-                    temperature *= scalar * mean_molecular_weight 
-                    self.toCGS = 1. 
-                    # do the conversion: matches expected units from EAGLE
-                    # and an extra scalar multiplication doesn't cost much
-                    return temperature
-                elif field == 'PartType0/Pressure':
-                    # !! Thermal Pressure only !!
-                    # P = n * k_B * T
-                    # n = Density / mu (density = mu * n_part by definition)
-                    # T = mu * (gamma-1) * InternalEnergy / k_B
-                    # so P = Density / mu * k_B * mu * (gamma - 1) \
-                    #        * InternalEnergy / k_B
-                    # so P = Density * (gamma - 1) * InternalEnergy
-                    pressure = self.readarray('PartType0/InternalEnergy',
-                                                 subsample=subsample, 
-                                                 errorflag=errorflag)
-                    # internal energy per unit mass
-                    _toCGS = self.units.getunits('PartType0/InternalEnergy')
-                    _toCGS *= (gamma_gas - 1.)
-                    pressure *= self.readarray('PartType0/Density',
-                                                 subsample=subsample, 
-                                                 errorflag=errorflag)
-                    _toCGS *= self.units.getunits('PartType0/Density')
-                    self.toCGS = _toCGS
-                    return pressure
+                    return self._readraw(_field, subsample=subsample, 
+                                         errorflag=errorflag, 
+                                         blocksel=blocksel,
+                                         usecache=usecache)
                 else:
                     raise err
+    
+    def _calc_derived(self, field, subsample=1, errorflag=np.nan, 
+                      memo=None, blocksel=None, usecache=True):
+        '''
+        calculate a field in derived_fields from its dependencies. 
+        Dependencies are read in (or calculated) once per top-level
+        readarray_emulateEAGLE call. Reuse across calls only happens
+        through the readarray cache (cache_maxbytes not None), which
+        stores the dependencies and the derived fields.
+        '''
+        parttypestr = field.split('/')[0]
+        relfield = '/'.join(field.split('/')[1:])
+        dfield = derived_fields[relfield]
+        if dfield.parttypes is not None \
+                and int(parttypestr[-1]) not in dfield.parttypes:
+            msg = 'Derived field {} is only available for PartTypes {}'
+            raise FieldNotFoundError(msg.format(field, dfield.parttypes))
+        if blocksel is None:
+            cachekey = (field, subsample, 'derived')
+        else:
+            cachekey = (field, subsample, 'derived', blocksel.start, 
+                        blocksel.stop)
+        if usecache:
+            cached = self._cache_get(cachekey)
+            if cached is not None:
+                arr, self.toCGS = cached
+                return arr
+        else:
+            self._cache_drop(cachekey)
+        depdct = {}
+        for dep in dfield.dependencies:
+            dpath = parttypestr + '/' + dep
+            if dpath not in memo:
+                _arr = self._readarray_emulateEAGLE(dpath, 
+                                                    subsample=subsample,
+                                                    errorflag=errorflag,
+                                                    memo=memo,
+                                                    blocksel=blocksel,
+                                                    usecache=usecache)
+                # python float conversion factors don't upcast float32
+                # arrays in calcfunc arithmetic
+                memo[dpath] = (_arr, float(self.toCGS))
+            depdct[dep] = memo[dpath]
+        arr, toCGS = dfield.calcfunc(self, depdct)
+        del depdct
+        arr = self._castfloat(field, arr)
+        if usecache:
+            self._cache_put(cachekey, arr, toCGS)
+        self.toCGS = toCGS
+        return arr
+
+    def _readraw(self, path, subsample=1, errorflag=np.nan, subindex=None,
+                 blocksel=None, usecache=True):
+        if blocksel is None:
+            return self.readarray(path, subsample=subsample, 
+                                  errorflag=errorflag, subindex=subindex,
+                                  usecache=usecache)
+        elif subsample != 1:
+            raise ValueError('subsampling is not available for block reads')
+        return self.readarray_slice(path, blocksel.start, blocksel.stop,
+                                    subindex=subindex)
+
+    def readarray_slice(self, path, start, stop, subindex=None):
+        '''
+        read in the particles with global indices start -- stop from
+        an array in the snapshot file(s). Sets the .toCGS attribute 
+        like readarray.
+
+        Parameters:
+        -----------
+        path: str
+            the full path to the dataset in the hdf5 file
+        start, stop: int
+            first and last + 1 (global) particle index to read in
+        subindex: int, slice, or None
+            specific index (or range of indices) to read in if the 
+            array is 2D instead of 1D (e.g., only read in the X 
+            coordinates -> subindex=0)
+        
+        Returns:
+        --------
+        the desired array slice
+        '''
+        self.toCGS = np.NaN 
+        parttype = int(path.split('/')[0][-1]) 
+        offsets = self.get_fileoffsets(parttype)
+        stop = min(stop, offsets[-1])
+        arr = None
+        for fi in range(len(offsets) - 1):
+            lo = max(start, offsets[fi])
+            hi = min(stop, offsets[fi + 1])
+            if hi <= lo:
+                continue
+            filen = self.filens[fi]
+            with h5py.File(filen, 'r') as f:
+                if path not in f:
+                    msg = 'Field {} not found in {}'.format(path, filen)
+                    raise FieldNotFoundError(msg)
+                ds = f[path]
+                if arr is None:
+                    if subindex is None:
+                        shape = (stop - start,) + ds.shape[1:]
+                    elif isinstance(subindex, slice):
+                        ncol = len(range(*subindex.indices(ds.shape[1])))
+                        shape = (stop - start, ncol)
+                    else:
+                        shape = (stop - start,)
+                    arr = np.empty(shape, 
+                                   dtype=self._readdtype(path, ds.dtype))
+                sel = slice(lo - offsets[fi], hi - offsets[fi], None)
+                if subindex is not None:
+                    sel = (sel, subindex)
+                ds.read_direct(arr, source_sel=sel, 
+                               dest_sel=slice(lo - start, hi - start, None))
+        if arr is None:
+            msg = 'Field {} not found for particles {} -- {}'
+            raise FieldNotFoundError(msg.format(path, start, stop))
+        self.toCGS = self.units.getunits(path)
+        return arr
+    
+    def _metallicity_index(self, element):
+        '''
+        column index of an element ('total' for the total metallicity)
+        in the Metallicity arrays
+        '''
+        if element == 'total':
+            atomno = 0
+        else:
+            atomno = name_to_atomnumber[element]
+        if 'name_to_atomnumber' in self.ff['Header'].attrs:
+            atomnos = self.ff['Header'].attrs['name_to_atomnumber']
+        else:
+            # assume “standard” runs with METAL_SPECIES_COOLING enabled
+            atomnos = standard_atomno_indices
+        index = np.where([_atomno == atomno for _atomno in atomnos])[0][0]
+        return index
+    
+    def readarray_elements(self, parttype, elements, subsample=1, 
+                           blocksize=2**22):
+        '''
+        read in the mass fractions of several elements in a single
+        pass over the Metallicity array (one block of particles at a
+        time, for the range of columns containing all the elements).
+        Sets the .toCGS attribute. If the readarray cache is used, 
+        columns are taken from or added to the cache.
+
+        Parameters:
+        -----------
+        parttype: int
+            particle type (PartType<parttype> in the files)
+        elements: list of str
+            element names, e.g., 'Oxygen', or 'total' for the total 
+            metallicity. 'Hydrogen' is calculated from the Helium and 
+            total metallicity.
+        subsample: int
+            one in <subsample> values is read in. Values other than 1
+            mean the elements are read in one at a time.
+        blocksize: int
+            number of particles to read in at a time
+
+        Returns:
+        --------
+        dict with the element names as keys and the mass fraction 
+        arrays as values
+        '''
+        path = f'PartType{parttype}/Metallicity'
+        colelts = []
+        for elt in elements:
+            if elt == 'Hydrogen':
+                colelts += ['Helium', 'total']
+            else:
+                colelts.append(elt)
+        colelts = list(set(colelts))
+        colinds = {elt: self._metallicity_index(elt) for elt in colelts}
+        cols = {}
+        toread = []
+        for elt in colelts:
+            cachekey = (path, subsample, colinds[elt])
+            if subsample != 1 or cachekey in self._cache:
+                cols[elt] = self.readarray(path, subsample=subsample,
+                                           subindex=colinds[elt])
+            else:
+                toread.append(elt)
+        toCGS = self.units.getunits(path)
+        if len(toread) > 0:
+            lo = min([colinds[elt] for elt in toread])
+            hi = max([colinds[elt] for elt in toread]) + 1
+            numpart = self.get_fileoffsets(parttype)[-1]
+            if numpart == 0:
+                for elt in toread:
+                    cols[elt] = np.zeros((0,), dtype=np.float32)
+            for start in range(0, numpart, blocksize):
+                stop = min(start + blocksize, numpart)
+                slab = self.readarray_slice(path, start, stop, 
+                                            subindex=slice(lo, hi, None))
+                if start == 0:
+                    for elt in toread:
+                        cols[elt] = np.empty((numpart,), dtype=slab.dtype)
+                for elt in toread:
+                    cols[elt][start: stop] = slab[:, colinds[elt] - lo]
+                del slab
+            for elt in toread:
+                self._cache_put((path, 1, colinds[elt]), cols[elt], toCGS)
+        out = {}
+        for elt in elements:
+            if elt == 'Hydrogen':
+                out[elt] = 1. - cols['Helium'] * toCGS - cols['total'] * toCGS
+                if not np.isclose(toCGS, 1.):
+                    out[elt] /= toCGS
+            else:
+                out[elt] = cols[elt]
+        self.toCGS = toCGS
+        return out
+    
+    def iter_blocks(self, fields, blocksize=2**24, filter=None):
+        '''
+        read in several fields (readarray_emulateEAGLE names) in 
+        blocks of particles, so that large snapshots can be processed 
+        in bounded memory. Stored fields needed for several derived 
+        fields are only read in once per block.
+
+        Parameters:
+        -----------
+        fields: list of str
+            the fields to read in, e.g., 'PartType0/Temperature'. All
+            should be for the same particle type.
+        blocksize: int
+            number of particles (before filtering) in each block
+        filter: bool array or None
+            if not None, a selection of particles (size matching the
+            number of particles of the requested type). Only selected 
+            particles are returned, and blocks without any selected
+            particles are skipped.
+        
+        Yields:
+        -------
+        blocksel: slice
+            the range of global particle indices in the block
+        blockdct: dict
+            for each field (keys), an (array, toCGS) tuple. The arrays 
+            are aligned: index i is the same particle for each field.
+        '''
+        parttypes = {int(field.split('/')[0][-1]) for field in fields}
+        if len(parttypes) != 1:
+            msg = 'iter_blocks fields should all be the same PartType: {}'
+            raise ValueError(msg.format(fields))
+        parttype = parttypes.pop()
+        numpart = self.get_fileoffsets(parttype)[-1]
+        if filter is not None and len(filter) != numpart:
+            msg = 'filter length {} does not match particle number {}'
+            raise ValueError(msg.format(len(filter), numpart))
+        for start in range(0, numpart, blocksize):
+            blocksel = slice(start, min(start + blocksize, numpart), None)
+            if filter is not None:
+                bfilter = filter[blocksel]
+                if not np.any(bfilter):
+                    continue
+            memo = {}
+            blockdct = {}
+            for field in fields:
+                if field not in memo:
+                    arr = self._readarray_emulateEAGLE(field, memo=memo,
+                                                       blocksel=blocksel)
+                    memo[field] = (arr, self.toCGS)
+                arr, toCGS = memo[field]
+                if filter is not None:
+                    arr = arr[bfilter]
+                blockdct[field] = (arr, toCGS)
+            del memo
+            yield blocksel, blockdct
+
+class DerivedField:
+    '''
+    a quantity calculated from other (stored or derived) snapshot 
+    fields, for use in Firesnap.readarray_emulateEAGLE
+    '''
+    def __init__(self, dependencies, calcfunc, parttypes=None, info=None):
+        '''
+        Parameters:
+        -----------
+        dependencies: list of str
+            the fields needed to calculate this one, without the
+            'PartType<#>/' part (e.g., 'InternalEnergy',
+            'ElementAbundance/Helium'). These are read in with 
+            readarray_emulateEAGLE, so they may be derived fields 
+            themselves.
+        calcfunc: function
+            called as calcfunc(snap, depdct), where snap is the 
+            Firesnap object and depdct is a dictionary with the 
+            dependencies as keys and (array, toCGS) tuples as values.
+            It should return an (array, toCGS) tuple.
+            Input arrays may be shared between fields, so they should 
+            not be modified in place.
+        parttypes: tuple of ints or None
+            particle types the field is available for. None means all.
+        info: str or None
+            description (e.g., to document approximations)
+        '''
+        self.dependencies = list(dependencies)
+        self.calcfunc = calcfunc
+        self.parttypes = parttypes
+        self.info = info
+
+# keys: field names without the 'PartType<#>/' part
+derived_fields = {}
+
+def register_derived_field(name, dependencies, calcfunc, parttypes=None,
+                           info=None, overwrite=False):
+    '''
+    add a field that can be read in with 
+    Firesnap.readarray_emulateEAGLE('PartType<#>/' + name).
+    Note that registered fields take precedence over any stored 
+    fields with the same name. 
+
+    Parameters:
+    -----------
+    name: str
+        the field name, without the 'PartType<#>/' part
+    dependencies, calcfunc, parttypes, info:
+        see DerivedField
+    overwrite: bool
+        replace an existing registered field with the same name (True)
+        or raise a ValueError (False)
+    '''
+    if name in derived_fields and not overwrite:
+        raise ValueError(f'Derived field {name} is already registered')
+    derived_fields[name] = DerivedField(dependencies, calcfunc, 
+                                        parttypes=parttypes, info=info)
+
+def _calc_hydrogen(snap, depdct):
+    he, he_toCGS = depdct['ElementAbundance/Helium']
+    me, me_toCGS = depdct['Metallicity']
+    hfrac = 1. - he * he_toCGS - me * me_toCGS
+    return hfrac, 1.
+
+def _calc_temperature(snap, depdct):
+    hefrac = depdct['ElementAbundance/Helium'][0]
+    etoh = depdct['ElectronAbundance'][0]
+    ienergy, uconv = depdct['InternalEnergy']
+    yhe = hefrac / (4. * (1. - hefrac))
+    mu = (1. + 4. * yhe) / ( 1. + yhe + etoh)
+    del yhe
+    mu *= uconv * (gamma_gas - 1.) / uf.c.boltzmann * uf.c.atomw_H * uf.c.u
+    mu *= ienergy
+    # do the conversion: matches expected units from EAGLE
+    # and an extra scalar multiplication doesn't cost much
+    return mu, 1.
+
+def _calc_pressure(snap, depdct):
+    # !! Thermal Pressure only !!
+    # P = n * k_B * T
+    # n = Density / mu (density = mu * n_part by definition)
+    # T = mu * (gamma-1) * InternalEnergy / k_B
+    # so P = Density / mu * k_B * mu * (gamma - 1) \
+    #        * InternalEnergy / k_B
+    # so P = Density * (gamma - 1) * InternalEnergy
+    ienergy, ie_toCGS = depdct['InternalEnergy']
+    dens, d_toCGS = depdct['Density']
+    pressure = ienergy * dens
+    return pressure, ie_toCGS * (gamma_gas - 1.) * d_toCGS
+
+def _calc_nH(snap, depdct):
+    dens, d_toCGS = depdct['Density']
+    hfrac, h_toCGS = depdct['ElementAbundance/Hydrogen']
+    hdens = dens * hfrac
+    return hdens, d_toCGS * h_toCGS / (uf.c.atomw_H * uf.c.u)
+
+register_derived_field('ElementAbundance/Hydrogen',
+                       ['ElementAbundance/Helium', 'Metallicity'],
+                       _calc_hydrogen,
+                       info='1 - Helium - Metallicity mass fraction')
+register_derived_field('Temperature',
+                       ['ElementAbundance/Helium', 'ElectronAbundance', 
+                        'InternalEnergy'],
+                       _calc_temperature, parttypes=(0,),
+                       info='from InternalEnergy, ElectronAbundance, Helium')
+register_derived_field('Pressure', ['InternalEnergy', 'Density'],
+                       _calc_pressure, parttypes=(0,),
+                       info='thermal pressure only')
+register_derived_field('HydrogenNumberDensity', 
+                       ['Density', 'ElementAbundance/Hydrogen'],
+                       _calc_nH, parttypes=(0,),
+                       info='hydrogen nuclei per unit volume')
                   
-def get_Firesnap(path, snapnum, filetype='snap'):
+def get_Firesnap(path, snapnum, filetype='snap', cache_maxbytes=None,
+                 numreaders=1, floattype=None, usecatalogue=True):
     '''
     return a FireSnap object, with the parameterfile and snapshot file
     in the given path.
@@ -473,6 +1302,23 @@ def get_Firesnap(path, snapnum, filetype='snap'):
         stub; for now this only works for snapshots, but it can be
         adapted to read/return a halo file reader.
         The default is 'snap'.
+    cache_maxbytes: int or None
+        passed to Firesnap; memory budget for caching read-in arrays.
+        The default (None) means no caching.
+    numreaders: int
+        passed to Firesnap; number of processes used to read in split
+        snapshot files. The default is 1.
+    floattype: numpy floating-point type or None
+        passed to Firesnap; type to read floating-point arrays in as
+        (e.g., np.float32). The default (None) keeps the stored types.
+    usecatalogue: bool
+        use (and update) the stored snapshot metadata for this 
+        simulation (readfire.snapcatalogue) to skip file discovery 
+        and unit/header parsing. Stored entries are checked against
+        the first snapshot file (size, modification time, header 
+        particle and file numbers), and replaced if they don't match.
+        Ignored if opts_locs has no dir_snapsidecars.
+        The default is True.
     
     Returns:
     --------
@@ -481,6 +1327,68 @@ def get_Firesnap(path, snapnum, filetype='snap'):
     opts_filetype = ['snap']
     if filetype not in opts_filetype:
         raise ValueError('filetype should be one of {}'.format(opts_filetype))
+    kwargs_snap = {'cache_maxbytes': cache_maxbytes, 
+                   'numreaders': numreaders,
+                   'floattype': floattype}
+    usecatalogue = usecatalogue and sc.catalogue_isenabled()
+    if usecatalogue:
+        entry = sc.get_snapentry(path, snapnum)
+        if entry is not None:
+            try:
+                if _snapentry_isvalid(entry):
+                    firesnap = Firesnap(None, metadata=entry, **kwargs_snap)
+                    msg = ('Using parameterfile {}, (1st) snapshot {}'
+                           ' (from snapshot catalogue)')
+                    print(msg.format(entry['parameterfile'], 
+                                     firesnap.firstfilen))
+                    return firesnap
+            except (OSError, KeyError):
+                pass
+            print('Snapshot catalogue entry did not match files; replacing')
+            sc.remove_snapentry(path, snapnum)
+    basename, parameterfile = find_snapfiles(path, snapnum)
+    firesnap = Firesnap(basename, parameterfile=parameterfile, **kwargs_snap)
+    msg = 'Using parameterfile {}, (1st) snapshot {}'
+    print(msg.format(parameterfile, basename))
+    if usecatalogue:
+        sc.set_snapentry(path, snapnum, firesnap.getmetadata())
+    return firesnap
+
+def _snapentry_isvalid(entry):
+    '''
+    check a snapshot catalogue entry against the first snapshot file:
+    size, modification time, and header total particle numbers and
+    number of files
+    '''
+    firstfilen = entry['filens'][0]
+    stat = os.stat(firstfilen)
+    if stat.st_size != entry['firstfilesize'] \
+            or stat.st_mtime != entry['firstfilemtime']:
+        return False
+    with h5py.File(firstfilen, 'r') as f:
+        hed = f['Header'].attrs
+        numpart = [int(num) for num in hed['NumPart_Total']]
+        numfiles = int(hed['NumFilesPerSnapshot'])
+    if numpart != entry['NumPart_Total']:
+        return False
+    # single-file snapshots (snapshot_###.hdf5) are opened without 
+    # checking NumFilesPerSnapshot
+    if len(entry['filens']) > 1 or firstfilen.endswith('.0.hdf5'):
+        return numfiles == len(entry['filens'])
+    return True
+
+def find_snapfiles(path, snapnum):
+    '''
+    find the (first) snapshot file and the parameter file for a 
+    snapshot. See get_Firesnap for the path options.
+
+    Returns:
+    --------
+    basename: str
+        snapshot file (first file, for split snapshots)
+    parameterfile: str or None
+        the parameter file, if one was found
+    '''
     prefix = ''
     if not os.path.isdir(path):
         if not os.path.isdir(prefix + path):
@@ -530,13 +1438,9 @@ def get_Firesnap(path, snapnum, filetype='snap'):
         msg = 'Could not find a snapshot file {} in {}'
         dirs = [path + _d for _d in opts_snapdir]
         raise RuntimeError(msg.format(opts_snapfile, dirs))
-    
-    firesnap = Firesnap(basename, parameterfile=parameterfile)
-    msg = 'Using parameterfile {}, (1st) snapshot {}'
-    print(msg.format(parameterfile, basename))
-    return firesnap
+    return basename, parameterfile
      
-def findclosestz_snap(path, redshift):
+def findclosestz_snap(path, redshift, usecatalogue=True):
     '''
     Utility function for picking snapshots. Note: some of the returned
     snapshot numbers may not exist (yet).
@@ -548,6 +1452,9 @@ def findclosestz_snap(path, redshift):
         the get_Firesnap path.
     redshift: float
         which redshift value to try to match
+    usecatalogue: bool
+        use (and update) the output redshift list stored in the 
+        snapshot catalogue for this simulation (readfire.snapcatalogue)
     
     Returns:
     --------
@@ -556,6 +1463,24 @@ def findclosestz_snap(path, redshift):
     zval: float
         the redshift of the closest matching snapshot
     '''
+    zopts = None
+    usecatalogue = usecatalogue and sc.catalogue_isenabled()
+    if usecatalogue:
+        zopts = sc.get_outputzs(path)
+    if zopts is None:
+        zopts, targetfile = _read_outputzs(path)
+        if usecatalogue:
+            sc.set_outputzs(path, zopts, targetfile)
+    zopts = np.array(zopts)
+    snapnum = np.argmin(np.abs(zopts - redshift))
+    zval = zopts[snapnum]
+    return snapnum, zval
+
+def _read_outputzs(path):
+    '''
+    get the redshifts of all the (planned) snapshots of a simulation,
+    from the snapshot_scale-factors.txt or snapshot_times.txt file
+    '''
     if path.endswith('output'):
         path = path[:-6]
     if not path.endswith('/'):
@@ -571,8 +1496,6 @@ def findclosestz_snap(path, redshift):
         aopts = (aopts.strip()).split('\n')
         aopts = np.array([float(aopt) for aopt in aopts])
         zopts = 1. / aopts - 1.
-        snapnum = np.argmin(np.abs(zopts - redshift))
-        zval = zopts[snapnum]
     elif os.path.isfile(tf2):
         targetfile = tf2
         #if not os.path.isfile(targetfile):
@@ -585,13 +1508,11 @@ def findclosestz_snap(path, redshift):
                           if not aopt.startswith('#')])
         #print(aopts)
         zopts = 1. / aopts - 1.
-        snapnum = np.argmin(np.abs(zopts - redshift))
-        zval = zopts[snapnum]
     else:
         raise ValueError(f'No files {tf1} or {tf2} found.')
-    return snapnum, zval
+    return list(zopts), targetfile
 
-def findclosestzs_snaps(basedir, simnames, zvals):
+def findclosestzs_snaps(basedir, simnames, zvals, usecatalogue=True):
     '''
     for a set of simulations, find the closest snapshots to a list of
     redshifts. The results are printed.
@@ -605,6 +1526,9 @@ def findclosestzs_snaps(basedir, simnames, zvals):
         possibly in a subdirectory called 'output'
     zvals: list of floats
         the redshift values to find the snapshots for
+    usecatalogue: bool
+        use (and update) the snapshot catalogues for the simulations
+        (readfire.snapcatalogue)
 
     Returns:
     --------
@@ -629,10 +1553,12 @@ def findclosestzs_snaps(basedir, simnames, zvals):
         print(simname)
         snapnums = []
         for ztar in zvals:
-            snapnum, zmatch = findclosestz_snap(dirpath, ztar)
+            snapnum, zmatch = findclosestz_snap(dirpath, ztar,
+                                                usecatalogue=usecatalogue)
             pstr = f'{snapnum} at {zmatch} (target {ztar})'
             try:
-                sno = get_Firesnap(dirpath, snapnum, filetype='snap')
+                sno = get_Firesnap(dirpath, snapnum, filetype='snap',
+                                   usecatalogue=usecatalogue)
                 snapnums.append(f'{snapnum}')
             except RuntimeError:
                 pstr = pstr + ' snapshot not found'
@@ -641,6 +1567,170 @@ def findclosestzs_snaps(basedir, simnames, zvals):
         print()
     return None    
 
+class FlatsnapUnits:
+    '''
+    units (CGS conversion factors) for the fields in a Flatsnap
+    manifest; stands in for units_fire.Units
+    '''
+    def __init__(self, fielddct):
+        self._toCGS = {path: fielddct[path]['toCGS'] for path in fielddct}
+
+    def getunits(self, field):
+        if field not in self._toCGS:
+            raise FieldNotFoundError(f'Field {field} was not extracted')
+        return self._toCGS[field]
+
+class Flatsnap(Firesnap):
+    '''
+    Firesnap-compatible reader for snapshot fields extracted to flat
+    binary files (readfire.flatsnap.extract_flatsnap). Arrays are 
+    returned as copy-on-write np.memmap views of these files, so 
+    read-in does not copy the data, and repeated read-ins (also by 
+    different processes) are served from the page cache. In-place 
+    changes to a returned array only affect that array.
+    Only the extracted fields, and derived fields calculated from 
+    these, are available.
+    '''
+    def __init__(self, manifest, cache_maxbytes=None, floattype=None):
+        '''
+        Parameters:
+        -----------
+        manifest: str
+            the manifest file made by extract_flatsnap, or the 
+            directory containing it (including the full path)
+        cache_maxbytes: int or None
+            memory budget for caching derived fields; see Firesnap.
+            The default (None) means no caching.
+        floattype: numpy floating-point type or None
+            if not None, floating-point arrays are converted to this
+            type (this does make copies); see Firesnap. 
+        Returns:
+        --------
+        Flatsnap object, for reading in the extracted fields of a FIRE
+        snapshot
+        '''
+        if os.path.isdir(manifest):
+            manifest = os.path.join(manifest, flatsnap_manifest)
+        self.manifestfilen = manifest
+        self.flatdir = os.path.dirname(os.path.abspath(manifest))
+        with open(self.manifestfilen, 'r') as f:
+            self.manifest = json.load(f)
+        self.filens = self.manifest['snapfiles']
+        self.firstfilen = self.filens[0]
+        self.numfiles = len(self.filens)
+        self.parfilen = self.manifest['parameterfile']
+        self.numreaders = 1
+        self.floattype = floattype
+        self.fields = self.manifest['fields']
+        self.units = FlatsnapUnits(self.fields)
+        self.cosmopars = Cosmopars(self.manifest['cosmopars'])
+        self._atomnos = self.manifest['metallicity_atomnos']
+        self.set_cache(cache_maxbytes)
+        self._fileoffsets = {}
+        self._spatialindices = {}
+
+    def _memmap(self, path):
+        # new (copy-on-write) map for each read-in, so changes to one
+        # returned array are not visible in others
+        if path not in self.fields:
+            raise FieldNotFoundError(f'Field {path} was not extracted')
+        fdct = self.fields[path]
+        return np.memmap(os.path.join(self.flatdir, fdct['file']), 
+                         dtype=np.dtype(fdct['dtype']), mode='c',
+                         shape=tuple(fdct['shape']))
+
+    def _convert(self, path, arr):
+        dtype = self._readdtype(path, arr.dtype)
+        if dtype != arr.dtype:
+            arr = arr.astype(dtype)
+        return arr
+
+    def readarray(self, path, subsample=1, errorflag=np.nan, subindex=None,
+                  numreaders=None, usecache=True):
+        '''
+        read in an extracted array and set the .toCGS attribute; 
+        arguments as for Firesnap.readarray (errorflag, numreaders,
+        and usecache are ignored: stored arrays are not cached)
+        '''
+        self.toCGS = np.NaN 
+        sel = slice(None, None, subsample)
+        if subindex is not None:
+            sel = (sel, subindex)
+        arr = self._convert(path, self._memmap(path)[sel])
+        self.toCGS = self.units.getunits(path)
+        return arr
+
+    def readarray_slice(self, path, start, stop, subindex=None):
+        self.toCGS = np.NaN 
+        sel = slice(start, stop, None)
+        if subindex is not None:
+            sel = (sel, subindex)
+        arr = self._convert(path, self._memmap(path)[sel])
+        self.toCGS = self.units.getunits(path)
+        return arr
+
+    def readarray_indices(self, path, indices, subindex=None, mergegap=1024):
+        self.toCGS = np.NaN 
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.where(indices)[0]
+        mm = self._memmap(path)
+        if subindex is None:
+            arr = np.array(mm[indices])
+        else:
+            arr = np.array(mm[indices, subindex])
+        del mm
+        arr = self._convert(path, arr)
+        self.toCGS = self.units.getunits(path)
+        return arr
+
+    def get_fileoffsets(self, parttype):
+        numpart = self.manifest['NumPart_Total'][parttype]
+        return np.array([0, numpart], dtype=np.int64)
+
+    def _metallicity_index(self, element):
+        if element == 'total':
+            atomno = 0
+        else:
+            atomno = name_to_atomnumber[element]
+        index = np.where([_atomno == atomno for _atomno in self._atomnos])
+        return index[0][0]
+
+    # Firesnap methods using the (first) snapshot file (self.ff)
+    def find_cosmopars(self):
+        '''
+        set the cosmological parameters from the manifest
+        '''
+        self.cosmopars = Cosmopars(self.manifest['cosmopars'])
+
+    def readattr(self, path, attribute):
+        '''
+        read in an attribute from the original snapshot (first file);
+        attributes are not stored in the flat files, so this only
+        works if that file is still available
+        '''
+        if not os.path.isfile(self.firstfilen):
+            msg = ('Attribute {} of {} is not stored in the flat '
+                   'snapshot {}, and the snapshot file {} is not '
+                   'available')
+            raise ValueError(msg.format(attribute, path, self.manifestfilen,
+                                        self.firstfilen))
+        with h5py.File(self.firstfilen, 'r') as f:
+            val = f[path].attrs[attribute]
+        if isbstr(val):
+            val = val.decode()
+        return val
+
+    def getmetadata(self):
+        '''
+        not available: Flatsnap objects are recreated from their 
+        manifest file (self.manifestfilen), not from snapshot 
+        catalogue metadata
+        '''
+        msg = ('Flatsnap objects have no snapshot catalogue metadata; '
+               'use the manifest file {}')
+        raise ValueError(msg.format(self.manifestfilen))
+
 class MockFireSpec:
     '''
     class to pass to functions expecting a snapshot object for testing
@@ -657,7 +1747,8 @@ class MockFireSpec:
             self._csm.update(cosmopars)
         self.cosmopars = Cosmopars(self._csm)
 
-    def readarray(self, field, subsample=1, subindex=None, errorflag=np.nan):
+    def readarray(self, field, subsample=1, subindex=None, errorflag=np.nan,
+                  usecache=True):
         self.toCGS = np.NaN
         sel = slice(None, None, subsample)
         if subindex is not None:
@@ -666,6 +1757,43 @@ class MockFireSpec:
         self.toCGS = self._units[field]
         return out
     
+    def readarray_indices(self, field, indices, subindex=None, 
+                          mergegap=1024):
+        self.toCGS = np.NaN
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.where(indices)[0]
+        if subindex is None:
+            out = np.copy(self._dict[field][indices])
+        else:
+            out = np.copy(self._dict[field][indices, subindex])
+        self.toCGS = self._units[field]
+        return out
+    
+    def readarray_elements(self, parttype, elements, subsample=1, 
+                           blocksize=2**22):
+        out = {}
+        for elt in elements:
+            if elt == 'total':
+                field = f'PartType{parttype}/Metallicity'
+            else:
+                field = f'PartType{parttype}/ElementAbundance/{elt}'
+            out[elt] = self.readarray(field, subsample=subsample)
+        self.toCGS = self._units[field]
+        return out
+
+    def iter_blocks(self, fields, blocksize=2**24, filter=None):
+        numpart = len(self._dict[fields[0]])
+        for start in range(0, numpart, blocksize):
+            blocksel = slice(start, min(start + blocksize, numpart), None)
+            blockdct = {}
+            for field in fields:
+                arr = np.copy(self._dict[field][blocksel])
+                if filter is not None:
+                    arr = arr[filter[blocksel]]
+                blockdct[field] = (arr, self._units[field])
+            yield blocksel, blockdct
+
     def readarray_emulateEAGLE(self, *args, **kwargs):
         return self.readarray(*args, **kwargs)
     
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Persistent per-simulation catalogue of snapshot metadata: for each
+snapshot number, the snapshot files, parameter file, redshift, 
+particle numbers, units, and cosmological parameters, as well as the
+list of output redshifts for the simulation. get_Firesnap, 
+findclosestz_snap, and findclosestzs_snaps use this to avoid probing 
+for files and parsing headers and parameter files on every call.
+
+The catalogues are JSON files in ol.dir_snapsidecars, one per 
+simulation directory. If opts_locs does not set dir_snapsidecars, no
+catalogues are used. Snapshot entries are checked against the 
+snapshot header and the size and modification time of the first 
+snapshot file when the snapshot is opened (get_Firesnap), and 
+replaced if they don't match.
+'''
+
+import hashlib
+import json
+import os
+
+import fire_an.utils.opts_locs as ol
+
+# catalogues already read in by this process
+_catalogues = {}
+
+def simkey(path):
+    '''
+    normalized simulation directory path: the same simulation can be 
+    specified with or without the 'output' subdirectory
+    '''
+    path = os.path.abspath(path)
+    if os.path.basename(path) == 'output':
+        path = os.path.dirname(path)
+    return path
+
+def catalogue_isenabled():
+    '''
+    whether there is a directory (opts_locs.dir_snapsidecars) to store
+    catalogues in
+    '''
+    return getattr(ol, 'dir_snapsidecars', None) is not None
+
+def catalogue_filen(path):
+    '''
+    catalogue file name for a simulation directory, or None if 
+    catalogues are not enabled
+    '''
+    if not catalogue_isenabled():
+        return None
+    key = simkey(path)
+    tag = hashlib.md5(key.encode()).hexdigest()[:12]
+    base = os.path.basename(key)
+    outdir = ol.dir_snapsidecars
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    return outdir + f'snapcatalogue_{base}_{tag}.json'
+
+def _read_catalogue(filen, key):
+    if os.path.isfile(filen):
+        try:
+            with open(filen, 'r') as f:
+                cat = json.load(f)
+            if cat['simpath'] == key:
+                return cat
+        except (OSError, ValueError, KeyError):
+            print(f'Could not read snapshot catalogue {filen}; ignoring it')
+    return {'simpath': key, 'snapshots': {}, 'outputzs': None}
+
+def load_catalogue(path):
+    '''
+    get the catalogue (dict) for a simulation directory; an empty 
+    catalogue if none is stored yet
+    '''
+    key = simkey(path)
+    if key not in _catalogues:
+        _catalogues[key] = _read_catalogue(catalogue_filen(path), key)
+    return _catalogues[key]
+
+def _update_catalogue(path, snapshots=None, removesnaps=None,
+                      outputzs=None):
+    '''
+    update the catalogue in memory and on disk. The stored file is 
+    re-read first, so entries added by other processes are kept.
+    Failure to write the file is not an error: the catalogue is only
+    used to save time.
+    '''
+    if not catalogue_isenabled():
+        return None
+    key = simkey(path)
+    filen = catalogue_filen(path)
+    cat = _read_catalogue(filen, key)
+    if snapshots is not None:
+        cat['snapshots'].update(snapshots)
+    if removesnaps is not None:
+        for snapkey in removesnaps:
+            if snapkey in cat['snapshots']:
+                del cat['snapshots'][snapkey]
+    if outputzs is not None:
+        cat['outputzs'] = outputzs
+    _catalogues[key] = cat
+    try:
+        outdir = os.path.dirname(filen)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        _tempfilen = filen + f'.{os.getpid()}.tmp'
+        with open(_tempfilen, 'w') as f:
+            json.dump(cat, f, indent=1)
+        os.replace(_tempfilen, filen)
+    except OSError as err:
+        print(f'Could not save snapshot catalogue {filen}: {err}')
+
+def get_snapentry(path, snapnum):
+    '''
+    get the stored metadata (dict) for a snapshot, or None
+    '''
+    if not catalogue_isenabled():
+        return None
+    cat = load_catalogue(path)
+    snapkey = str(snapnum)
+    if snapkey in cat['snapshots']:
+        return cat['snapshots'][snapkey]
+    return None
+
+def set_snapentry(path, snapnum, entry):
+    '''
+    store the metadata (dict, JSON-serializable) for a snapshot
+    '''
+    _update_catalogue(path, snapshots={str(snapnum): entry})
+
+def remove_snapentry(path, snapnum):
+    _update_catalogue(path, removesnaps=[str(snapnum)])
+
+def get_outputzs(path):
+    '''
+    get the stored output redshifts (list, index = snapshot number),
+    or None
+    '''
+    if not catalogue_isenabled():
+        return None
+    cat = load_catalogue(path)
+    if cat['outputzs'] is None:
+        return None
+    return cat['outputzs']['zvals']
+
+def set_outputzs(path, zvals, sourcefile):
+    '''
+    store the output redshifts (list, index = snapshot number), read 
+    from sourcefile
+    '''
+    outputzs = {'zvals': [float(zval) for zval in zvals],
+                'sourcefile': sourcefile}
+    _update_catalogue(path, outputzs=outputzs)
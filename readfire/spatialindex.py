@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Spatial index 'sidecar' files for FIRE snapshots: the particles of
+one type are assigned to cells of a fine regular grid (2**level cells
+per axis) covering the particle positions, and the (global) particle
+indices are stored sorted by the Morton (z-curve) key of their cell.
+Only the non-empty cells are stored: a sorted list of their keys and
+the matching offsets into the particle index list. Since the keys of
+all fine cells inside a coarser (octree) cell form one contiguous key
+range, a query can use any coarser level: the key ranges of the
+overlapping coarse cells are looked up in the stored keys
+(np.searchsorted), and only the matching parts of the index list are
+read, followed by only those particles from the snapshot. The query
+level is chosen per query, so small regions (e.g., a zoom halo in a
+large box) are resolved by small cells, without a dense table over
+the mostly empty grid.
+
+The snapshot file names, sizes, and modification times are stored
+with the index, and an index no longer matching the snapshot is
+not used. The snapshot files themselves are not modified. Queries
+are available through Firesnap.select_box and Firesnap.select_sphere.
+'''
+
+import h5py
+import hashlib
+import numpy as np
+import os
+
+import fire_an.readfire.gasstate as gs
+import fire_an.utils.opts_locs as ol
+
+# largest number of (coarse) cells to look up for a query
+maxquerycells = 4096
+
+
+def _part1by2(vals):
+    '''
+    spread out the bits of (up to 21-bit) integers, with two zero bits
+    between each input bit
+    '''
+    x = np.asarray(vals, dtype=np.uint64) & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+def mortonkeys(cellinds):
+    '''
+    get the Morton (z-curve) keys for integer cell indices
+
+    Parameters:
+    -----------
+    cellinds: int array, shape (N, 3)
+        cell indices along the x, y, and z axes
+
+    Returns:
+    --------
+    keys: uint64 array, shape (N,)
+    '''
+    keys = _part1by2(cellinds[:, 0])
+    keys |= _part1by2(cellinds[:, 1]) << np.uint64(1)
+    keys |= _part1by2(cellinds[:, 2]) << np.uint64(2)
+    return keys
+
+def sidecar_filen(snap, parttype, outdir=None):
+    '''
+    default spatial index file name for a snapshot (Firesnap object)
+    and particle type
+    '''
+    if outdir is None:
+        outdir = ol.dir_snapsidecars
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    snapfile = os.path.abspath(snap.firstfilen)
+    # snapshot file names are only unique with the directory path
+    tag = hashlib.md5(snapfile.encode()).hexdigest()[:12]
+    base = os.path.basename(snapfile).split('.')[0]
+    return outdir + f'spatialindex_{base}_{tag}_PartType{parttype}.hdf5'
+
+def make_spatialindex(snap, parttype, level=16, outfilen=None,
+                      overwrite=False):
+    '''
+    write a spatial index file for a snapshot and particle type
+
+    Parameters:
+    -----------
+    snap: Firesnap object
+        the snapshot to index
+    parttype: int
+        particle type (PartType<parttype> in the files)
+    level: int
+        the finest grid has 2**level cells along each axis (1 -- 21).
+        Only non-empty cells are stored, so the index size is at most
+        about the particle number, whatever the level. The default 
+        (16) gives ~1 ckpc/h cells for a 60 cMpc/h box.
+    outfilen: str or None
+        file to write the index to (including the full path). If None,
+        the sidecar_filen default is used.
+    overwrite: bool
+        overwrite an existing file (True) or raise a ValueError (False)
+
+    Returns:
+    --------
+    outfilen: str
+        the name of the index file
+    '''
+    if level < 1 or level > 21:
+        raise ValueError(f'level should be in 1 -- 21, not {level}')
+    if outfilen is None:
+        outfilen = sidecar_filen(snap, parttype)
+    if os.path.isfile(outfilen) and not overwrite:
+        raise ValueError('File {} already exists.'.format(outfilen))
+    cpath = f'PartType{parttype}/Coordinates'
+    coords = snap.readarray(cpath)
+    coords_toCGS = snap.toCGS
+    ncell = 2**level
+    cmin = np.min(coords, axis=0).astype(np.float64)
+    cmax = np.max(coords, axis=0).astype(np.float64)
+    # make sure the max. values fall inside the last cell
+    pad = 1e-6 * np.max(cmax - cmin)
+    cmax += pad
+    cellsize = (cmax - cmin) / ncell
+    keys = np.zeros(len(coords), dtype=np.uint64)
+    for i in range(3):
+        _cellinds = np.floor((coords[:, i] - cmin[i]) / cellsize[i])
+        np.clip(_cellinds, 0, ncell - 1, out=_cellinds)
+        keys |= _part1by2(_cellinds.astype(np.int64)) << np.uint64(i)
+        del _cellinds
+    del coords
+    # stable: keeps file order within cells -> more contiguous reads
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    cell_keys, cell_starts = np.unique(keys, return_index=True)
+    del keys
+    cell_offsets = np.append(cell_starts, len(order)).astype(np.int64)
+    sizes, mtimes = gs.snapfilestats(snap)
+
+    # write to a temporary file first: other processes might be
+    # reading the file
+    tempfilen = outfilen + '.{}.tmp'.format(os.getpid())
+    with h5py.File(tempfilen, 'w') as f:
+        f.create_dataset('order', data=order)
+        f.create_dataset('cell_keys', data=cell_keys)
+        f.create_dataset('cell_offsets', data=cell_offsets)
+        hed = f.create_group('Header')
+        hed.attrs.create('snapfile', np.string_(snap.firstfilen))
+        hed.attrs.create('snapfiles',
+                         np.array([np.string_(filen)
+                                   for filen in snap.filens]))
+        hed.attrs.create('snapfilesizes', sizes)
+        hed.attrs.create('snapfilemtimes', mtimes)
+        hed.attrs.create('parttype', parttype)
+        numpart = snap.get_fileoffsets(parttype)[-1]
+        hed.attrs.create('NumPart_Total', numpart)
+        hed.attrs.create('level', level)
+        hed.attrs.create('ncell', ncell)
+        hed.attrs.create('gridmin_simu', cmin)
+        hed.attrs.create('gridmax_simu', cmax)
+        hed.attrs.create('cellsize_simu', cellsize)
+        hed.attrs.create('coords_toCGS', coords_toCGS)
+        hed.attrs.create('cellorder', np.string_('Morton, sparse'))
+        _info = ('order: global particle indices sorted by the Morton '
+                 'key of their grid cell; cell_keys: sorted keys of the '
+                 'non-empty cells; particles in cell cell_keys[i] are '
+                 'order[cell_offsets[i]: cell_offsets[i + 1]]')
+        hed.attrs.create('info', np.string_(_info))
+    os.replace(tempfilen, outfilen)
+    print(f'Saved spatial index to {outfilen}')
+    return outfilen
+
+def spatialindex_isvalid(snap, filen, parttype):
+    '''
+    check whether a spatial index file exists, is in the current
+    (sparse) format, and matches the snapshot files (names, sizes, 
+    modification times, particle number)
+    '''
+    if not os.path.isfile(filen):
+        return False
+    try:
+        with h5py.File(filen, 'r') as f:
+            if 'cell_keys' not in f:
+                return False
+            hed = f['Header']
+            snapfiles = [_filen.decode() for _filen in 
+                         hed.attrs['snapfiles']]
+            sizes = hed.attrs['snapfilesizes']
+            mtimes = hed.attrs['snapfilemtimes']
+            numpart = hed.attrs['NumPart_Total']
+            _parttype = hed.attrs['parttype']
+    except (OSError, KeyError):
+        return False
+    if snapfiles != list(snap.filens) or _parttype != parttype:
+        return False
+    try:
+        _sizes, _mtimes = gs.snapfilestats(snap)
+    except OSError:
+        return False
+    if not (np.array_equal(sizes, _sizes)
+            and np.array_equal(mtimes, _mtimes)):
+        return False
+    return numpart == snap.get_fileoffsets(parttype)[-1]
+
+
+class SpatialIndex:
+    '''
+    read-in and queries for a spatial index file made with
+    make_spatialindex
+    '''
+    def __init__(self, filen, snap=None):
+        '''
+        Parameters:
+        -----------
+        filen: str
+            the index file (including the full path)
+        snap: Firesnap object or None
+            if given, check that the index matches this snapshot
+        '''
+        self.filen = filen
+        with h5py.File(self.filen, 'r') as f:
+            hed = f['Header']
+            self.parttype = int(hed.attrs['parttype'])
+            if snap is not None:
+                if not spatialindex_isvalid(snap, self.filen, 
+                                            self.parttype):
+                    msg = (f'Spatial index {self.filen} does not match '
+                           f'the current files of {snap.firstfilen}, or '
+                           'is in an old format; remake it with '
+                           'spatialindex.make_spatialindex')
+                    raise ValueError(msg)
+            self.numpart = int(hed.attrs['NumPart_Total'])
+            self.level = int(hed.attrs['level'])
+            self.ncell = int(hed.attrs['ncell'])
+            self.gridmin = hed.attrs['gridmin_simu']
+            self.gridmax = hed.attrs['gridmax_simu']
+            self.cellsize = hed.attrs['cellsize_simu']
+            self.coords_toCGS = hed.attrs['coords_toCGS']
+            self.cell_keys = f['cell_keys'][:]
+            self.cell_offsets = f['cell_offsets'][:]
+
+    def _cellrange(self, boxmin, boxmax):
+        '''
+        finest-level cell index ranges (inclusive) overlapping a box, 
+        or None if the box is outside the grid
+        '''
+        imin = np.floor((boxmin - self.gridmin) / self.cellsize)
+        imax = np.floor((boxmax - self.gridmin) / self.cellsize)
+        if np.any(imax < 0) or np.any(imin > self.ncell - 1):
+            return None
+        imin = np.clip(imin, 0, self.ncell - 1).astype(np.int64)
+        imax = np.clip(imax, 0, self.ncell - 1).astype(np.int64)
+        return imin, imax
+
+    def _querycells(self, imin, imax, maxcells):
+        '''
+        get the coarsest-needed level cells covering a finest-level 
+        cell index range: the finest level where at most maxcells cells
+        overlap the range.
+
+        Returns:
+        --------
+        cellinds: int array, shape (N, 3)
+            cell indices at the query level
+        shift: int
+            the query level is self.level - shift
+        '''
+        shift = 0
+        while shift < self.level:
+            num = np.prod((imax >> shift) - (imin >> shift) + 1)
+            if num <= maxcells:
+                break
+            shift += 1
+        _imin = imin >> shift
+        _imax = imax >> shift
+        grids = np.meshgrid(*[np.arange(_imin[i], _imax[i] + 1)
+                              for i in range(3)], indexing='ij')
+        cellinds = np.array([grid.flatten() for grid in grids]).T
+        return cellinds, shift
+
+    def _read_cells(self, cellinds, shift):
+        '''
+        get the sorted particle indices in the cells with the input
+        cell indices (int array, shape (N, 3)) at level 
+        self.level - shift. Only the parts of the particle index list 
+        for these cells are read in.
+        '''
+        if len(cellinds) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        keys = np.sort(mortonkeys(cellinds))
+        # finest-level key range of each (coarse) cell
+        _shift = np.uint64(3 * shift)
+        kstarts = keys << _shift
+        kends = (keys + np.uint64(1)) << _shift
+        starts = self.cell_offsets[np.searchsorted(self.cell_keys, kstarts)]
+        ends = self.cell_offsets[np.searchsorted(self.cell_keys, kends)]
+        # merge index ranges of consecutive cells
+        newrun = np.ones(len(keys), dtype=bool)
+        newrun[1:] = starts[1:] != ends[:-1]
+        rstarts = starts[newrun]
+        rends = ends[np.append(np.where(newrun)[0][1:] - 1, len(keys) - 1)]
+        out = []
+        with h5py.File(self.filen, 'r') as f:
+            ds = f['order']
+            for rstart, rend in zip(rstarts, rends):
+                if rend > rstart:
+                    out.append(ds[rstart: rend])
+        if len(out) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        out = np.concatenate(out)
+        out.sort()
+        return out
+
+    def candidates_box(self, boxmin, boxmax, maxcells=None):
+        '''
+        indices of particles in cells overlapping the box
+        boxmin -- boxmax (simulation coordinate units). The cells are
+        the smallest ones for which at most maxcells (default: 
+        module maxquerycells) overlap the box.
+        '''
+        if maxcells is None:
+            maxcells = maxquerycells
+        crange = self._cellrange(np.asarray(boxmin), np.asarray(boxmax))
+        if crange is None:
+            return np.zeros((0,), dtype=np.int64)
+        cellinds, shift = self._querycells(*crange, maxcells)
+        return self._read_cells(cellinds, shift)
+
+    def candidates_sphere(self, center, radius, maxcells=None):
+        '''
+        indices of particles in cells overlapping the sphere with the
+        given center and radius (simulation coordinate units). The 
+        cells are chosen as in candidates_box.
+        '''
+        if maxcells is None:
+            maxcells = maxquerycells
+        center = np.asarray(center, dtype=np.float64)
+        crange = self._cellrange(center - radius, center + radius)
+        if crange is None:
+            return np.zeros((0,), dtype=np.int64)
+        cellinds, shift = self._querycells(*crange, maxcells)
+        # distance from the center to the closest point in each cell
+        cellsize = self.cellsize * 2**shift
+        cmin = self.gridmin + cellinds * cellsize
+        cmax = cmin + cellsize
+        closest = np.clip(center[np.newaxis, :], cmin, cmax)
+        d2 = np.sum((closest - center[np.newaxis, :])**2, axis=1)
+        cellinds = cellinds[d2 <= radius**2]
+        return self._read_cells(cellinds, shift)
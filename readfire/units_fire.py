@@ -245,6 +245,34 @@ class Units:
          self.codevelocity_cm_per_s *= np.sqrt(self.a)
          self.codedensity_g_per_cm3 *= self.a**-3
     
+    def getdct(self):
+        '''
+        get the (processed) unit values as a dictionary (e.g., for 
+        storing); Units.fromdct recreates the Units object from this
+        '''
+        dct = {}
+        for key, val in self.__dict__.items():
+            if key == 'reqlist':
+                continue
+            if isinstance(val, (bool, np.bool_)):
+                dct[key] = bool(val)
+            else:
+                dct[key] = float(val)
+        return dct
+    
+    @classmethod
+    def fromdct(cls, dct):
+        '''
+        create a Units object from the output of getdct, without 
+        reading any files
+        '''
+        units = cls.__new__(cls)
+        units.__dict__.update(dct)
+        units.reqlist = ['a', 'HubbleParam', 'cosmoexp', 
+                         'codevelocity_cm_per_s', 'codemageneticfield_gauss',
+                         'codemass_g', 'codelength_cm']
+        return units
+
     def getunits(self, field):
         '''
         get the units for a FIRE simulation output field: 
@@ -1349,3 +1349,241 @@ def test_tablesum_interpolate_to_tabulated(ztargets = [0., 1., 3.],
             plt.colorbar(img, cax=cax)
             cax.set_ylabel(flabel, fontsize=fontsize)
             plt.savefig(_savename, bbox_inches='tight')
+
+def test_ps20_tablecache(ion='O6', z=0.7, tmpdir='./ps20tables_test/'):
+    '''
+    check that the shared (in-memory and on-disk) redshift-interpolated
+    ion balance tables match direct read-in and interpolation of the
+    ion balance table file, and that the parent element lookup matches
+    the Linetable_PS20 attributes
+    '''
+    import fire_an.ionrad.ion_utils as iu
+    import fire_an.utils.opts_locs as ol
+    tablefile = ol.iontab_sylvia_ssh
+    _dir_ps20tables = ol.dir_ps20tables
+    ol.dir_ps20tables = tmpdir
+    allgood = True
+    try:
+        for lintable in [False, True]:
+            iontab = Linetable_PS20(ion, z, emission=False, vol=True,
+                                    lintable=lintable)
+            iontab.findiontable()
+            iontab.finddepletiontable()
+            tablepath = 'Tdep/IonFractions/{eltnum:02d}{eltname}'
+            tablepath = tablepath.format(eltnum=iontab.eltind,
+                                         eltname=iontab.element.lower())
+            with h5py.File(tablefile, 'r') as f:
+                zs = f['TableBins/RedshiftBins'][:]
+                zi_hi = np.searchsorted(zs, z)
+                zi_lo = zi_hi - 1
+                wlo = (zs[zi_hi] - z) / (zs[zi_hi] - zs[zi_lo])
+                refs = []
+                for path, ind in [(tablepath, iontab.ionstage - 1),
+                                  ('Tdep/Depletion', iontab.eltind)]:
+                    tlo = f[path][zi_lo, :, 1:, :, ind]
+                    thi = f[path][zi_hi, :, 1:, :, ind]
+                    if lintable:
+                        tlo = 10**tlo
+                        thi = 10**thi
+                    refs.append(wlo * tlo + (1. - wlo) * thi)
+            good = np.allclose(iontab.iontable_T_Z_nH, refs[0])
+            good &= np.allclose(iontab.depletiontable_T_Z_nH, refs[1])
+            # second instance: same arrays
+            iontab2 = Linetable_PS20(ion, z, emission=False, vol=True,
+                                     lintable=lintable)
+            iontab2.findiontable()
+            good &= iontab2.iontable_T_Z_nH is iontab.iontable_T_Z_nH
+            # read from disk
+            iu._ps20tables.clear()
+            iontab2.findiontable()
+            good &= iontab2.iontable_T_Z_nH is not iontab.iontable_T_Z_nH
+            good &= np.array_equal(iontab2.iontable_T_Z_nH, 
+                                   iontab.iontable_T_Z_nH)
+            element, elementmass_u = iu.get_ps20_element(ion)
+            good &= element == iontab.element
+            good &= elementmass_u == iontab.elementmass_u
+            if not good:
+                print(f'Failed for lintable={lintable}')
+            allgood &= good
+        # no cache directory: tables are only kept in memory
+        del ol.dir_ps20tables
+        iu._ps20tables.clear()
+        iontab3 = Linetable_PS20(ion, z, emission=False, vol=True,
+                                 lintable=True)
+        iontab3.findiontable()
+        allgood &= np.array_equal(iontab3.iontable_T_Z_nH, 
+                                  iontab.iontable_T_Z_nH)
+    finally:
+        ol.dir_ps20tables = _dir_ps20tables
+    return allgood
+
+def test_tableinterpolator(seed=0, backend='C'):
+    '''
+    check that TableInterpolator (C interpolation function or NumPy 
+    backend) reproduces table values at the grid points, uses the edge
+    values outside the grid, and gives the same results for multiple 
+    tables in one call and into a preallocated output array as one 
+    table at a time
+    '''
+    import fire_an.ionrad.ion_utils as iu
+    rng = np.random.default_rng(seed)
+    logT = np.linspace(2., 9., 15)
+    logZ = np.linspace(-6., -1., 6)
+    lognH = np.linspace(-8., 2., 21)
+    tables = [rng.uniform(-5., 0., size=(15, 6, 21)) for _ in range(3)]
+    interp = iu.TableInterpolator(logT, logZ, lognH, tables, 
+                                  backend=backend, blocksize=1000, 
+                                  nthreads=2)
+    # grid points, and points outside the grid on all sides
+    gT, gZ, gnH = np.meshgrid(logT, logZ, lognH, indexing='ij')
+    pT = np.append(gT.ravel(), [1., 10., 5., 5.])
+    pZ = np.append(gZ.ravel(), [-3., -3., -10., 0.])
+    pnH = np.append(gnH.ravel(), [-9., 3., 0., -10.])
+    parts = [arr.astype(np.float32) for arr in (pT, pZ, pnH)]
+    res = interp(*parts)
+    allgood = True
+    for ti, table in enumerate(tables):
+        expected = np.append(table.ravel(), 
+                             [table[0, 3, 0], table[-1, 3, -1],
+                              table[6, 0, 16], table[6, -1, 0]])
+        good = np.allclose(res[ti], expected, rtol=1e-6, atol=1e-6)
+        single = iu.TableInterpolator(logT, logZ, lognH, [table],
+                                      backend=backend)(*parts)
+        good &= np.array_equal(single[0], res[ti])
+        if not good:
+            print(f'Failed for table {ti}')
+        allgood &= good
+    out = np.empty((3, len(pT)), dtype=np.float32)
+    _out = interp(*parts, out=out)
+    allgood &= _out is out
+    allgood &= np.array_equal(out, res)
+    return allgood
+
+def _randomtables_particles(numpart, ntables=2, seed=0):
+    rng = np.random.default_rng(seed)
+    # grid similar to the PS20 tables
+    logT = np.linspace(1., 9.5, 86)
+    logZ = np.log10(0.0134) + np.array([-4., -3., -2., -1.5, -1., -0.5, 
+                                        0., 0.5])
+    lognH = np.linspace(-8., 6., 141)
+    tables = [rng.uniform(-8., 0., size=(len(logT), len(logZ), 
+                                         len(lognH)))
+              for _ in range(ntables)]
+    # particles include some outside the grid
+    parts = [rng.uniform(0., 10., numpart).astype(np.float32),
+             rng.uniform(-8., 0., numpart).astype(np.float32),
+             rng.uniform(-9., 7., numpart).astype(np.float32)]
+    return (logT, logZ, lognH), tables, parts
+
+def test_tableinterpolator_numpy_vs_C(numpart=10**6, ntables=2):
+    '''
+    check that the NumPy TableInterpolator backend matches the C 
+    interpolation function (opts_locs.c_interpfile), including edge
+    handling, for random particles on a PS20-like grid
+    '''
+    import fire_an.ionrad.ion_utils as iu
+    grids, tables, parts = _randomtables_particles(numpart, 
+                                                   ntables=ntables)
+    res_c = iu.TableInterpolator(*grids, tables, backend='C')(*parts)
+    allgood = True
+    for nthreads in [1, 4]:
+        res_n = iu.TableInterpolator(*grids, tables, backend='numpy',
+                                     nthreads=nthreads)(*parts)
+        maxdiff = np.max(np.abs(res_n - res_c))
+        print(f'nthreads {nthreads}: max. abs. difference {maxdiff:.2e}')
+        allgood &= np.allclose(res_n, res_c, rtol=1e-5, atol=1e-5)
+    return allgood
+
+def benchmark_tableinterpolator(numpart=10**7, ntables=(1, 3), 
+                                nthreads=(1, 2, 4, 8), blocksize=2**16):
+    '''
+    time the C and NumPy (for different numbers of threads) 
+    TableInterpolator backends
+    '''
+    import time
+    import fire_an.ionrad.ion_utils as iu
+    out = {}
+    for ntab in ntables:
+        grids, tables, parts = _randomtables_particles(numpart, 
+                                                       ntables=ntab)
+        start = time.time()
+        iu.TableInterpolator(*grids, tables, backend='C')(*parts)
+        t_c = time.time() - start
+        print(f'{ntab} tables, C: {t_c:.2f} s for {numpart} particles')
+        out[(ntab, 'C')] = t_c
+        for _nthreads in nthreads:
+            interp = iu.TableInterpolator(*grids, tables, backend='numpy',
+                                          nthreads=_nthreads, 
+                                          blocksize=blocksize)
+            start = time.time()
+            interp(*parts)
+            t_n = time.time() - start
+            print(f'{ntab} tables, numpy, {_nthreads} threads: '
+                  f'{t_n:.2f} s ({t_c / t_n:.2f} x C speed)')
+            out[(ntab, 'numpy', _nthreads)] = t_n
+    return out
+
+def test_find_ionbals(ions=('O6', 'O7', 'O8', 'H1'), z=0.7, 
+                      numpart=10**5, seed=0):
+    '''
+    check that ion balances for multiple ions at once 
+    (ion_utils.find_ionbals) match those for one ion at a time 
+    (Linetable_PS20.find_ionbal), with and without depletion
+    '''
+    import fire_an.ionrad.ion_utils as iu
+    rng = np.random.default_rng(seed)
+    dct = {'logT': rng.uniform(1., 9.5, numpart).astype(np.float32),
+           'lognH': rng.uniform(-8., 2., numpart).astype(np.float32),
+           'logZ': rng.uniform(-7., -1., numpart).astype(np.float32)}
+    allgood = True
+    for lintable in [True, False]:
+        for depletion in [False, True]:
+            res = iu.find_ionbals(ions, z, dct, depletion=depletion,
+                                  lintable=lintable, backend='numpy')
+            for ion in ions:
+                iontab = Linetable_PS20(ion, z, emission=False, vol=True,
+                                        lintable=lintable)
+                ref = iontab.find_ionbal(dct, depletion=depletion)
+                good = np.allclose(res[ion], ref, rtol=1e-5, atol=1e-30)
+                if not good:
+                    print(f'Failed for {ion}, lintable {lintable}, '
+                          f'depletion {depletion}')
+                allgood &= good
+    return allgood
+
+def benchmark_find_ionbals(ions=('C1', 'C2', 'C3', 'C4', 'C5', 'C6', 
+                                 'O6', 'Ne8', 'Mg10', 'H1'),
+                           z=0.5, numpart=10**7, seed=0):
+    '''
+    time ion balance interpolation for a series of ions, one ion at a 
+    time (Linetable_PS20.find_ionbal) and all at once 
+    (ion_utils.find_ionbals), with the NumPy interpolation backend
+    '''
+    import time
+    import fire_an.ionrad.ion_utils as iu
+    rng = np.random.default_rng(seed)
+    dct = {'logT': rng.uniform(1., 9.5, numpart).astype(np.float32),
+           'lognH': rng.uniform(-8., 2., numpart).astype(np.float32),
+           'logZ': rng.uniform(-7., -1., numpart).astype(np.float32)}
+    # read in the tables first
+    iu.find_ionbals(ions, z, dct_T_Z_nH={key: dct[key][:10] 
+                                         for key in dct},
+                    depletion=True)
+    _backend = iu.interp_backend
+    iu.interp_backend = 'numpy'
+    try:
+        start = time.time()
+        for ion in ions:
+            iontab = Linetable_PS20(ion, z, emission=False, vol=True,
+                                    lintable=True)
+            iontab.find_ionbal(dct, depletion=True)
+        t_single = time.time() - start
+    finally:
+        iu.interp_backend = _backend
+    start = time.time()
+    iu.find_ionbals(ions, z, dct, depletion=True, lintable=True,
+                    backend='numpy')
+    t_batch = time.time() - start
+    print(f'{len(ions)} ions, {numpart} particles: one at a time '
+          f'{t_single:.2f} s, together {t_batch:.2f} s')
+    return t_single, t_batch
@@ -273,3 +273,262 @@ def masstest_map(filens):
     print('Found enclosed mass in projection = {:.3e} g'.format(enclmass))
 
 
+
+def test_massmap_batch(dirpath, snapnum, outdir, axes=('x', 'y', 'z')):
+    '''
+    check that massmap_batch gives the same maps as massmap run
+    separately for each quantity and axis
+    '''
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    mapspecs = [('Mass', None),
+                ('ion', {'ion': 'O6'}),
+                ('Metal', {'element': 'Oxygen'}),
+                ('sim-direct', {'field': 'Temperature'}, 'Mass', None)]
+    outfilens_batch = [outdir + f'batch_spec{i}_{{ax}}.hdf5' 
+                       for i in range(len(mapspecs))]
+    outfilens_single = [outdir + f'single_spec{i}_{{ax}}.hdf5' 
+                        for i in range(len(mapspecs))]
+    mm.massmap_batch(dirpath, snapnum, mapspecs, list(axes),
+                     outfilens_batch, radius_rvir=1., pixsize_pkpc=10.)
+    allsame = True
+    for spec, filen_b, filen_s in zip(mapspecs, outfilens_batch, 
+                                      outfilens_single):
+        weighttype = spec[2] if len(spec) > 2 else None
+        weighttype_args = spec[3] if len(spec) > 3 else None
+        for ax in axes:
+            mm.massmap(dirpath, snapnum, radius_rvir=1., pixsize_pkpc=10.,
+                       axis=ax, outfilen=filen_s.format(ax=ax),
+                       maptype=spec[0], maptype_args=spec[1],
+                       weighttype=weighttype, 
+                       weighttype_args=weighttype_args)
+            with h5py.File(filen_b.format(ax=ax), 'r') as fb, \
+                    h5py.File(filen_s.format(ax=ax), 'r') as fs:
+                map_b = fb['map'][:]
+                map_s = fs['map'][:]
+                margin_b = fb['Header/inputpars'].attrs['margin_lsmooth_cm']
+                margin_s = fs['Header/inputpars'].attrs['margin_lsmooth_cm']
+            same = np.allclose(map_b, map_s, rtol=1e-5, equal_nan=True)
+            same &= np.isclose(margin_b, margin_s)
+            if not same:
+                print(f'Maps {filen_b}, {filen_s} differ for axis {ax}')
+            allsame &= same
+    return allsame
+
+def test_mappyramid(shape=(75, 64), levels=3):
+    '''
+    check that coarse map levels conserve the total projected 
+    quantity and the weighted totals of weighted quantities (for 
+    even map sizes; for odd sizes, edge pixels cover a smaller area)
+    '''
+    rng = np.random.default_rng(0)
+    mapW = rng.lognormal(size=shape).astype(np.float32)
+    mapQ = rng.uniform(1., 2., size=shape).astype(np.float32)
+    pyramid = mm.mappyramid(mapW, mapQ, levels=levels)
+    allgood = True
+    for level, (_mapW, _mapQ) in enumerate(pyramid):
+        factor = 2**(level + 1)
+        expshape = tuple((np.array(shape) - 1) // factor + 1)
+        good = _mapW.shape == expshape and _mapQ.shape == expshape
+        # even-sized part of the map
+        nx = shape[0] // factor
+        ny = shape[1] // factor
+        wsum = np.sum(mapW[:nx * factor, :ny * factor], dtype=np.float64)
+        wqsum = np.sum(mapW[:nx * factor, :ny * factor] 
+                       * mapQ[:nx * factor, :ny * factor], 
+                       dtype=np.float64)
+        _wsum = np.sum(_mapW[:nx, :ny], dtype=np.float64) * factor**2
+        _wqsum = np.sum(_mapW[:nx, :ny] * _mapQ[:nx, :ny], 
+                        dtype=np.float64) * factor**2
+        good &= np.isclose(wsum, _wsum, rtol=1e-5)
+        good &= np.isclose(wqsum, _wqsum, rtol=1e-5)
+        if not good:
+            print(f'Failed for level {level + 1}')
+        allgood &= good
+    return allgood
+
+def test_savemap_allmasked(outfilen='./allmasked_test.hdf5', 
+                           shape=(20, 30)):
+    '''
+    check that maps (and pyramid levels) with all pixels masked by 
+    mincol can be stored, with NaN min/max attributes where there are
+    no values
+    '''
+    rng = np.random.default_rng(0)
+    storeopts = {'compression': None, 'compression_opts': None,
+                 'shuffle': False}
+    good = True
+    with h5py.File(outfilen, 'w') as f:
+        for logmap in [True, False]:
+            # projected quantity: -inf (log) or 0 (linear)
+            mapW = rng.uniform(1., 2., size=shape)
+            levels = [(mapW, None)] + mm.mappyramid(mapW, levels=2)
+            outmaps = [mm._outmaps(_mapW, None, 1., None, logmap, False,
+                                   False, mincol=10.)
+                       for _mapW, _ in levels]
+            name = f'W_log{logmap}'
+            mm._savemapds(f, name, outmaps[0][0], logmap, storeopts)
+            mm._savepyramid(f, name, outmaps, 0, logmap, 1., storeopts)
+            # weighted quantity: NaN
+            mapW = rng.uniform(1., 2., size=shape)
+            mapQ = rng.uniform(1., 2., size=shape)
+            omapQ, _ = mm._outmaps(mapW, mapQ, 1., 1., logmap, False,
+                                   False, mincol=10.)
+            name = f'Q_log{logmap}'
+            mm._savemapds(f, name, omapQ, logmap, storeopts)
+        good &= f['W_logTrue'].attrs['max'] == -np.inf
+        good &= np.isnan(f['W_logTrue'].attrs['minfinite'])
+        good &= np.isnan(f['W_logTrue_pyramid/level1'].attrs['minfinite'])
+        good &= f['W_logFalse'].attrs['min'] == 0.
+        good &= f['W_logFalse'].attrs['max'] == 0.
+        good &= np.isnan(f['Q_logTrue'].attrs['minfinite'])
+        good &= np.isnan(f['Q_logTrue'].attrs['max'])
+        good &= np.isnan(f['Q_logFalse'].attrs['min'])
+        good &= np.isnan(f['Q_logFalse'].attrs['max'])
+    os.remove(outfilen)
+    return good
+
+def test_radprof_vs_map(filens, rbins, rbin_units='pkpc',
+                        profiles=('av-lin', 'av-log', 'min', 'max', 
+                                  'perc-0.5', 'perc-0.9')):
+    '''
+    compare impact parameter profiles from the annular statistics 
+    stored with massmap(..., radprof=...) to those calculated from the 
+    stored maps. Percentiles for multiple files come from histograms, 
+    so these only match to about the histogram bin size (more in 
+    small annuli, where np.quantile interpolates between sparse 
+    values).
+    '''
+    import fire_an.makeplots.get_2dprof as gpr
+    _rbins, _rbin_units, prs = gpr.get_profile_radprof(filens, 
+                                                       profiles=profiles)
+    good = np.allclose(_rbins, rbins) and _rbin_units == rbin_units
+    prs_map = gpr.get_profile_massmap(filens, rbins, 
+                                      rbin_units=rbin_units,
+                                      profiles=profiles)
+    for prof, pr, pr_map in zip(profiles, prs, prs_map):
+        if prof.startswith('perc-') and not isinstance(filens, str):
+            _good = np.allclose(pr, pr_map, atol=0.05, equal_nan=True)
+        else:
+            _good = np.allclose(pr, pr_map, rtol=1e-5, equal_nan=True)
+        if not _good:
+            print(f'Profile {prof} does not match')
+            print(pr)
+            print(pr_map)
+        good &= _good
+    return good
+
+def test_profiles_massmaps(filens, rbins, rbin_units='pkpc',
+                           profiles=('av-lin', 'av-log', 'min', 'max', 
+                                     'perc-0.5', 'perc-0.9')):
+    '''
+    check that the batched per-map profiles from get_profiles_massmaps
+    match the get_profile_massmap profiles for the individual maps
+    '''
+    import fire_an.makeplots.get_2dprof as gpr
+    prs = gpr.get_profiles_massmaps(filens, rbins, rbin_units=rbin_units,
+                                    profiles=profiles)
+    good = True
+    for fi, filen in enumerate(filens):
+        prs_single = gpr.get_profile_massmap(filen, rbins, 
+                                             rbin_units=rbin_units,
+                                             profiles=profiles)
+        for prof, pr, pr_single in zip(profiles, prs, prs_single):
+            _good = np.allclose(pr[fi], pr_single, rtol=1e-5, 
+                                equal_nan=True)
+            if not _good:
+                print(f'Profile {prof} does not match for {filen}')
+            good &= _good
+    return good
+
+def test_profile_minmax(filen, rbins, rbin_units='pkpc'):
+    '''
+    check that the 'min' and 'max' profiles from get_profile_massmap
+    are the minimum and maximum pixel values in each radial bin (the 
+    'min' option used to return the maximum)
+    '''
+    import fire_an.makeplots.get_2dprof as gpr
+    prmin, prmax = gpr.get_profile_massmap(filen, rbins, 
+                                           rbin_units=rbin_units,
+                                           profiles=['min', 'max'])
+    rvals, mvals = gpr.get_rval_massmap(filen, units=rbin_units)
+    binis = np.searchsorted(rbins, rvals, side='right') - 1
+    refmin = np.array([np.min(mvals[binis == bi]) 
+                       for bi in range(len(rbins) - 1)])
+    refmax = np.array([np.max(mvals[binis == bi]) 
+                       for bi in range(len(rbins) - 1)])
+    good = np.allclose(prmin, refmin) and np.allclose(prmax, refmax)
+    if not good:
+        print('min/max profiles do not match the pixel values')
+    return good
+
+def test_rval_massmap_repeat(filen, units='pkpc', ncalls=3):
+    '''
+    check that repeated get_rval_massmap calls for the same map 
+    return the same radii (the cached pixel distances are shared 
+    between calls)
+    '''
+    import fire_an.makeplots.get_2dprof as gpr
+    r0, m0 = gpr.get_rval_massmap(filen, units=units)
+    good = True
+    for _ in range(ncalls - 1):
+        r1, m1 = gpr.get_rval_massmap(filen, units=units)
+        good &= np.array_equal(r0, r1) and np.array_equal(m0, m1)
+    if not good:
+        print('Radii changed between calls')
+    return good
+
+def test_stackmaps(filens, rbins, rbin_units='pkpc', 
+                   profiles=('av-lin', 'av-log', 'min', 'max', 
+                             'perc-0.5', 'perc-0.9', 'fcov-14.0'),
+                   nproc=2):
+    '''
+    compare stacked profiles from stackmaps.stack_profiles (first 
+    run: calculated, second run: cached reductions) to 
+    get_profile_massmap for the same files. Percentiles come from
+    histograms in the stacks, so these only match to about the 
+    histogram bin size (see test_radprof_vs_map); they are only 
+    compared for annuli with at least 1000 pixels in the stack.
+    Also check the median map from stackmaps.stack_maps (the files 
+    must have the same map shape and pixel size for that).
+    '''
+    import tempfile
+    import fire_an.makeplots.get_2dprof as gpr
+    import fire_an.makeplots.stackmaps as sm
+    prs_map = gpr.get_profile_massmap(filens, rbins, 
+                                      rbin_units=rbin_units,
+                                      profiles=profiles)
+    # pixels per annulus in the stack
+    with h5py.File(filens[0], 'r') as f:
+        _map, pixsize_pkpc, center_pix, _ = gpr.readmap(f)
+        rfactor = gpr._rfactor(f, pixsize_pkpc, rbin_units)
+    ri = gpr.get_radiusindex(_map.shape, center_pix)
+    starts, ends = ri.segments(rbins, factor=rfactor)
+    percsel = (ends - starts) * len(filens) >= 1000
+    good = True
+    with tempfile.TemporaryDirectory() as cachedir:
+        for _nproc in [nproc, 1]:
+            prs = sm.stack_profiles(filens, rbins, rbin_units=rbin_units,
+                                    profiles=profiles, nproc=_nproc,
+                                    cachedir=cachedir)
+            for prof, pr, pr_map in zip(profiles, prs, prs_map):
+                if prof.startswith('perc-'):
+                    _good = np.allclose(pr[percsel], pr_map[percsel], 
+                                        atol=0.05, equal_nan=True)
+                else:
+                    _good = np.allclose(pr, pr_map, rtol=1e-5, 
+                                        equal_nan=True)
+                if not _good:
+                    print(f'Profile {prof} does not match (nproc {_nproc})')
+                good &= _good
+    medmap = sm.stack_maps(filens, stats=('perc-0.5',), blockrows=50, 
+                           nproc=nproc)[0]
+    maps = []
+    for filen in filens:
+        with h5py.File(filen, 'r') as f:
+            maps.append(f['map'][:])
+    _good = np.allclose(medmap, np.median(maps, axis=0))
+    if not _good:
+        print('Median maps do not match')
+    good &= _good
+    return good
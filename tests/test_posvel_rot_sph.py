@@ -340,3 +340,34 @@ def test_sph_coords():
     return phiring_match & thetaring_match & phiring_rot_match 
 
 
+
+def test_center_rotate_inplace(numpart=100003, blocksize=4096):
+    '''
+    check the blocked, in-place centering, rotation, and region 
+    selection (as used in makemap.massmap_batch) against the 
+    full-array versions
+    '''
+    rng = np.random.default_rng(2)
+    coords = rng.uniform(-1., 1., size=(numpart, 3)).astype(np.float32)
+    center = np.array([0.1, -0.2, 0.05])
+    boxhalfsize = np.array([0.5, 0.6, 0.4])
+    allgood = True
+    for zdir in zdir_tests:
+        rm = crd.rotmatrix_from_zdir(zdir)
+        _coords = coords.copy()
+        excess = crd.center_rotate_inplace(_coords, center, rotmatrix=rm,
+                                           boxhalfsize=boxhalfsize,
+                                           blocksize=blocksize)
+        ref = np.einsum('kj,ij->ik', rm.astype(np.float32), 
+                        coords - center.astype(np.float32))
+        good = np.allclose(_coords, ref, atol=1e-6)
+        sel_ref = np.all(np.abs(ref) <= boxhalfsize + 0.1, axis=1)
+        good &= np.sum(np.logical_xor(excess <= 0.1, sel_ref)) <= 2
+        _ref = _coords[excess <= 0.1]
+        _sel = crd.compress_inplace(_coords, excess <= 0.1, 
+                                    blocksize=blocksize)
+        good &= np.array_equal(_sel, _ref)
+        if not good:
+            print(f'Failed for z direction {zdir}')
+        allgood &= good
+    return allgood
@@ -0,0 +1,264 @@
+import numpy as np
+import time
+
+import fire_an.utils.projection as pr
+
+
+def _randomparticles(numpart, boxsize=1., hmed=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = rng.uniform(-0.5 * boxsize, 0.5 * boxsize,
+                         size=(numpart, 3)).astype(np.float32)
+    lsmooth = (hmed * rng.lognormal(sigma=0.5, size=numpart)).astype(
+        np.float32)
+    qW = rng.uniform(0.5, 1.5, size=numpart).astype(np.float32)
+    qQ = rng.uniform(1., 2., size=numpart).astype(np.float32)
+    return {'coords': coords, 'lsmooth': lsmooth, 'qW': qW, 'qQ': qQ}
+
+def test_projkernel_norm(kernel='C2'):
+    '''
+    check that the projected kernel integrates to the same value as
+    the 3D kernel
+    '''
+    # 3D integral: 4 pi int u^2 W(u) du
+    u = np.linspace(0., 1., 20001)
+    du = u[1] - u[0]
+    def _trapz(vals):
+        return du * (np.sum(vals) - 0.5 * (vals[0] + vals[-1]))
+    int3d = _trapz(4. * np.pi * u**2 * pr.kernels[kernel](u))
+    # 2D integral: 2 pi int u F(u) du
+    int2d = _trapz(2. * np.pi * u * pr.projkernel(u, kernel=kernel))
+    kt = pr.ProjKernelTable(kernel=kernel, usecache=False)
+    print(f'{kernel}: 3D integral {int3d:.6f}, 2D integral {int2d:.6f},'
+          f' table {kt.norm:.6f}')
+    return np.isclose(int3d, int2d, rtol=1e-4) \
+           and np.isclose(int3d, kt.norm, rtol=1e-4)
+
+def test_project_numpy_conservation(numpart=10000, npix=200):
+    '''
+    all qW should end up in the map for particles well inside the
+    map; for periodic maps, everything should be conserved. qQ
+    values should be within the input range.
+    '''
+    dct = _randomparticles(numpart)
+    # keep the particles and their kernels inside the map
+    dct['coords'] *= 0.8
+    Ls = [1., 1., 1.]
+    box3 = [1., 1., 1.]
+    allgood = True
+    for periodic in [False, True]:
+        if periodic:
+            _dct = dct.copy()
+            _dct['coords'] = dct['coords'] + 0.5
+        else:
+            _dct = dct
+        for kernel in ['C2', 'gadget']:
+            resW, resQ = pr.project(numpart, Ls, 0, 1, 2, box3, periodic,
+                                    npix, npix, kernel, _dct, False,
+                                    backend='numpy')
+            wsum = np.sum(dct['qW'].astype(np.float64))
+            good = np.isclose(np.sum(resW, dtype=np.float64), wsum,
+                              rtol=1e-5)
+            qsel = resW > 0.
+            good &= np.all(resQ[qsel] >= 1. - 1e-5)
+            good &= np.all(resQ[qsel] <= 2. + 1e-5)
+            if not good:
+                print(f'Failed for periodic={periodic}, kernel={kernel}')
+            allgood &= good
+    return allgood
+
+def benchmark_projection_backends(numpart=10**6, npix=800, hmed=0.005,
+                                  periodic=False, kernel='C2'):
+    '''
+    time the NumPy and C projection backends for the same random
+    particles, and compare the resulting maps. The C backend needs the
+    HsmlAndProject libraries in opts_locs.hsml_dir.
+    The kernel shapes differ a bit between the backends (the C
+    libraries use the 3D kernel at the pixel center impact parameter,
+    the NumPy version the line-of-sight integral), so the maps are not
+    expected to be identical, but the totals should match.
+    '''
+    dct = _randomparticles(numpart, hmed=hmed)
+    if periodic:
+        dct['coords'] += 0.5
+    Ls = [1., 1., 1.]
+    box3 = [1., 1., 1.]
+    out = {}
+    for backend in ['numpy', 'C']:
+        start = time.time()
+        resW, resQ = pr.project(numpart, Ls, 0, 1, 2, box3, periodic,
+                                npix, npix, kernel, dct, False,
+                                ompproj=True, backend=backend)
+        out[backend] = (resW, resQ, time.time() - start)
+    for backend in out:
+        print(f'{backend}: {out[backend][2]:.2f} s for {numpart} particles'
+              f' on {npix}**2 pixels')
+    resW_n, resQ_n, _ = out['numpy']
+    resW_c, resQ_c, _ = out['C']
+    print('total W: numpy {:.6e}, C {:.6e}'.format(np.sum(resW_n),
+                                                   np.sum(resW_c)))
+    sel = np.logical_and(resW_n > 0., resW_c > 0.)
+    wratio = np.log10(resW_n[sel] / resW_c[sel])
+    qratio = np.log10(resQ_n[sel] / resQ_c[sel])
+    print('log10 W ratio (numpy / C) pixels: '
+          'median {:.4f}, 1st/99th perc. {:.4f}, {:.4f}'.format(
+           np.median(wratio), *np.percentile(wratio, [1., 99.])))
+    print('log10 Q ratio (numpy / C) pixels: '
+          'median {:.4f}, 1st/99th perc. {:.4f}, {:.4f}'.format(
+           np.median(qratio), *np.percentile(qratio, [1., 99.])))
+    return out
+
+def test_project_tiled(numpart=20000, npix_x=150, npix_y=120, nproc=2,
+                       backend='numpy'):
+    '''
+    check that tiled projections match the untiled ones, for periodic
+    and non-periodic maps, in one and multiple processes
+    '''
+    dct = _randomparticles(numpart, hmed=0.03)
+    box3 = [1., 1., 1.]
+    allgood = True
+    for periodic in [False, True]:
+        if periodic:
+            _dct = dct.copy()
+            _dct['coords'] = dct['coords'] + 0.5
+            _Ls = [1., 1., 0.6]
+        else:
+            _dct = dct
+            _Ls = [0.8, 0.7, 0.6]
+        resW, resQ = pr.project(numpart, _Ls, 0, 1, 2, box3, periodic,
+                                npix_x, npix_y, 'C2', _dct, False,
+                                backend=backend)
+        for _nproc in [1, nproc]:
+            tresW, tresQ = pr.project_tiled(numpart, _Ls, 0, 1, 2, box3, 
+                                            periodic, npix_x, npix_y, 'C2',
+                                            _dct, False, backend=backend,
+                                            ntiles_x=3, ntiles_y=2,
+                                            nproc=_nproc)
+            good = np.allclose(resW, tresW, rtol=1e-4, 
+                               atol=1e-6 * np.max(resW))
+            good &= np.allclose(resQ, tresQ, rtol=1e-4, atol=1e-6)
+            if not good:
+                print(f'Failed for periodic={periodic}, nproc={_nproc}')
+            allgood &= good
+    return allgood
+
+def benchmark_projkernel_table(kernel='C2', ntabs=(65, 257, 1025, 4097),
+                               neval=10**6):
+    '''
+    accuracy and speed of ProjKernelTable interpolation compared to 
+    direct calculation of the kernel line-of-sight integral
+    '''
+    # reference: accurate integrals on a fine grid
+    u2_ref = np.linspace(0., 1., 20001)
+    ref = pr.projkernel(np.sqrt(u2_ref), kernel=kernel, nlos=128)
+    rng = np.random.default_rng(1)
+    u2 = rng.uniform(0., 1.1, size=neval)
+    start = time.time()
+    pr.projkernel(np.sqrt(u2), kernel=kernel)
+    t_direct = time.time() - start
+    print(f'{kernel}: direct calculation: {t_direct:.3f} s for '
+          f'{neval} values')
+    out = {}
+    for ntab in ntabs:
+        kt = pr.ProjKernelTable(kernel=kernel, ntab=ntab, usecache=False)
+        maxerr = np.max(np.abs(kt(u2_ref) - ref)) / ref[0]
+        start = time.time()
+        kt(u2)
+        t_table = time.time() - start
+        print(f'ntab {ntab}: max. error / central value {maxerr:.1e}, '
+              f'{t_table:.3f} s ({t_direct / t_table:.1f} x faster)')
+        out[ntab] = (maxerr, t_table)
+    return out
+
+def test_ppv_peakvels(numpart=3000, npix_x=40, npix_y=30, 
+                      smoothsigmas=(10., 25.)):
+    '''
+    compare the p-p-v peak velocities from proc_ppv.ppv_peakvels 
+    (tiled, FFT smoothing) to those from a full p-p-v cube smoothed 
+    with scipy.signal.convolve, as in proc_ppv.smoothmax_ppv, with 
+    and without thermal broadening (one thermal b bin).
+    '''
+    import scipy.signal as spsig
+    import scipy.special as spspec
+    import fire_an.mainfunc.proc_ppv as pp
+    dct = _randomparticles(numpart, hmed=0.03)
+    dct['coords'] *= 0.8
+    rng = np.random.default_rng(5)
+    dct['vlos'] = rng.normal(0., 60., size=numpart).astype(np.float32)
+    vmin = -200.
+    dv = 10.
+    nv = 40
+    Ls = [1., 1., 1.]
+    box3 = [1., 1., 1.]
+    def _kernel(sigma):
+        vlim = np.floor(-3. * sigma / dv) * dv
+        vbins = np.arange(vlim - 0.5 * dv, -vlim + dv, dv)
+        kern = spspec.erf(vbins[1:] / sigma) - spspec.erf(vbins[:-1] / sigma)
+        return kern / np.sum(kern)
+    # reference cube
+    cube = np.zeros((npix_x * npix_y, nv))
+    vbin = np.floor((dct['vlos'] - vmin) / dv).astype(int)
+    vsel = np.logical_and(vbin >= 0, vbin < nv)
+    _dct = dct.copy()
+    _dct['qW'] = np.where(vsel, dct['qW'], 0.)
+    for pinds, pixinds, wk in pr.kernelpairs(numpart, Ls, 0, 1, 2, box3, 
+                                             False, npix_x, npix_y, 'C2', 
+                                             _dct):
+        np.add.at(cube, (pixinds, vbin[pinds]), wk * _dct['qW'][pinds])
+    hasW = np.sum(cube, axis=1) > 0.
+    allgood = True
+    # b parameter at a thermal bin center
+    for bth in [0., 10**(20.5 * 0.05)]:
+        _cube = cube
+        vcens = vmin + (np.arange(nv) + 0.5) * dv
+        if bth > 0.:
+            dct['bth'] = np.full(numpart, bth)
+            kern = _kernel(bth)
+            _cube = spsig.convolve(cube, kern[np.newaxis, :], mode='full')
+            vcens = vcens[0] + (np.arange(_cube.shape[1]) 
+                                - len(kern) // 2) * dv
+        vpeak_ref = [vcens[np.argmax(_cube, axis=1)]]
+        for sigma in smoothsigmas:
+            kern = _kernel(sigma)
+            _sm = spsig.convolve(_cube, kern[np.newaxis, :], mode='full')
+            _vcens = vcens[0] + (np.arange(_sm.shape[1]) 
+                                 - len(kern) // 2) * dv
+            vpeak_ref.append(_vcens[np.argmax(_sm, axis=1)])
+        mapW, _, vpeak = pp.ppv_peakvels(numpart, Ls, 0, 1, 2, box3, False,
+                                         npix_x, npix_y, 'C2', dct, 
+                                         vmin, vmin + nv * dv, dv,
+                                         smoothsigmas=smoothsigmas,
+                                         maxcells=20000)
+        good = np.allclose(mapW.ravel(), np.sum(cube, axis=1), rtol=1e-4,
+                           atol=1e-6 * np.max(mapW))
+        for i in range(len(smoothsigmas) + 1):
+            good &= np.allclose(vpeak[i].ravel()[hasW], vpeak_ref[i][hasW])
+        good &= np.all(np.isnan(vpeak[:, np.logical_not(
+            hasW.reshape((npix_x, npix_y)))]))
+        if not good:
+            print(f'Failed for thermal b {bth}')
+        allgood &= good
+    return allgood
+
+def test_ppv_thermal_mass():
+    '''
+    check the thermal broadening particle masses in proc_ppv: element 
+    names in any capitalization give the element mass, and the total 
+    metal mass is rejected.
+    '''
+    import fire_an.mainfunc.proc_ppv as pp
+    import fire_an.utils.constants_and_units as c
+    allgood = True
+    for element in ['oxygen', 'Oxygen', 'OXYGEN']:
+        mass_u = pp.thermal_mass_u('Metal', {'element': element})
+        if not np.isclose(mass_u, 15.9994, rtol=1e-3):
+            print(f'Wrong mass {mass_u} for element {element}')
+            allgood = False
+    mass_u = pp.thermal_mass_u('Mass', None)
+    allgood &= np.isclose(mass_u, c.atomw_H)
+    try:
+        pp.thermal_mass_u('Metal', {'element': 'total'})
+        print('No error for total metal mass')
+        allgood = False
+    except ValueError:
+        pass
+    return allgood
@@ -2,6 +2,7 @@
 
 import h5py
 import numpy as np
+import os
 
 import fire_an.readfire.readin_fire_data as rf
 
@@ -55,4 +56,337 @@ def run_checkfields_units(index):
         snap = snaps1[index]
         outfilen = outdir1 + outtemp.format(simname=simname1, snap=snap)
         checkfields_units(dirpath1, snap, *fields1, numpart=100, 
-                          outfilen=outfilen)
\ No newline at end of file
+                          outfilen=outfilen)
+
+
+def test_readarray_cache(dirpath, snapnum, 
+                         field='PartType0/ElementAbundance/Oxygen'):
+    '''
+    check that arrays from the readarray cache match fresh reads,
+    that the cache counters add up, and that the cache can be 
+    bypassed
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    ref = snap.readarray_emulateEAGLE(field)
+    ref_toCGS = snap.toCGS
+    snap_c = rf.get_Firesnap(dirpath, snapnum, cache_maxbytes=2 * ref.nbytes)
+    first = snap_c.readarray_emulateEAGLE(field)
+    # cached arrays are shared and read-only
+    try:
+        first *= 2.
+        same = False
+    except ValueError:
+        same = True
+    second = snap_c.readarray_emulateEAGLE(field)
+    same &= second is first
+    same &= np.all(ref == second) and ref_toCGS == snap_c.toCGS
+    info = snap_c.cache_info()
+    print(info)
+    same &= info['hits'] == 1 and info['misses'] == 1
+    same &= info['bytes'] == ref.nbytes
+    # bypassing the cache: writable, unshared array; the stored one is
+    # dropped
+    third = snap_c.readarray_emulateEAGLE(field, usecache=False)
+    same &= third is not first and third.flags.writeable
+    same &= np.all(ref == third)
+    same &= snap_c.cache_info()['bytes'] == 0
+    return same
+
+def test_readarray_parallel(dirpath, snapnum, numreaders=4,
+                            fields=('PartType0/Coordinates', 
+                                    'PartType0/Masses')):
+    '''
+    check that parallel read-in of split snapshots matches the serial
+    read-in, and print the timing for each
+    '''
+    import time
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    allsame = True
+    for field in fields:
+        for subindex in [None, 0]:
+            if subindex is not None and field.endswith('Masses'):
+                continue
+            t0 = time.time()
+            ser = snap.readarray(field, subindex=subindex, numreaders=1)
+            t1 = time.time()
+            par = snap.readarray(field, subindex=subindex, 
+                                 numreaders=numreaders)
+            t2 = time.time()
+            same = np.array_equal(ser, par)
+            print(f'{field}, subindex {subindex}: serial {t1 - t0:.2f} s,'
+                  f' {numreaders} readers {t2 - t1:.2f} s; match: {same}')
+            allsame &= same
+    return allsame
+
+def test_readarray_indices(dirpath, snapnum, field='PartType0/Coordinates',
+                           fraction=0.02, seed=0):
+    '''
+    check that reading a random subset of particles with 
+    readarray_indices matches indexing the full array
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    full = snap.readarray(field)
+    rng = np.random.default_rng(seed)
+    sel = rng.random(len(full)) < fraction
+    inds = np.where(sel)[0]
+    # unsorted input should come back in input order
+    rng.shuffle(inds)
+    part = snap.readarray_indices(field, inds)
+    same = np.array_equal(full[inds], part)
+    part_bool = snap.readarray_indices(field, sel, subindex=1)
+    same &= np.array_equal(full[sel, 1], part_bool)
+    print('file offsets: ', snap.get_fileoffsets(int(field.split('/')[0][-1])))
+    return same
+
+def test_select_sphere(dirpath, snapnum, center_cm, radius_cm, parttype=0,
+                       indexfile='spatialindex_test.hdf5'):
+    '''
+    compare the spatial-index sphere and box (enclosing the sphere)
+    selections to selections from the full coordinate array
+    '''
+    import fire_an.readfire.spatialindex as si
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    si.make_spatialindex(snap, parttype, outfilen=indexfile, overwrite=True)
+    same = si.spatialindex_isvalid(snap, indexfile, parttype)
+    inds = snap.select_sphere(center_cm, radius_cm, parttype=parttype,
+                              indexfile=indexfile)
+    boxinds = snap.select_box(np.asarray(center_cm) - radius_cm,
+                              np.asarray(center_cm) + radius_cm,
+                              parttype=parttype, indexfile=indexfile)
+    coords = snap.readarray(f'PartType{parttype}/Coordinates', 
+                            usecache=False)
+    coords -= np.asarray(center_cm) / snap.toCGS
+    r2 = np.sum(coords**2, axis=1)
+    ref = np.where(r2 <= (radius_cm / snap.toCGS)**2)[0]
+    boxref = np.where(np.all(np.abs(coords) <= radius_cm / snap.toCGS, 
+                             axis=1))[0]
+    print(f'selected {len(inds)} / {len(coords)} particles')
+    same &= np.array_equal(ref, inds)
+    same &= np.array_equal(boxref, boxinds)
+    return same
+
+def test_derived_fields(dirpath, snapnum, numpart=100):
+    '''
+    check derived-field values against direct calculations from the
+    stored fields (first numpart particles)
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    dens = snap.readarray('PartType0/Density')[:numpart]
+    dens_toCGS = snap.toCGS
+    uint = snap.readarray('PartType0/InternalEnergy')[:numpart]
+    uint_toCGS = snap.toCGS
+    hfrac = snap.readarray_emulateEAGLE(
+        'PartType0/ElementAbundance/Hydrogen')[:numpart]
+    nH = snap.readarray_emulateEAGLE(
+        'PartType0/HydrogenNumberDensity')[:numpart]
+    nH_toCGS = snap.toCGS
+    nH_ref = dens * hfrac * dens_toCGS / (rf.uf.c.atomw_H * rf.uf.c.u) 
+    same = np.allclose(nH * nH_toCGS, nH_ref, rtol=1e-5)
+    pres = snap.readarray_emulateEAGLE('PartType0/Pressure')[:numpart]
+    pres_ref = dens * uint * dens_toCGS * uint_toCGS * (rf.gamma_gas - 1.)
+    same &= np.allclose(pres * snap.toCGS, pres_ref, rtol=1e-5)
+    return same
+
+def test_iter_blocks(dirpath, snapnum, blocksize=10**6,
+                     fields=('PartType0/Temperature', 
+                             'PartType0/HydrogenNumberDensity',
+                             'PartType0/Coordinates')):
+    '''
+    check that blockwise read-in matches whole-array read-in
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    filter = snap.readarray('PartType0/Density') > 0.
+    same = True
+    for field in fields:
+        full = snap.readarray_emulateEAGLE(field)[filter]
+        toCGS = snap.toCGS
+        blocks = [(bdct[field][0], bdct[field][1]) for _, bdct in 
+                  snap.iter_blocks([field], blocksize=blocksize,
+                                   filter=filter)]
+        same &= np.array_equal(full, np.concatenate([b[0] for b in blocks]))
+        same &= np.all([np.isclose(b[1], toCGS) for b in blocks])
+    return same
+
+def test_readarray_elements(dirpath, snapnum, blocksize=10**6,
+                            elements=('Oxygen', 'Hydrogen', 'total', 
+                                      'Iron')):
+    '''
+    check that the one-pass element read-in matches the per-element
+    read-in
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    eltdct = snap.readarray_elements(0, list(elements), blocksize=blocksize)
+    toCGS = snap.toCGS
+    same = True
+    for elt in elements:
+        if elt == 'total':
+            path = 'PartType0/Metallicity'
+        else:
+            path = 'PartType0/ElementAbundance/' + elt
+        ref = snap.readarray_emulateEAGLE(path)
+        same &= np.allclose(eltdct[elt] * toCGS, ref * snap.toCGS, 
+                            rtol=1e-6)
+    return same
+
+def test_floattype(dirpath, snapnum, 
+                   fields=('PartType0/Temperature', 'PartType0/Density',
+                           'PartType0/Coordinates')):
+    '''
+    check that float32 read-in matches the stored-precision read-in
+    (to float32 precision), and that Coordinates are not converted
+    '''
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    snap32 = rf.get_Firesnap(dirpath, snapnum, floattype=np.float32)
+    same = True
+    for field in fields:
+        ref = snap.readarray_emulateEAGLE(field)
+        arr = snap32.readarray_emulateEAGLE(field)
+        if field.endswith('Coordinates'):
+            same &= arr.dtype == ref.dtype
+        else:
+            same &= arr.dtype == np.float32
+        same &= np.allclose(arr, ref, rtol=1e-6)
+    return same
+
+def test_flatsnap(dirpath, snapnum, outdir,
+                  fields=('PartType0/Coordinates', 'PartType0/Density',
+                          'PartType0/Metallicity', 
+                          'PartType0/ElectronAbundance',
+                          'PartType0/InternalEnergy'),
+                  checkfields=('PartType0/Coordinates', 
+                               'PartType0/ElementAbundance/Oxygen',
+                               'PartType0/Temperature')):
+    '''
+    check that the memmap reader of extracted fields returns the same
+    values as the snapshot reader, that in-place changes to the
+    returned arrays don't affect later read-ins, and that the header
+    and cosmology helpers work
+    '''
+    import fire_an.readfire.flatsnap as fs
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    manifestfilen = fs.extract_flatsnap(snap, list(fields), outdir=outdir, 
+                                        blocksize=10**6)
+    flat = rf.Flatsnap(manifestfilen)
+    same = True
+    for field in checkfields:
+        ref = snap.readarray_emulateEAGLE(field)
+        ref_toCGS = snap.toCGS
+        arr = flat.readarray_emulateEAGLE(field)
+        same &= np.array_equal(arr, ref)
+        same &= np.isclose(flat.toCGS, ref_toCGS)
+        arr *= 2.
+        same &= np.array_equal(flat.readarray_emulateEAGLE(field), ref)
+    # Firesnap helpers that use the first snapshot file
+    flat.find_cosmopars()
+    same &= flat.cosmopars.getdct() == snap.cosmopars.getdct()
+    same &= flat.readattr('Header', 'Redshift') \
+            == snap.readattr('Header', 'Redshift')
+    return same
+
+def test_snapcatalogue(dirpath, snapnum, field='PartType0/Density'):
+    '''
+    check that a snapshot reader made from the snapshot catalogue 
+    entry matches one made from the files
+    '''
+    snap_files = rf.get_Firesnap(dirpath, snapnum, usecatalogue=False)
+    # first call stores the entry (if not already stored)
+    rf.get_Firesnap(dirpath, snapnum, usecatalogue=True)
+    snap_cat = rf.get_Firesnap(dirpath, snapnum, usecatalogue=True)
+    same = snap_files.filens == snap_cat.filens
+    same &= snap_files.cosmopars.getdct() == snap_cat.cosmopars.getdct()
+    ref = snap_files.readarray(field)
+    ref_toCGS = snap_files.toCGS
+    arr = snap_cat.readarray(field)
+    same &= np.array_equal(arr, ref)
+    same &= np.isclose(snap_cat.toCGS, ref_toCGS)
+    return same
+
+def test_gasstate(dirpath, snapnum, outdir, numsel=10**5):
+    '''
+    check that ion fraction inputs read from a gas state file match
+    those calculated from the snapshot (to float32 precision), for all
+    gas and a selection, and that get_qty ion quantities are the same
+    with and without the file
+    '''
+    import fire_an.mainfunc.get_qty as gq
+    import fire_an.readfire.gasstate as gs
+    import fire_an.utils.opts_locs as ol
+    snap = rf.get_Firesnap(dirpath, snapnum)
+    _dir_snapsidecars = ol.dir_snapsidecars
+    ol.dir_snapsidecars = outdir
+    try:
+        ref = gq.get_ionfrac_inputs(snap, usegasstate=False)
+        gq.make_gasstate(snap, overwrite=True)
+        same = gs.gasstate_isvalid(snap, gs.gasstate_filen(snap))
+        stored = gq.get_ionfrac_inputs(snap)
+        numpart = len(ref['logT'])
+        sel = np.random.default_rng(0).choice(numpart, size=numsel, 
+                                              replace=False)
+        sel.sort()
+        stored_sel = gq.get_ionfrac_inputs(snap, indct={'filter': sel})
+        for key in gs.gasstate_fields:
+            same &= np.allclose(stored[key], ref[key], rtol=1e-6)
+            same &= np.array_equal(stored_sel[key], stored[key][sel])
+        maptype_args = {'ion': 'O6', 'ionfrac-method': 'PS20'}
+        filter = np.zeros(numpart, dtype=bool)
+        filter[sel] = True
+        qty_gs, toCGS_gs, _ = gq.get_qty(snap, 0, 'ion', maptype_args,
+                                         filterdct={'filter': filter})
+        os.remove(gs.gasstate_filen(snap))
+        qty, toCGS, _ = gq.get_qty(snap, 0, 'ion', maptype_args,
+                                   filterdct={'filter': filter})
+        same &= np.allclose(qty_gs * toCGS_gs, qty * toCGS, rtol=1e-5)
+    finally:
+        ol.dir_snapsidecars = _dir_snapsidecars
+    return same
+
+def test_gasstate_mock(outdir, numpart=1000):
+    '''
+    check that ion fraction inputs for snapshots without files 
+    (MockFireSpec) or without a gas state directory are calculated
+    from the snapshot data, and that a valid gas state file is used
+    for snapshots with files
+    '''
+    import fire_an.mainfunc.get_qty as gq
+    import fire_an.readfire.gasstate as gs
+    import fire_an.utils.opts_locs as ol
+    rng = np.random.default_rng(0)
+    data = {'PartType0/Temperature': rng.uniform(1e4, 1e6, numpart),
+            'PartType0/Density': rng.uniform(1e-3, 1., numpart),
+            'PartType0/ElementAbundance/Hydrogen': np.full(numpart, 0.7),
+            'PartType0/Metallicity': rng.uniform(1e-4, 0.02, numpart)}
+    snap = rf.MockFireSpec(data)
+    ref = gq.get_ionfrac_inputs(snap, usegasstate=False)
+    out = gq.get_ionfrac_inputs(snap)
+    same = all([np.array_equal(ref[key], out[key]) 
+                for key in gs.gasstate_fields])
+
+    # mock snapshot with (dummy) files
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    snapfilen = outdir + '/snapshot_000.0.hdf5'
+    with open(snapfilen, 'w') as f:
+        f.write('mock snapshot file')
+    snap.filens = [snapfilen]
+    snap.firstfilen = snapfilen
+    snap.get_fileoffsets = lambda parttype: np.array([0, numpart])
+    stored = {key: ref[key] + 1. for key in gs.gasstate_fields}
+    _hasdir = hasattr(ol, 'dir_snapsidecars')
+    _dir_snapsidecars = getattr(ol, 'dir_snapsidecars', None)
+    try:
+        ol.dir_snapsidecars = outdir
+        gs.write_gasstate(snap, stored, overwrite=True)
+        out = gq.get_ionfrac_inputs(snap)
+        same &= all([np.allclose(stored[key], out[key], rtol=1e-6) 
+                     for key in gs.gasstate_fields])
+        # no gas state directory: not used
+        del ol.dir_snapsidecars
+        out = gq.get_ionfrac_inputs(snap)
+        same &= all([np.array_equal(ref[key], out[key]) 
+                     for key in gs.gasstate_fields])
+    finally:
+        if _hasdir:
+            ol.dir_snapsidecars = _dir_snapsidecars
+        elif hasattr(ol, 'dir_snapsidecars'):
+            del ol.dir_snapsidecars
+    return same
@@ -31,8 +31,16 @@ simdir_fire3_m12plus = ''
 simdir_fire3x_tests = '/scratch3/01799/phopkins/fire3_suite_done/'
 dir_halodata = frontera_work + 'halodata/'
 filen_halocenrvir = dir_halodata + 'cen_rvir.hdf5'
+# spatial index and other derived per-snapshot files
+dir_snapsidecars = dir_halodata + 'snapsidecars/'
 
 kernel_list = ['C2','gadget']
+# cached projected kernel tables (utils.projection.ProjKernelTable)
+dir_kerneltables = dir_halodata + 'kerneltables/'
+# cached per-map reductions for map stacks (makeplots.stackmaps)
+dir_mapstackcache = dir_halodata + 'mapstackcache/'
+# cached redshift-interpolated PS20 tables (ionrad.ion_utils)
+dir_ps20tables = dir_halodata + 'ps20tables/'
 # desngb = 58 read out from sample hdf5 file (RunTimePars)
 desngb = 58
 
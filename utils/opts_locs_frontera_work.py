@@ -7,6 +7,8 @@
 ############################
 dir_halodata = '/work2/08466/tg877653/frontera/halodata/'
 filen_halocenrvir = dir_halodata + 'cen_rvir.hdf5'
+# spatial index and other derived per-snapshot files
+dir_snapsidecars = dir_halodata + 'snapsidecars/'
 
 frontera_work = '/work2/08466/tg877653/frontera/'
 frontera_scratch = '/scratch1/08466/tg877653/'
@@ -24,6 +26,12 @@ simdir_fire3_m12plus = ''
 simdir_fire3x_tests = '/scratch3/01799/phopkins/fire3_suite_done/'
 
 kernel_list = ['C2','gadget']
+# cached projected kernel tables (utils.projection.ProjKernelTable)
+dir_kerneltables = dir_halodata + 'kerneltables/'
+# cached per-map reductions for map stacks (makeplots.stackmaps)
+dir_mapstackcache = dir_halodata + 'mapstackcache/'
+# cached redshift-interpolated PS20 tables (ionrad.ion_utils)
+dir_ps20tables = dir_halodata + 'ps20tables/'
 # desngb = 58 read out from sample hdf5 file (RunTimePars)
 # needed for C projection routine, but only used if smoothing lengths
 # need to be calculated
@@ -32,10 +32,18 @@ simdir_fire2_md = '/projects/b1026/snapshots/metal_diffusion/'
 simdir_fire3_m12plus = '/projects/b1026/snapshots/fire3_m12_new/'
 dir_halodata = pre_data + 'halodata_fire/'
 filen_halocenrvir = dir_halodata + 'cen_rvir.hdf5'
+# spatial index and other derived per-snapshot files
+dir_snapsidecars = dir_halodata + 'snapsidecars/'
 
 path_jscoolingflow = '/home/naw0231/code/'
 
 kernel_list = ['C2','gadget']
+# cached projected kernel tables (utils.projection.ProjKernelTable)
+dir_kerneltables = dir_halodata + 'kerneltables/'
+# cached per-map reductions for map stacks (makeplots.stackmaps)
+dir_mapstackcache = dir_halodata + 'mapstackcache/'
+# cached redshift-interpolated PS20 tables (ionrad.ion_utils)
+dir_ps20tables = dir_halodata + 'ps20tables/'
 # desngb = 58 read out from sample hdf5 file (RunTimePars)
 desngb = 58
 
@@ -30,8 +30,16 @@ simdir_fire2_md = '/scratch/projects/xsede/GalaxiesOnFIRE/metal_diffusion/'
 simdir_fire3_m12plus = '/scratch/projects/xsede/GalaxiesOnFIRE/fire3/m12_new/'
 dir_halodata = stampede2_work + 'halodata/'
 filen_halocenrvir = dir_halodata + 'cen_rvir.hdf5'
+# spatial index and other derived per-snapshot files
+dir_snapsidecars = dir_halodata + 'snapsidecars/'
 
 kernel_list = ['C2','gadget']
+# cached projected kernel tables (utils.projection.ProjKernelTable)
+dir_kerneltables = dir_halodata + 'kerneltables/'
+# cached per-map reductions for map stacks (makeplots.stackmaps)
+dir_mapstackcache = dir_halodata + 'mapstackcache/'
+# cached redshift-interpolated PS20 tables (ionrad.ion_utils)
+dir_ps20tables = dir_halodata + 'ps20tables/'
 # desngb = 58 read out from sample hdf5 file (RunTimePars)
 desngb = 58
 
@@ -2,13 +2,51 @@
 """
 
 """
-import numpy as np
+import concurrent.futures as cf
 import ctypes as ct
+import h5py
+from multiprocessing import shared_memory
+import numpy as np
+import os
 
 import fire_an.utils.opts_locs as ol
 
+def _mapedges(Ls, Axis1, Axis2, Axis3, box3, periodic, projmin=None,
+              projmax=None):
+    '''
+    map edges (Xmin, Xmax, Ymin, Ymax, Zmin, Zmax) for project
+    '''
+    if not periodic: # 0-centered
+        Xmin = -0.5 * Ls[Axis1]
+        Xmax =  0.5 * Ls[Axis1]
+        Ymin = -0.5 * Ls[Axis2]
+        Ymax =  0.5 * Ls[Axis2]
+        if projmin is None:
+            Zmin = -0.5 * Ls[Axis3]
+        else:
+            Zmin = projmin
+        if projmax is None:
+            Zmax = 0.5 * Ls[Axis3]
+        else:
+            Zmax = projmax
+    # half box centered (BoxSize used for x-y periodic boundary 
+    # conditions)
+    else: 
+        Xmin, Ymin = (0.,) * 2
+        Xmax, Ymax = (box3[Axis1], box3[Axis2])
+        if projmin is None:
+            Zmin = 0.5 * (box3[Axis3] - Ls[Axis3])
+        else:
+            Zmin = projmin
+        if projmax is None:
+            Zmax = 0.5 * (box3[Axis3] + Ls[Axis3])
+        else:
+            Zmax = projmax
+    return Xmin, Xmax, Ymin, Ymax, Zmin, Zmax
+
 def project(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
-            kernel, dct, tree, ompproj=True, projmin=None, projmax=None):
+            kernel, dct, tree, ompproj=True, projmin=None, projmax=None,
+            backend='C', Hmax=None):
     '''
     Parameters:
     -----------
@@ -65,6 +103,15 @@ def project(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
         maximum coordinate values in projection direction
         (override default values in Ls; I put this in for a specific
         application)
+    backend: ['C', 'numpy']
+        'C': use the HsmlAndProject shared libraries in 
+        opts_locs.hsml_dir.
+        'numpy': use the built-in NumPy projection (project_numpy). 
+        This does not need any compiled libraries; tree and ompproj are
+        ignored. 
+    Hmax: float or None
+        maximum smoothing length (same units as coordinates). The 
+        default (None) is half the smaller map dimension.
               
     Returns:
     --------
@@ -78,6 +125,13 @@ def project(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
         outside the projected region
     - ResultQ: qW-weighted average of qQ in each pixel
     '''
+    if backend == 'numpy':
+        return project_numpy(NumPart, Ls, Axis1, Axis2, Axis3, box3, 
+                             periodic, npix_x, npix_y, kernel, dct,
+                             projmin=projmin, projmax=projmax, Hmax=Hmax)
+    elif backend != 'C':
+        msg = 'backend should be "C" or "numpy", not {}'
+        raise ValueError(msg.format(backend))
 
     # positions [Mpc / cm/s], kernel sizes [Mpc] and input quantities
     # a quirk of HsmlAndProject is that it only works for >= 100 
@@ -114,38 +168,17 @@ def project(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
     # these need to be defined wrt the 'rotated' axes, 
     # e.g. Zmin, Zmax are always the min/max along the projection 
     # direction
-    if not periodic: # 0-centered
-        Xmin = -0.5 * Ls[Axis1]
-        Xmax =  0.5 * Ls[Axis1]
-        Ymin = -0.5 * Ls[Axis2]
-        Ymax =  0.5 * Ls[Axis2]
-        if projmin is None:
-            Zmin = -0.5 * Ls[Axis3]
-        else:
-            Zmin = projmin
-        if projmax is None:
-            Zmax = 0.5 * Ls[Axis3]
-        else:
-            Zmax = projmax
-    # half box centered (BoxSize used for x-y periodic boundary 
-    # conditions)
-    else: 
-        Xmin, Ymin = (0.,) * 2
-        Xmax, Ymax = (box3[Axis1], box3[Axis2])
-        if projmin is None:
-            Zmin = 0.5 * (box3[Axis3] - Ls[Axis3])
-        else:
-            Zmin = projmin
-        if projmax is None:
-            Zmax = 0.5 * (box3[Axis3] + Ls[Axis3])
-        else:
-            Zmax = projmax
+    Xmin, Xmax, Ymin, Ymax, Zmin, Zmax = _mapedges(Ls, Axis1, Axis2, Axis3, 
+                                                   box3, periodic, 
+                                                   projmin=projmin,
+                                                   projmax=projmax)
 
     BoxSize = box3[Axis1]
 
     # maximum kernel size [Mpc] (modified from Marijke's version)
     # Axis3 might be velocity; whole different units, so just ignore
-    Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
+    if Hmax is None:
+        Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
 
     # arrays to be filled with resulting maps
     ResultW = np.zeros((npix_x, npix_y)).astype(np.float32)
@@ -251,4 +284,695 @@ def project(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
     print('Total quantity Q in:  %.5e' % (np.sum(c_QuantityQ)))
     print('Total quantity Q out: %.5e' % (np.sum(ResultQ)))
 
-    return ResultW, ResultQ
\ No newline at end of file
+    return ResultW, ResultQ
+
+def kernel_C2(u):
+    '''
+    Wendland C2 kernel shape (not normalized) at u = r / h
+    '''
+    u = np.asarray(u)
+    out = np.zeros(u.shape, dtype=np.float64)
+    sel = u < 1.
+    _u = u[sel]
+    out[sel] = (1. - _u)**4 * (1. + 4. * _u)
+    return out
+
+def kernel_gadget(u):
+    '''
+    Gadget (cubic spline) kernel shape (not normalized) at u = r / h
+    '''
+    u = np.asarray(u)
+    out = np.zeros(u.shape, dtype=np.float64)
+    sel = u < 0.5
+    _u = u[sel]
+    out[sel] = 1. - 6. * _u**2 + 6. * _u**3
+    sel = np.logical_and(u >= 0.5, u < 1.)
+    _u = u[sel]
+    out[sel] = 2. * (1. - _u)**3
+    return out
+
+kernels = {'C2': kernel_C2,
+           'gadget': kernel_gadget}
+
+def _losquad(nlos):
+    '''
+    Gauss-Legendre nodes and weights for the line-of-sight integrals,
+    mapped from [-1, 1] to [0, 1] (kernels are symmetric along the 
+    line of sight)
+    '''
+    nodes, weights = np.polynomial.legendre.leggauss(nlos)
+    return 0.5 * (nodes + 1.), 0.5 * weights
+
+def projkernel(u, kernel='C2', nlos=16):
+    '''
+    line-of-sight integral of a kernel (kernels) at impact parameter 
+    u = R / h, in units of h and the (not normalized) kernel shape 
+
+    Parameters:
+    -----------
+    u: float array
+        impact parameter in units of the smoothing length
+    kernel: ['C2', 'gadget']
+        kernel shape
+    nlos: int
+        number of Gauss-Legendre points for the integral
+
+    Returns:
+    --------
+    the column integral, same shape as u (float64)
+    '''
+    kernfunc = kernels[kernel]
+    losnodes, losweights = _losquad(nlos)
+    u = np.asarray(u, dtype=np.float64)
+    out = np.zeros(u.shape, dtype=np.float64)
+    sel = u < 1.
+    _u = u[sel]
+    # half the chord length through the kernel support
+    zmax = np.sqrt(1. - _u**2)
+    zs = zmax[:, np.newaxis] * losnodes[np.newaxis, :]
+    ws = kernfunc(np.sqrt(_u[:, np.newaxis]**2 + zs**2))
+    out[sel] = 2. * zmax * np.sum(ws * losweights[np.newaxis, :], axis=1)
+    return out
+
+def kerneltable_filen(kernel, ntab):
+    '''
+    file name for a cached ProjKernelTable
+    '''
+    outdir = ol.dir_kerneltables
+    if not outdir.endswith('/'):
+        outdir = outdir + '/'
+    return outdir + f'projkernel_{kernel}_ntab{ntab}.hdf5'
+
+class ProjKernelTable:
+    '''
+    table of the kernel line-of-sight integral (projkernel) on an even
+    grid in u**2 = (R / h)**2, for fast linear interpolation. 
+    Tabulating in u**2 means no square roots are needed to look up the 
+    values for particle-pixel or particle-sightline distances.
+
+    Accuracy vs. table size: the interpolation error scales roughly
+    as ntab**-2. The maximum absolute errors, relative to the central 
+    value, are (test_projection.benchmark_projkernel_table):
+        ntab     C2        gadget
+        65       2.3e-3    1.0e-3
+        257      2.0e-4    7.9e-5
+        1025     1.6e-5    6.0e-6
+        4097     1.2e-6    4.7e-7
+    Table look-ups are 30 -- 50 times faster than the direct 
+    calculation (16-point integrals), independent of table size. 
+    The default (1025) is far below the float32 precision of the maps
+    in the pixel sums, and the table (8 kB) fits in the L1 cache.
+
+    Tables are cached in memory (get_projkernel_table) and on disk
+    (opts_locs.dir_kerneltables), since the accurate line-of-sight 
+    integrals are slower to calculate.
+    '''
+    # line-of-sight integral points for the tabulated values
+    nlos_table = 64
+
+    def __init__(self, kernel='C2', ntab=1025, usecache=True):
+        '''
+        Parameters:
+        -----------
+        kernel: ['C2', 'gadget']
+            kernel shape
+        ntab: int
+            number of table points in u**2 (0 -- 1)
+        usecache: bool
+            read the table from disk if it was stored before, and 
+            store it if not
+        '''
+        if kernel not in kernels:
+            msg = 'kernel should be one of {}, not {}'
+            raise ValueError(msg.format(list(kernels.keys()), kernel))
+        self.kernel = kernel
+        self.ntab = ntab
+        self.u2 = np.linspace(0., 1., self.ntab)
+        self.table = None
+        if usecache:
+            self.filen = kerneltable_filen(self.kernel, self.ntab)
+            self._readtable()
+        if self.table is None:
+            self.table = projkernel(np.sqrt(self.u2), kernel=self.kernel,
+                                    nlos=self.nlos_table)
+            if usecache:
+                self._savetable()
+        self.slopes = np.diff(self.table)
+        # 2D integral of the table = 3D kernel integral
+        # 2 pi int u F(u) du = pi int F du**2
+        self.norm = np.pi * np.sum(0.5 * (self.table[1:] + self.table[:-1])) \
+                    / (self.ntab - 1)
+    
+    def _readtable(self):
+        if not os.path.isfile(self.filen):
+            return None
+        with h5py.File(self.filen, 'r') as f:
+            if f.attrs['nlos'] != self.nlos_table:
+                return None
+            self.table = f['projkernel'][:]
+
+    def _savetable(self):
+        try:
+            outdir = os.path.dirname(self.filen)
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            # write to a temporary file first: other processes might 
+            # be reading the table
+            tempfilen = self.filen + '.{}.tmp'.format(os.getpid())
+            with h5py.File(tempfilen, 'w') as f:
+                f.create_dataset('projkernel', data=self.table)
+                f.create_dataset('u2', data=self.u2)
+                f.attrs.create('kernel', np.string_(self.kernel))
+                f.attrs.create('nlos', self.nlos_table)
+                _info = ('line of sight integral of the (not normalized)'
+                         ' kernel at impact parameter u = sqrt(u2) in '
+                         'units of the smoothing length')
+                f.attrs.create('info', np.string_(_info))
+            os.replace(tempfilen, self.filen)
+        except OSError as err:
+            print('Warning: could not save kernel table '
+                  '{}:\n{}'.format(self.filen, err))
+
+    def __call__(self, u2):
+        '''
+        linearly interpolated projected kernel at u2 = (R / h)**2
+        (float array, any shape). Returns a float64 array of the same 
+        shape (zero for u2 >= 1).
+        '''
+        u2 = np.asarray(u2)
+        x = u2 * (self.ntab - 1)
+        ind = x.astype(np.int64)
+        np.clip(ind, 0, self.ntab - 2, out=ind)
+        x -= ind
+        out = self.slopes[ind]
+        out *= x
+        out += self.table[ind]
+        out[u2 >= 1.] = 0.
+        return out
+
+# projected kernel tables, by kernel and table size
+_kerneltables = {}
+
+def get_projkernel_table(kernel='C2', ntab=1025, usecache=True):
+    '''
+    get a ProjKernelTable, only reading or calculating it once per 
+    process
+    '''
+    key = (kernel, ntab)
+    if key not in _kerneltables:
+        _kerneltables[key] = ProjKernelTable(kernel=kernel, ntab=ntab,
+                                             usecache=usecache)
+    return _kerneltables[key]
+
+def sightline_weights(impactpar, lsmooth, kernel='C2', ntab=1025):
+    '''
+    normalized kernel column weights for particles along a sightline,
+    e.g., for column densities N = sum(quantity * weights) for 
+    particle quantities (ion numbers, masses, ...), or weighted 
+    averages along a sightline
+
+    Parameters:
+    -----------
+    impactpar: float array
+        distance of the particles to the sightline
+    lsmooth: float array
+        particle smoothing lengths (same units as impactpar)
+    kernel: ['C2', 'gadget']
+        kernel shape
+    ntab: int
+        kernel table size (see ProjKernelTable)
+
+    Returns:
+    --------
+    weights: float64 array
+        kernel column integral normalized to a total of one, in units 
+        of 1 / lsmooth units**2
+    '''
+    kt = get_projkernel_table(kernel=kernel, ntab=ntab)
+    lsmooth = np.asarray(lsmooth, dtype=np.float64)
+    u2 = (np.asarray(impactpar, dtype=np.float64) / lsmooth)**2
+    weights = kt(u2)
+    weights /= kt.norm * lsmooth**2
+    return weights
+
+def kernelpairs(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, 
+                npix_x, npix_y, kernel, dct, projmin=None, projmax=None,
+                Hmax=None, maxpairs=2**22, kerneltable=True):
+    '''
+    generator for the particle-pixel pairs of a projection, with the
+    kernel weights of each pair. Parameters are as for project_numpy;
+    dct only needs the 'coords', 'lsmooth', and 'qW' entries (qW is 
+    only used to skip particles with zero weight).
+
+    As in the C version, smoothing lengths are set to at least the 
+    pixel diagonal and at most half the smaller map dimension (or 
+    Hmax). Particle positions along the line of sight must be within 
+    the projected range; only perpendicular to the line of sight are 
+    kernels cut off at the map edges, or wrapped around for periodic 
+    maps. Particles are processed in groups with the same footprint 
+    size in pixels, with at most maxpairs particle-pixel pairs at a 
+    time, to bound memory use. 
+
+    Yields:
+    -------
+    pinds: int array
+        particle index (in dct) for each pair
+    pixinds: int array
+        flattened map pixel index (ix * npix_y + iy) for each pair
+    weights: float64 array
+        kernel column integral at the pixel center, normalized so that
+        the weights for each particle sum to one over all pixels 
+        (including those outside the map)
+    '''
+    if kernel not in kernels:
+        msg = 'kernel should be one of {}, not {}'
+        raise ValueError(msg.format(list(kernels.keys()), kernel))
+    Xmin, Xmax, Ymin, Ymax, Zmin, Zmax = _mapedges(Ls, Axis1, Axis2, Axis3, 
+                                                   box3, periodic, 
+                                                   projmin=projmin,
+                                                   projmax=projmax)
+    pixsize_x = (Xmax - Xmin) / npix_x
+    pixsize_y = (Ymax - Ymin) / npix_y
+    hmin = np.sqrt(pixsize_x**2 + pixsize_y**2)
+    if Hmax is None:
+        Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
+    if kerneltable:
+        kt = get_projkernel_table(kernel=kernel)
+
+    pos = dct['coords']
+    qW = dct['qW']
+    h = np.clip(dct['lsmooth'][:NumPart].astype(np.float64), hmin, Hmax)
+
+    _z = pos[:NumPart, Axis3]
+    sel = np.logical_and(_z >= Zmin, _z <= Zmax)
+    del _z
+    sel &= qW[:NumPart] != 0.
+    if not periodic:
+        for ax, _min, _max in [(Axis1, Xmin, Xmax), (Axis2, Ymin, Ymax)]:
+            _x = pos[:NumPart, ax]
+            sel &= _x + h > _min
+            sel &= _x - h < _max
+            del _x
+    inds = np.where(sel)[0]
+    del sel
+    # pixel half-widths of the particle footprints
+    nhx = np.floor(h[inds] / pixsize_x).astype(np.int64) + 1
+    nhy = np.floor(h[inds] / pixsize_y).astype(np.int64) + 1
+    groupkey = nhx * (np.max(nhy, initial=0) + 1) + nhy
+    order = np.argsort(groupkey, kind='stable')
+    inds = inds[order]
+    nhx = nhx[order]
+    nhy = nhy[order]
+    groupkey = groupkey[order]
+    del order
+    gstarts = np.where(np.diff(groupkey) != 0)[0] + 1
+    gstarts = np.append(0, gstarts)
+    gends = np.append(gstarts[1:], len(groupkey))
+    del groupkey
+
+    for gstart, gend in zip(gstarts, gends):
+        if gend <= gstart:
+            continue
+        _nhx = nhx[gstart]
+        _nhy = nhy[gstart]
+        offx = np.arange(-_nhx, _nhx + 1)
+        offy = np.arange(-_nhy, _nhy + 1)
+        npairs = len(offx) * len(offy)
+        if not kerneltable:
+            # line-of-sight integration points
+            npairs *= 16
+        chunksize = max(1, maxpairs // npairs)
+        for cstart in range(gstart, gend, chunksize):
+            _inds = inds[cstart: min(cstart + chunksize, gend)]
+            _h = h[_inds]
+            px = (pos[_inds, Axis1] - Xmin) / pixsize_x
+            py = (pos[_inds, Axis2] - Ymin) / pixsize_y
+            ix = np.floor(px).astype(np.int64)[:, np.newaxis] \
+                 + offx[np.newaxis, :]
+            iy = np.floor(py).astype(np.int64)[:, np.newaxis] \
+                 + offy[np.newaxis, :]
+            # pixel center distances in units of h
+            dx = (ix + 0.5 - px[:, np.newaxis]) \
+                 * (pixsize_x / _h[:, np.newaxis])
+            dy = (iy + 0.5 - py[:, np.newaxis]) \
+                 * (pixsize_y / _h[:, np.newaxis])
+            del px, py
+            u2 = dx[:, :, np.newaxis]**2 + dy[:, np.newaxis, :]**2
+            del dx, dy
+            if kerneltable:
+                wk = kt(u2)
+            else:
+                wk = projkernel(np.sqrt(u2), kernel=kernel)
+            del u2
+            norm = np.sum(wk, axis=(1, 2))
+            norm[norm <= 0.] = np.inf # nothing deposited
+            wk *= (1. / norm)[:, np.newaxis, np.newaxis]
+            if periodic:
+                ix %= npix_x
+                iy %= npix_y
+                pixinds = ix[:, :, np.newaxis] * npix_y \
+                          + iy[:, np.newaxis, :]
+                wk = wk.ravel()
+                pixinds = pixinds.ravel()
+                pinds = np.repeat(_inds, len(offx) * len(offy))
+            else:
+                inmap = np.logical_and(ix >= 0, ix < npix_x)[:, :, np.newaxis]
+                inmap = np.logical_and(inmap, np.logical_and(
+                    iy >= 0, iy < npix_y)[:, np.newaxis, :])
+                pixinds = ix[:, :, np.newaxis] * npix_y \
+                          + iy[:, np.newaxis, :]
+                wk = wk[inmap]
+                pixinds = pixinds[inmap]
+                pinds = np.broadcast_to(_inds[:, np.newaxis, np.newaxis],
+                                        inmap.shape)[inmap]
+                del inmap
+            del ix, iy
+            if len(pixinds) == 0:
+                continue
+            yield pinds, pixinds, wk
+
+def project_numpy(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, 
+                  npix_x, npix_y, kernel, dct, projmin=None, projmax=None,
+                  Hmax=None, maxpairs=2**22, kerneltable=True):
+    '''
+    NumPy version of project (same parameters and return values), 
+    which does not need the HsmlAndProject libraries.
+
+    Each particle's qW is distributed over the pixels it overlaps with 
+    weights given by the kernel column integral at the pixel centers, 
+    normalized so that the weights sum to one over all pixels 
+    (including those outside the map); see kernelpairs for the 
+    smoothing length limits and the processing in groups. 
+    With kerneltable=True (default), the kernel column integrals are 
+    interpolated from a ProjKernelTable, otherwise, they are 
+    calculated for each particle-pixel pair (projkernel). 
+    '''
+    qW = dct['qW']
+    qQ = dct['qQ']
+    print('Total quantity W in: %.5e' % (np.sum(qW[:NumPart])))
+    print('Total quantity Q in: %.5e' % (np.sum(qQ[:NumPart])))
+
+    # sum in float64, return float32 like the C version
+    ResultW = np.zeros(npix_x * npix_y, dtype=np.float64)
+    ResultQ = np.zeros(npix_x * npix_y, dtype=np.float64)
+    for pinds, pixinds, wk in kernelpairs(NumPart, Ls, Axis1, Axis2, Axis3,
+                                          box3, periodic, npix_x, npix_y,
+                                          kernel, dct, projmin=projmin,
+                                          projmax=projmax, Hmax=Hmax,
+                                          maxpairs=maxpairs,
+                                          kerneltable=kerneltable):
+        wk *= qW[pinds]
+        pmin = np.min(pixinds)
+        pixinds -= pmin
+        _sumW = np.bincount(pixinds, weights=wk)
+        ResultW[pmin: pmin + len(_sumW)] += _sumW
+        wk *= qQ[pinds]
+        _sumQ = np.bincount(pixinds, weights=wk)
+        ResultQ[pmin: pmin + len(_sumQ)] += _sumQ
+        del wk, pinds, pixinds, _sumW, _sumQ
+    nonzero = ResultW != 0.
+    ResultQ[nonzero] /= ResultW[nonzero]
+    ResultQ[np.logical_not(nonzero)] = 0.
+    ResultW = ResultW.astype(np.float32).reshape((npix_x, npix_y))
+    ResultQ = ResultQ.astype(np.float32).reshape((npix_x, npix_y))
+    
+    print('Total quantity W out: %.5e' % (np.sum(ResultW)))
+    print('Total quantity Q out: %.5e' % (np.sum(ResultQ)))
+    return ResultW, ResultQ
+
+
+def maptiles(npix_x, npix_y, ntiles_x, ntiles_y):
+    '''
+    split a npix_x x npix_y map into ntiles_x x ntiles_y tiles of 
+    (nearly) equal size
+
+    Returns:
+    --------
+    list of (ix0, ix1, iy0, iy1) tuples: the tile is 
+    map[ix0:ix1, iy0:iy1]. Tiles are ordered by x, then y index.
+    '''
+    xedges = np.linspace(0, npix_x, ntiles_x + 1).round().astype(int)
+    yedges = np.linspace(0, npix_y, ntiles_y + 1).round().astype(int)
+    return [(int(xedges[i]), int(xedges[i + 1]), 
+             int(yedges[j]), int(yedges[j + 1]))
+            for i in range(ntiles_x) for j in range(ntiles_y)]
+
+def tileinput(dct, NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, 
+              npix_x, npix_y, tile, projmin=None, projmax=None, 
+              Hmax=None):
+    '''
+    select the particles overlapping a map tile, and get the 
+    project arguments to project only that tile. The tile is 
+    projected as a non-periodic map, centered on the tile center; for 
+    periodic maps, particles are included with any periodic shift 
+    that makes them overlap the tile.
+    '''
+    ix0, ix1, iy0, iy1 = tile
+    Xmin, Xmax, Ymin, Ymax, Zmin, Zmax = _mapedges(Ls, Axis1, Axis2, Axis3, 
+                                                   box3, periodic, 
+                                                   projmin=projmin,
+                                                   projmax=projmax)
+    pixsize_x = (Xmax - Xmin) / npix_x
+    pixsize_y = (Ymax - Ymin) / npix_y
+    hmin = np.sqrt(pixsize_x**2 + pixsize_y**2)
+    if Hmax is None:
+        Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
+    txmin = Xmin + ix0 * pixsize_x
+    txmax = Xmin + ix1 * pixsize_x
+    tymin = Ymin + iy0 * pixsize_y
+    tymax = Ymin + iy1 * pixsize_y
+    xc = 0.5 * (txmin + txmax)
+    yc = 0.5 * (tymin + tymax)
+    zc = 0.5 * box3[Axis3] if periodic else 0.
+
+    coords = dct['coords'][:NumPart]
+    h = np.clip(dct['lsmooth'][:NumPart], hmin, Hmax)
+    x = coords[:, Axis1]
+    y = coords[:, Axis2]
+    z = coords[:, Axis3]
+    zsel = np.logical_and(z >= Zmin, z <= Zmax)
+    if periodic:
+        shifts_x = [-box3[Axis1], 0., box3[Axis1]]
+        shifts_y = [-box3[Axis2], 0., box3[Axis2]]
+    else:
+        shifts_x = [0.]
+        shifts_y = [0.]
+    xsels = [np.logical_and(x + sx + h > txmin, x + sx - h < txmax)
+             for sx in shifts_x]
+    ysels = [np.logical_and(y + sy + h > tymin, y + sy - h < tymax)
+             for sy in shifts_y]
+    indss = []
+    offsets = []
+    for xsel, sx in zip(xsels, shifts_x):
+        if not np.any(xsel):
+            continue
+        for ysel, sy in zip(ysels, shifts_y):
+            inds = np.where(np.logical_and(np.logical_and(xsel, ysel), 
+                                           zsel))[0]
+            if len(inds) == 0:
+                continue
+            indss.append(inds)
+            offsets.append((sx, sy))
+    del xsels, ysels, zsel
+    if len(indss) == 0:
+        inds = np.zeros((0,), dtype=np.int64)
+    else:
+        inds = np.concatenate(indss)
+    tcoords = coords[inds].astype(np.float64)
+    start = 0
+    for _inds, (sx, sy) in zip(indss, offsets):
+        end = start + len(_inds)
+        tcoords[start: end, Axis1] += sx - xc
+        tcoords[start: end, Axis2] += sy - yc
+        start = end
+    tcoords[:, Axis3] -= zc
+    tdct = {'coords': tcoords.astype(coords.dtype)}
+    # lsmooth, qW, qQ, and any other per-particle arrays
+    for key in dct:
+        if key != 'coords':
+            tdct[key] = dct[key][inds]
+    tLs = list(Ls)
+    tLs[Axis1] = txmax - txmin
+    tLs[Axis2] = tymax - tymin
+    kwargs = {'NumPart': len(inds), 'Ls': tLs, 
+              'Axis1': Axis1, 'Axis2': Axis2, 'Axis3': Axis3,
+              'box3': box3, 'periodic': False, 
+              'npix_x': ix1 - ix0, 'npix_y': iy1 - iy0,
+              'projmin': Zmin - zc, 'projmax': Zmax - zc, 
+              'Hmax': Hmax}
+    return tdct, kwargs
+
+def _projecttile_shm(shminfo, NumPart, Ls, Axis1, Axis2, Axis3, box3,
+                     periodic, npix_x, npix_y, kernel, tree, ompproj,
+                     projmin, projmax, backend, Hmax, tile, tilefilen):
+    '''
+    worker function for project_tiled: project one tile, using 
+    particle data from shared memory
+    '''
+    shms = {}
+    try:
+        dct = {}
+        for key, (shmname, shape, dtype) in shminfo.items():
+            shms[key] = shared_memory.SharedMemory(name=shmname)
+            dct[key] = np.ndarray(shape, dtype=np.dtype(dtype), 
+                                  buffer=shms[key].buf)
+        tdct, kwargs = tileinput(dct, NumPart, Ls, Axis1, Axis2, Axis3, 
+                                 box3, periodic, npix_x, npix_y, tile, 
+                                 projmin=projmin, projmax=projmax, 
+                                 Hmax=Hmax)
+        del dct
+    finally:
+        for key in shms:
+            shms[key].close()
+    resW, resQ = project(kernel=kernel, dct=tdct, tree=tree, 
+                         ompproj=ompproj, backend=backend, **kwargs)
+    if tilefilen is not None:
+        savetile(tilefilen, resW, resQ, tile, npix_x, npix_y)
+    return tile, resW, resQ
+
+def savetile(filen, resW, resQ, tile, npix_x, npix_y):
+    '''
+    save one map tile from project_tiled to an hdf5 file
+    '''
+    with h5py.File(filen, 'w') as f:
+        f.create_dataset('ResultW', data=resW)
+        f.create_dataset('ResultQ', data=resQ)
+        f.attrs.create('tile_ix0_ix1_iy0_iy1', np.array(tile))
+        f.attrs.create('npix_x', npix_x)
+        f.attrs.create('npix_y', npix_y)
+
+def stitch_tiles(filens):
+    '''
+    combine map tiles saved by project_tiled into full maps
+
+    Parameters:
+    -----------
+    filens: list of str
+        the tile files (including the full path). Missing tiles are 
+        left zero, with a warning.
+    
+    Returns:
+    --------
+    (ResultW, ResultQ) as returned by project
+    '''
+    ResultW = None
+    ResultQ = None
+    done = np.zeros((0, 0), dtype=bool)
+    for filen in filens:
+        with h5py.File(filen, 'r') as f:
+            ix0, ix1, iy0, iy1 = f.attrs['tile_ix0_ix1_iy0_iy1']
+            if ResultW is None:
+                npix_x = int(f.attrs['npix_x'])
+                npix_y = int(f.attrs['npix_y'])
+                ResultW = np.zeros((npix_x, npix_y), dtype=np.float32)
+                ResultQ = np.zeros((npix_x, npix_y), dtype=np.float32)
+                done = np.zeros((npix_x, npix_y), dtype=bool)
+            ResultW[ix0: ix1, iy0: iy1] = f['ResultW'][:]
+            ResultQ[ix0: ix1, iy0: iy1] = f['ResultQ'][:]
+            done[ix0: ix1, iy0: iy1] = True
+    if not np.all(done):
+        print('Warning: the tiles do not cover the whole map')
+    return ResultW, ResultQ
+
+def project_tiled(NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, 
+                  npix_x, npix_y, kernel, dct, tree, ompproj=True, 
+                  projmin=None, projmax=None, backend='C',
+                  ntiles_x=2, ntiles_y=2, nproc=1, tileinds=None,
+                  tilefilen=None):
+    '''
+    project, but with the map split into tiles that are projected 
+    separately, possibly in parallel. Each tile is projected using 
+    only the particles whose smoothing kernels overlap it, with the 
+    minimum and maximum smoothing lengths of the full map, so the 
+    stitched map matches the single projection.
+
+    Parameters:
+    -----------
+    NumPart, Ls, Axis1, Axis2, Axis3, box3, periodic, npix_x, npix_y,
+    kernel, dct, tree, ompproj, projmin, projmax, backend:
+        see project. For nproc > 1, setting ompproj to False might be
+        useful to avoid oversubscribing the cores.
+    ntiles_x, ntiles_y: int
+        number of tiles along the map x and y axes (Axis1 and Axis2)
+    nproc: int
+        number of processes to project tiles in. With nproc > 1, the
+        particle data is copied to shared memory (float32), and each
+        process only holds the particles for one tile.
+    tileinds: list of int or None
+        which tiles (indices in the maptiles list) to project. None 
+        means all tiles. Use this with tilefilen to split a map over
+        different jobs or nodes.
+    tilefilen: str or None
+        if not None, save each tile to this hdf5 file name (including 
+        the full path), with '{tile}' replaced by the tile index. 
+        Combine the tiles with stitch_tiles.
+    
+    Returns:
+    --------
+    (ResultW, ResultQ) as in project. Tiles that were not projected 
+    are left zero.
+    '''
+    tiles = maptiles(npix_x, npix_y, ntiles_x, ntiles_y)
+    if tileinds is None:
+        tileinds = list(range(len(tiles)))
+    if tilefilen is not None and len(tiles) > 1 \
+            and '{tile}' not in tilefilen:
+        msg = 'tilefilen should contain "{{tile}}", got {}'
+        raise ValueError(msg.format(tilefilen))
+    def _tilefilen(ti):
+        return None if tilefilen is None else tilefilen.format(tile=ti)
+    Hmax = 0.5 * min(Ls[Axis1], Ls[Axis2]) 
+
+    ResultW = np.zeros((npix_x, npix_y), dtype=np.float32)
+    ResultQ = np.zeros((npix_x, npix_y), dtype=np.float32)
+    if nproc == 1:
+        for ti in tileinds:
+            tile = tiles[ti]
+            print('Projecting tile {} / {}'.format(ti, len(tiles)))
+            tdct, kwargs = tileinput(dct, NumPart, Ls, Axis1, Axis2, Axis3,
+                                     box3, periodic, npix_x, npix_y, tile,
+                                     projmin=projmin, projmax=projmax, 
+                                     Hmax=Hmax)
+            resW, resQ = project(kernel=kernel, dct=tdct, tree=tree, 
+                                 ompproj=ompproj, backend=backend, **kwargs)
+            del tdct
+            if tilefilen is not None:
+                savetile(_tilefilen(ti), resW, resQ, tile, npix_x, npix_y)
+            ix0, ix1, iy0, iy1 = tile
+            ResultW[ix0: ix1, iy0: iy1] = resW
+            ResultQ[ix0: ix1, iy0: iy1] = resQ
+        return ResultW, ResultQ
+    
+    shms = {}
+    try:
+        shminfo = {}
+        for key in ['coords', 'lsmooth', 'qW', 'qQ']:
+            _in = dct[key][:NumPart]
+            nbytes = max(_in.size * 4, 1)
+            shms[key] = shared_memory.SharedMemory(create=True, size=nbytes)
+            _arr = np.ndarray(_in.shape, dtype=np.float32, 
+                              buffer=shms[key].buf)
+            _arr[:] = _in
+            del _arr, _in
+            shminfo[key] = (shms[key].name, dct[key][:NumPart].shape, 
+                            np.dtype(np.float32).str)
+        print('Projecting {} tiles with {} processes'.format(len(tileinds),
+                                                             nproc))
+        with cf.ProcessPoolExecutor(max_workers=nproc) as ex:
+            futures = [ex.submit(_projecttile_shm, shminfo, NumPart, Ls, 
+                                 Axis1, Axis2, Axis3, box3, periodic, 
+                                 npix_x, npix_y, kernel, tree, ompproj, 
+                                 projmin, projmax, backend, Hmax, 
+                                 tiles[ti], _tilefilen(ti))
+                       for ti in tileinds]
+            for future in cf.as_completed(futures):
+                # re-raises any errors from the worker processes
+                tile, resW, resQ = future.result()
+                ix0, ix1, iy0, iy1 = tile
+                ResultW[ix0: ix1, iy0: iy1] = resW
+                ResultQ[ix0: ix1, iy0: iy1] = resQ
+    finally:
+        for key in shms:
+            shms[key].close()
+            shms[key].unlink()
+    return ResultW, ResultQ